@@ -281,6 +281,11 @@ class PillarServer(BlinkerCompatibleEve):
 
     def _config_encoding_backend(self):
         # Encoding backend
+        if self.config['ENCODING_BACKEND'] == 'local':
+            self.log.info('Setting up video encoding backend %r, using queue %r',
+                          self.config['ENCODING_BACKEND'], self.config['ENCODING_LOCAL_QUEUE'])
+            return
+
         if self.config['ENCODING_BACKEND'] != 'zencoder':
             self.log.warning('Encoding backend %r not supported, no video encoding possible!',
                              self.config['ENCODING_BACKEND'])
@@ -496,8 +501,10 @@ class PillarServer(BlinkerCompatibleEve):
             'pillar.celery.badges',
             'pillar.celery.email_tasks',
             'pillar.celery.file_link_tasks',
+            'pillar.celery.file_processing',
             'pillar.celery.search_index_tasks',
             'pillar.celery.tasks',
+            'pillar.celery.video_encoding',
         ]
 
         # Allow Pillar extensions from defining their own Celery tasks.
@@ -520,6 +527,11 @@ class PillarServer(BlinkerCompatibleEve):
         if beat_schedule:
             self.celery.conf.beat_schedule = beat_schedule
 
+        # Video encoding is heavy, and is done by dedicated workers.
+        self.celery.conf.task_routes = {
+            'pillar.celery.video_encoding.*': {'queue': self.config['ENCODING_LOCAL_QUEUE']},
+        }
+
         self.log.info('Pinging Celery workers')
         self.log.info('Response: %s', self.celery.control.ping())
 
@@ -763,6 +775,7 @@ class PillarServer(BlinkerCompatibleEve):
         coll.create_index([('user', pymongo.ASCENDING)])
         coll.create_index([('token', pymongo.ASCENDING)])
         coll.create_index([('token_hashed', pymongo.ASCENDING)])
+        authentication.create_token_expiry_index(coll)
 
         coll = db['notifications']
         coll.create_index([('user', pymongo.ASCENDING)])
@@ -776,6 +789,8 @@ class PillarServer(BlinkerCompatibleEve):
         coll.create_index([('project', pymongo.ASCENDING),
                            ('node_type', pymongo.ASCENDING)])
         coll.create_index([('parent', pymongo.ASCENDING)])
+        # Used for finding all descendants of a node.
+        coll.create_index([('_ancestors', pymongo.ASCENDING)])
         coll.create_index([('short_code', pymongo.ASCENDING)],
                           sparse=True, unique=True)
         # Used for latest assets & comments
@@ -793,6 +808,17 @@ class PillarServer(BlinkerCompatibleEve):
         coll = db['organizations']
         coll.create_index([('ip_ranges.start', pymongo.ASCENDING)])
         coll.create_index([('ip_ranges.end', pymongo.ASCENDING)])
+
+        coll = db['files']
+        # Used for finding duplicate uploads, see pillar.api.file_storage.dedup.
+        coll.create_index([('project', pymongo.ASCENDING),
+                           ('sha256', pymongo.ASCENDING)],
+                          partialFilterExpression={'sha256': {'$exists': True}})
+
+        coll = db['upload_sessions']
+        coll.create_index([('user', pymongo.ASCENDING)])
+        # Used for finding expired sessions to clean up.
+        coll.create_index([('expires', pymongo.ASCENDING)])
         self.log.debug('Created database indices')
 
     def register_api_blueprint(self, blueprint, url_prefix):
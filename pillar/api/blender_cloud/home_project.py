@@ -407,7 +407,9 @@ def user_changed_role(sender, user):
     log.info('Updating permissions on user %s home project %s from %s to %s',
              user_id, project_id, current_perms, target_permissions)
     proj_coll.update_one({'_id': project_id},
-                         {'$set': {'permissions.groups.0.methods': list(target_permissions)}})
+                         {'$set': {'permissions.groups.0.methods': list(target_permissions),
+                                   '_etag': utils.random_etag()}})
+    authorization.invalidate_project_permissions(project_id)
 
     return True
 
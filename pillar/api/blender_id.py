@@ -4,8 +4,13 @@ Also contains functionality for other parts of Pillar to perform communication
 with Blender ID.
 """
 
+import collections
+import copy
 import datetime
 import logging
+import threading
+import time
+import typing
 from urllib.parse import urljoin
 
 import requests
@@ -24,6 +29,10 @@ blender_id = Blueprint('blender_id', __name__)
 log = logging.getLogger(__name__)
 
 
+# Counters for token validation, see validation_stats().
+_stats: typing.Counter[str] = collections.Counter()
+
+
 class LogoutUser(Exception):
     """Raised when Blender ID tells us the current user token is invalid.
 
@@ -74,15 +83,157 @@ def store_subclient_token():
                     'subclient_user_id': str(db_user['_id'])}), status
 
 
+class _RejectedTokens:
+    """Per-process cache of tokens that Blender ID rejected.
+
+    Only stores hashed tokens. Clients that keep retrying with a revoked
+    token thus only cause a call to Blender ID every once in a while.
+    """
+
+    max_size = 10000
+
+    def __init__(self):
+        self._expiry: typing.MutableMapping[str, float] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            expiry = self._expiry.get(key)
+            if expiry is None:
+                return False
+            if expiry < time.monotonic():
+                del self._expiry[key]
+                return False
+            return True
+
+    def add(self, key: str, timeout: float):
+        with self._lock:
+            self._expiry[key] = time.monotonic() + timeout
+            self._expiry.move_to_end(key)
+            while len(self._expiry) > self.max_size:
+                self._expiry.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._expiry.clear()
+
+
+class _SingleFlight:
+    """Coalesces concurrent calls with the same key into one call.
+
+    The first thread to call do() for a key performs the call; threads that
+    call do() with the same key while that is running wait for its result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: typing.Dict[str, '_SingleFlight._Call'] = {}
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exception: typing.Optional[BaseException] = None
+
+    def do(self, key: str, func: typing.Callable[[], typing.Any]) -> typing.Tuple[typing.Any, bool]:
+        """Calls func(), or waits for the result of an in-flight call.
+
+        :returns: tuple (result, shared), where 'shared' is True when the
+            result came from another thread's call.
+        """
+
+        with self._lock:
+            call = self._in_flight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._in_flight[key] = self._Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result, True
+
+        try:
+            call.result = func()
+        except BaseException as ex:
+            call.exception = ex
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+        return call.result, False
+
+
+_rejected_tokens = _RejectedTokens()
+_validations_in_flight = _SingleFlight()
+
+
+def _token_key(blender_id_user_id, token: str, oauth_subclient_id) -> str:
+    """Returns the key for the token in the negative cache and single-flight calls."""
+    return '%s/%s/%s' % (blender_id_user_id, oauth_subclient_id or '',
+                         authentication.hash_auth_token(token))
+
+
+def _remember_rejection(blender_id_user_id, token: str, oauth_subclient_id):
+    """Stores the token in the negative cache, after Blender ID rejected it."""
+
+    _stats['rejected'] += 1
+    timeout = current_app.config['BLENDER_ID_NEGATIVE_CACHE_TIMEOUT']
+    if timeout > 0:
+        _rejected_tokens.add(_token_key(blender_id_user_id, token, oauth_subclient_id), timeout)
+
+
+def validation_stats() -> typing.Dict[str, int]:
+    """Returns the counters of Blender ID token validation in this process.
+
+    - upstream_calls: token validations sent to Blender ID.
+    - rejected: tokens rejected by Blender ID.
+    - negative_cache_hits: validations skipped because the token was recently rejected.
+    - single_flight_shared: validations that used the result of a concurrent validation.
+    """
+
+    return dict(_stats)
+
+
+def _reset_validation_state():
+    """Forgets the rejected tokens and resets the counters. Only used in unit tests."""
+
+    _stats.clear()
+    _rejected_tokens.clear()
+
+
 def validate_create_user(blender_id_user_id, token, oauth_subclient_id):
     """Validates a user against Blender ID, creating the user in our database.
 
+    Tokens that Blender ID rejected are remembered for
+    BLENDER_ID_NEGATIVE_CACHE_TIMEOUT seconds, and concurrent validations of
+    the same token in this process share a single call to Blender ID.
+
     :param blender_id_user_id: the user ID at the BlenderID server.
     :param token: the OAuth access token.
     :param oauth_subclient_id: the subclient ID, or empty string if not a subclient.
     :returns: (user in MongoDB, HTTP status 200 or 201)
     """
 
+    key = _token_key(blender_id_user_id, token, oauth_subclient_id)
+    if key in _rejected_tokens:
+        log.debug('Token was recently rejected by Blender ID, not validating again.')
+        _stats['negative_cache_hits'] += 1
+        return None, None
+
+    def validate():
+        return _validate_create_user(blender_id_user_id, token, oauth_subclient_id)
+
+    (db_user, status), shared = _validations_in_flight.do(key, validate)
+    if shared:
+        _stats['single_flight_shared'] += 1
+        db_user = copy.deepcopy(db_user)
+    return db_user, status
+
+
+def _validate_create_user(blender_id_user_id, token, oauth_subclient_id):
     # Verify with Blender ID
     log.debug('Storing token for BlenderID user %s', blender_id_user_id)
     user_info, token_expiry = validate_token(blender_id_user_id, token, oauth_subclient_id)
@@ -126,6 +277,7 @@ def validate_token(user_id, token, oauth_subclient_id):
     if oauth_subclient_id and our_subclient_id != oauth_subclient_id:
         log.warning('validate_token(): BlenderID user %s is trying to use the wrong subclient '
                     'ID %r; treating as invalid login.', user_id, oauth_subclient_id)
+        _remember_rejection(user_id, token, oauth_subclient_id)
         return None, None
 
     # Validate against BlenderID.
@@ -146,6 +298,9 @@ def validate_token(user_id, token, oauth_subclient_id):
     log.debug('POSTing to %r', url)
 
     # POST to Blender ID, handling errors as negative verification results.
+    # Communication errors are not remembered as rejections, as they are
+    # most likely temporary.
+    _stats['upstream_calls'] += 1
     s = Session()
     try:
         r = s.post(url, data=payload, timeout=5,
@@ -166,11 +321,14 @@ def validate_token(user_id, token, oauth_subclient_id):
 
     if r.status_code != 200:
         log.debug('Token %s invalid, HTTP status %i returned', token, r.status_code)
+        if r.status_code < 500:
+            _remember_rejection(user_id, token, oauth_subclient_id)
         return None, None
 
     resp = r.json()
     if resp['status'] != 'success':
         log.warning('Failed response from %s: %s', url, resp)
+        _remember_rejection(user_id, token, oauth_subclient_id)
         return None, None
 
     expires = _compute_token_expiry(resp['token_expires'])
@@ -2,6 +2,7 @@ import datetime
 import json
 import logging
 import os
+import typing
 
 from bson import ObjectId
 from flask import Blueprint
@@ -109,21 +110,47 @@ def zencoder_notifications():
     log.info('Zencoder job %s for file %s completed with status %s.', zencoder_job_id, file_id,
              job_state)
 
-    # For every variation encoded, try to update the file object
+    apply_encoded_outputs(file_id, file_doc, data['outputs'],
+                          duration_secs=data['input']['duration_in_ms'] / 1000)
+
+    r, _, _, status = current_app.put_internal('files', file_doc, _id=file_id)
+    if status != 200:
+        log.error('unable to save file %s after Zencoder notification: %s', file_id, r)
+        return json.dumps(r), 500
+
+    return '', 204
+
+
+def apply_encoded_outputs(file_id: ObjectId, file_doc: dict,
+                          outputs: typing.Iterable[dict], *, duration_secs: float):
+    """Updates the variations of the file document with the encoded outputs.
+
+    Shared by all encoding backends. The encoded blobs are renamed to include
+    their size descriptor, and the file is marked as complete. The caller is
+    responsible for saving the file document.
+
+    :param outputs: per encoded variation a dict with the keys 'format',
+        'width', 'height', 'file_size_in_bytes' and 'md5_checksum', as sent
+        by Zencoder.
+    """
+
+    from pillar.api.file_storage import dedup
+
     storage_name, _ = os.path.splitext(file_doc['file_path'])
     nice_name, _ = os.path.splitext(file_doc['filename'])
 
     bucket_class = Bucket.for_backend(file_doc['backend'])
     bucket = bucket_class(str(file_doc['project']))
 
-    for output in data['outputs']:
+    for output in outputs:
         video_format = output['format']
         # Change the zencoder 'mpeg4' format to 'mp4' used internally
         video_format = 'mp4' if video_format == 'mpeg4' else video_format
 
         # Find a variation matching format and resolution
         variation = next((v for v in file_doc['variations']
-                          if v['format'] == format and v['width'] == output['width']), None)
+                          if v['format'] == video_format and v['width'] == output['width']),
+                         None)
         # Fall back to a variation matching just the format
         if variation is None:
             variation = next((v for v in file_doc['variations']
@@ -137,23 +164,27 @@ def zencoder_notifications():
         size = size_descriptor(output['width'], output['height'])
         new_fname = f'{storage_name}-{size}.{video_format}'
 
-        # Rename the file on the storage.
+        # Rename the file on the storage, unless other files use it too.
         blob = bucket.blob(variation['file_path'])
-        try:
-            new_blob = bucket.rename_blob(blob, new_fname)
-            new_blob.update_filename(f'{nice_name}-{size}.{video_format}')
-        except Exception:
-            log.warning('Unable to rename blob %r to %r. Keeping old name.',
-                        blob, new_fname, exc_info=True)
+        if dedup.is_blob_shared({**file_doc, '_id': file_id}, variation['file_path']):
+            log.info('Not renaming blob %r to %r, it is used by other files. Keeping old name.',
+                     blob, new_fname)
         else:
-            variation['file_path'] = new_fname
+            try:
+                new_blob = bucket.rename_blob(blob, new_fname)
+                new_blob.update_filename(f'{nice_name}-{size}.{video_format}')
+            except Exception:
+                log.warning('Unable to rename blob %r to %r. Keeping old name.',
+                            blob, new_fname, exc_info=True)
+            else:
+                variation['file_path'] = new_fname
 
         # TODO: calculate md5 on the storage
         variation.update({
             'height': output['height'],
             'width': output['width'],
             'length': output['file_size_in_bytes'],
-            'duration': data['input']['duration_in_ms'] / 1000,
+            'duration': duration_secs,
             'md5': output['md5_checksum'] or '',  # they don't do MD5 for GCS...
             'size': size,
         })
@@ -163,13 +194,6 @@ def zencoder_notifications():
     # Force an update of the links on the next load of the file.
     file_doc['link_expires'] = utils.utcnow() - datetime.timedelta(days=1)
 
-    r, _, _, status = current_app.put_internal('files', file_doc, _id=file_id)
-    if status != 200:
-        log.error('unable to save file %s after Zencoder notification: %s', file_id, r)
-        return json.dumps(r), 500
-
-    return '', 204
-
 
 def setup_app(app, url_prefix):
     app.register_api_blueprint(encoding, url_prefix=url_prefix)
@@ -348,6 +348,12 @@ nodes_schema = {
         'type': 'integer',
     },
     'parent': _node_embedded_schema,
+    # IDs of all ancestors, the top-level node first and the parent last.
+    # Maintained by pillar.api.nodes.hierarchy; any value sent by clients is replaced.
+    '_ancestors': {
+        'type': 'list',
+        'schema': {'type': 'objectid'},
+    },
     'project': {
         'type': 'objectid',
         'data_relation': {
@@ -450,6 +456,18 @@ files_schema = {
     'height': {
         'type': 'integer'
     },
+    # Properties of the first video stream, as found by ffprobe. See
+    # pillar.api.utils.imaging.probe_video(); width and height are not rotated.
+    'video_probe': {
+        'type': 'dict',
+        'schema': {
+            'duration': {'type': 'number'},  # in seconds
+            'width': {'type': 'integer'},
+            'height': {'type': 'integer'},
+            'codec': {'type': 'string'},
+            'rotation': {'type': 'integer'},  # in degrees clockwise
+        },
+    },
     'user': {
         'type': 'objectid',
         'required': True,
@@ -467,6 +485,9 @@ files_schema = {
         'type': 'string',
         'required': True,
     },
+    'sha256': {  # Hex digest of the file contents.
+        'type': 'string',
+    },
 
     # Original filename as given by the user, cleaned-up to make it safe.
     'filename': {
@@ -564,6 +585,9 @@ files_schema = {
                 'allowed': ["pending", "waiting", "processing", "finished",
                             "failed", "cancelled"]
             },
+            'progress': {  # in percent, only reported by the 'local' backend
+                'type': 'number',
+            },
         }
     },
     'status': {
@@ -1,5 +1,7 @@
+import concurrent.futures
 import datetime
 import io
+import itertools
 import logging
 import mimetypes
 import os
@@ -20,7 +22,6 @@ from flask import Blueprint
 from flask import current_app
 from flask import jsonify
 from flask import request
-from flask import send_from_directory
 from flask import url_for, helpers
 
 from pillar.api import utils
@@ -31,8 +32,9 @@ from pillar.api.utils.authorization import require_login, \
     user_matches_roles
 from pillar.api.utils.cdn import hash_file_path
 from pillar.api.utils.encoding import Encoder
-from pillar.api.file_storage_backends import default_storage_backend, Bucket
+from pillar.api.file_storage_backends import default_storage_backend, Bucket, blob_cache
 from pillar.auth import current_user
+from . import dedup, serving
 
 log = logging.getLogger(__name__)
 
@@ -45,6 +47,25 @@ OVERRIDE_MIMETYPES = {
     # We don't want to thumbnail EXR files right now, so don't handle as image/...
     'image/x-exr': 'application/x-exr',
 }
+# Number of files whose links are refreshed and saved together.
+LINK_REFRESH_BATCH_SIZE = 100
+# Maximum number of files whose links are generated concurrently.
+LINK_REFRESH_THREADS = 8
+# Backends without Bucket class whose links only depend on the file path,
+# see links_are_deterministic().
+DETERMINISTIC_LINK_BACKENDS = {'pillar', 'cdnsun', 'unittest'}
+
+
+class VariationUploadError(Exception):
+    """Raised when one or more variations of a file could not be uploaded."""
+
+    def __init__(self, file_id: ObjectId, failed_paths: typing.List[str]):
+        super().__init__(f'Unable to upload {len(failed_paths)} variations of file {file_id}: '
+                         f'{", ".join(failed_paths)}')
+        self.file_id = file_id
+        self.failed_paths = failed_paths
+
+
 # Add our own extensions to the mimetypes package
 mimetypes.add_type('application/x-blender', '.blend')
 mimetypes.add_type('application/x-radiance-hdr', '.hdr')
@@ -56,7 +77,7 @@ mimetypes.add_type('application/x-exr', '.exr')
 def index(file_name=None):
     # GET file -> read it
     if request.method == 'GET':
-        return send_from_directory(current_app.config['STORAGE_DIR'], file_name)
+        return serving.serve_local_file(file_name)
 
     # POST file -> save it
 
@@ -104,146 +125,87 @@ def _process_image(bucket: Bucket,
     # Send those previews to Google Cloud Storage.
     log.info('Uploading %i thumbnails for file %s to Google Cloud Storage '
              '(GCS)', len(src_file['variations']), file_id)
+    _upload_variations(bucket, file_id, src_file['variations'])
 
-    # TODO: parallelize this at some point.
-    for variation in src_file['variations']:
-        fname = variation['file_path']
-        if current_app.config['TESTING']:
-            log.warning('  - NOT sending thumbnail %s to %s', fname, bucket)
-        else:
-            blob = bucket.blob(fname)
-            log.debug('  - Sending thumbnail %s to %s', fname, blob)
-            blob.upload_from_path(pathlib.Path(variation['local_path']),
-                                  content_type=variation['content_type'])
+    log.info('Done processing file %s', file_id)
+    src_file['status'] = 'complete'
+
+
+def _upload_variations(bucket: Bucket, file_id: ObjectId, variations: typing.List[dict]):
+    """Uploads the variations to the bucket concurrently, and removes the local files.
 
-            if variation.get('size') == 't':
-                blob.make_public()
+    The local files are removed and 'local_path' is deleted from every
+    variation, regardless of whether uploading succeeded. Every upload uses
+    its own Bucket instance, as storage clients are not thread-safe.
 
+    :raises VariationUploadError: when any of the variations failed to upload,
+        after all uploads have finished.
+    """
+
+    if not variations:
+        return
+
+    app = current_app.real_app
+
+    def upload(variation: dict):
+        fname = variation['file_path']
+        local_path = pathlib.Path(variation['local_path'])
         try:
-            os.unlink(variation['local_path'])
-        except OSError:
-            log.warning('Unable to unlink %s, ignoring this but it will need '
-                        'cleanup later.', variation['local_path'])
+            with app.app_context():
+                if app.config['TESTING']:
+                    log.warning('  - NOT sending thumbnail %s to %s', fname, bucket)
+                    return
+
+                blob = bucket.clone().blob(fname)
+                log.debug('  - Sending thumbnail %s to %s', fname, blob)
+                blob.upload_from_path(local_path, content_type=variation['content_type'])
+
+                if variation.get('size') == 't':
+                    blob.make_public()
+        finally:
+            try:
+                local_path.unlink()
+            except OSError:
+                log.warning('Unable to unlink %s, ignoring this but it will need '
+                            'cleanup later.', local_path)
 
-        del variation['local_path']
+    thread_count = min(app.config['VARIATION_UPLOAD_THREADS'], len(variations))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor:
+        futures = [(variation, executor.submit(upload, variation)) for variation in variations]
 
-    log.info('Done processing file %s', file_id)
-    src_file['status'] = 'complete'
+    failed_paths = []
+    for variation, future in futures:
+        del variation['local_path']
 
+        exc = future.exception()
+        if exc is None:
+            continue
+        log.error('Unable to upload variation %s of file %s to %s',
+                  variation['file_path'], file_id, bucket, exc_info=exc)
+        failed_paths.append(variation['file_path'])
 
-def _video_duration_seconds(filename: pathlib.Path) -> typing.Optional[int]:
-    """Get the duration of a video file using ffprobe
-    https://superuser.com/questions/650291/how-to-get-video-duration-in-seconds
+    if failed_paths:
+        raise VariationUploadError(file_id, failed_paths)
 
-    :param filename: file path to video
-    :return: video duration in seconds
-    """
-    import subprocess
-
-    def run(cli_args):
-        if log.isEnabledFor(logging.INFO):
-            import shlex
-            cmd = ' '.join(shlex.quote(s) for s in cli_args)
-            log.info('Calling %s', cmd)
-
-        ffprobe = subprocess.run(
-            cli_args,
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            timeout=10,  # seconds
-        )
-
-        if ffprobe.returncode:
-            import shlex
-            cmd = ' '.join(shlex.quote(s) for s in cli_args)
-            log.error('Error running %s: stopped with return code %i',
-                      cmd, ffprobe.returncode)
-            log.error('Output was: %s', ffprobe.stdout)
-            return None
 
-        try:
-            return int(float(ffprobe.stdout))
-        except ValueError as e:
-            log.exception('ffprobe produced invalid number: %s', ffprobe.stdout)
-            return None
+def _video_probe(filename: pathlib.Path, src_file: dict) -> typing.Optional[imaging.VideoProbe]:
+    """Returns the probe result stored in the file document, probing the file if needed.
 
-    ffprobe_from_container_args = [
-        current_app.config['BIN_FFPROBE'],
-        '-v', 'error',
-        '-show_entries', 'format=duration',
-        '-of', 'default=noprint_wrappers=1:nokey=1',
-        str(filename),
-    ]
-
-    ffprobe_from_stream_args = [
-        current_app.config['BIN_FFPROBE'],
-        '-v', 'error',
-        '-hide_banner',
-        '-select_streams', 'v:0',  # we only care about the first video stream
-        '-show_entries', 'stream=duration',
-        '-of', 'default=noprint_wrappers=1:nokey=1',
-        str(filename),
-    ]
-
-    duration = run(ffprobe_from_stream_args) or \
-               run(ffprobe_from_container_args) or \
-               None
-    return duration
-
-
-def _video_size_pixels(filename: pathlib.Path) -> typing.Tuple[int, int]:
-    """Figures out the size (in pixels) of the video file.
-
-    Returns (0, 0) if there was any error detecting the size.
+    Stores the probe result in src_file.
     """
 
-    import json
-    import subprocess
-
-    cli_args = [
-        current_app.config['BIN_FFPROBE'],
-        '-loglevel', 'error',
-        '-hide_banner',
-        '-print_format', 'json',
-        '-select_streams', 'v:0',  # we only care about the first video stream
-        '-show_streams',
-        str(filename),
-    ]
-
-    if log.isEnabledFor(logging.INFO):
-        import shlex
-        cmd = ' '.join(shlex.quote(s) for s in cli_args)
-        log.info('Calling %s', cmd)
-
-    ffprobe = subprocess.run(
-        cli_args,
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        timeout=10,  # seconds
-    )
+    if src_file.get('video_probe'):
+        return imaging.VideoProbe.from_dict(src_file['video_probe'])
 
-    if ffprobe.returncode:
-        import shlex
-        cmd = ' '.join(shlex.quote(s) for s in cli_args)
-        log.error('Error running %s: stopped with return code %i',
-                  cmd, ffprobe.returncode)
-        log.error('Output was: %s', ffprobe.stdout)
-        return 0, 0
+    probe = imaging.probe_video(filename)
+    if probe is None:
+        return None
 
-    try:
-        ffprobe_info = json.loads(ffprobe.stdout)
-    except json.JSONDecodeError:
-        log.exception('ffprobe produced invalid JSON: %s', ffprobe.stdout)
-        return 0, 0
-
-    try:
-        stream_info = ffprobe_info['streams'][0]
-        return stream_info['width'], stream_info['height']
-    except (KeyError, IndexError):
-        log.exception('ffprobe produced unexpected JSON: %s', ffprobe.stdout)
-        return 0, 0
+    src_file['video_probe'] = probe.to_dict()
+    src_file['width'], src_file['height'] = probe.display_size
+    if probe.duration:
+        src_file['duration'] = int(probe.duration)
+    return probe
 
 
 def _video_cap_at_1080(width: int, height: int) -> typing.Tuple[int, int]:
@@ -282,10 +244,12 @@ def _process_video(gcs,
     # by determining the video size here we already have this information in the file
     # document before Zencoder calls our notification URL. It also opens up possibilities
     # for other encoding backends that don't support this functionality.
+    # The probe result is stored in the file document, so it is only done once per file.
     video_path = pathlib.Path(local_file.name)
-    video_width, video_height = _video_size_pixels(video_path)
+    probe = _video_probe(video_path, src_file)
+    video_width, video_height = probe.display_size if probe else (0, 0)
     capped_video_width, capped_video_height = _video_cap_at_1080(video_width, video_height)
-    video_duration = _video_duration_seconds(video_path)
+    video_duration = int(probe.duration) if probe and probe.duration else None
 
     # Create variations
     root, _ = os.path.splitext(src_file['file_path'])
@@ -309,20 +273,27 @@ def _process_video(gcs,
     # that's why we build a list.
     src_file['variations'].append(file_variation)
 
+    processing = src_file.get('processing') or {}
+    if processing.get('job_id') and processing.get('status') == 'pending':
+        # This happens when processing is retried after the job was created.
+        log.info('Encoder job %s already exists for file %s, not creating another',
+                 processing['job_id'], file_id)
+        return
+
     if current_app.config['TESTING']:
         log.warning('_process_video: NOT sending out encoding job due to '
                     'TESTING=%r', current_app.config['TESTING'])
         j = {'process_id': 'fake-process-id',
              'backend': 'fake'}
     else:
-        j = Encoder.job_create(src_file)
+        j = Encoder.job_create(src_file, file_id=file_id)
         if j is None:
             log.warning('_process_video: unable to create encoder job for file '
                         '%s.', file_id)
             return
 
-    log.info('Created asynchronous Zencoder job %s for file %s',
-             j['process_id'], file_id)
+    log.info('Created asynchronous %s encoding job %s for file %s',
+             j['backend'], j['process_id'], file_id)
 
     # Add the processing status to the file object
     src_file['processing'] = {
@@ -333,12 +304,18 @@ def _process_video(gcs,
 
 def process_file(bucket: Bucket,
                  file_id: typing.Union[str, ObjectId],
-                 local_file: tempfile._TemporaryFileWrapper):
+                 local_file: tempfile._TemporaryFileWrapper,
+                 *,
+                 may_encode_video: typing.Optional[bool] = None):
     """Process the file by creating thumbnails, sending to Zencoder, etc.
 
     :param file_id: '_id' key of the file
     :param local_file: locally stored file, or None if no local processing is
     needed.
+    :param may_encode_video: whether videos should be encoded; when None, this
+        is determined by the capabilities of the current user.
+    :raises Exception: when processing fails; the file status is then reset to
+        "queued_for_processing".
     """
 
     file_id = ObjectId(file_id)
@@ -356,7 +333,9 @@ def process_file(bucket: Bucket,
     mime_category, src_file['format'] = src_file['content_type'].split('/', 1)
 
     # Only allow video encoding when the user has the correct capability.
-    if not current_user.has_cap('encode-video') and mime_category == 'video':
+    if may_encode_video is None:
+        may_encode_video = current_user.has_cap('encode-video')
+    if not may_encode_video and mime_category == 'video':
         if src_file['format'].startswith('x-'):
             xified = src_file['format']
         else:
@@ -392,7 +371,7 @@ def process_file(bucket: Bucket,
                         'resetting status to '
                         '"queued_for_processing"', file_id, exc_info=True)
             update_file_doc(file_id, status='queued_for_processing')
-            return
+            raise
 
     # Update the original file with additional info, e.g. image resolution
     r, _, _, status = current_app.put_internal('files', src_file, _id=file_id)
@@ -402,6 +381,81 @@ def process_file(bucket: Bucket,
                     file_id, status, r)
 
 
+def process_stored_file(file_id: ObjectId,
+                        spool_path: typing.Optional[pathlib.Path],
+                        *,
+                        may_encode_video: bool):
+    """Process a file that was uploaded to storage before.
+
+    This is what the Celery task queued by upload_and_process() performs.
+    Files that were processed already are skipped, so that this is safe to
+    retry.
+
+    :param spool_path: local copy of the uploaded file. When None or when it
+        does not exist, the file is downloaded from storage if processing
+        needs it.
+    """
+
+    files_coll = current_app.db('files')
+    file_doc = files_coll.find_one(
+        {'_id': file_id},
+        projection={'status': 1, 'backend': 1, 'project': 1, 'file_path': 1,
+                    'content_type': 1})
+    if not file_doc:
+        log.warning('process_stored_file(%s): no such file document found, ignoring.', file_id)
+        return
+    if file_doc.get('status') == 'complete':
+        log.info('process_stored_file(%s): file was processed already, ignoring.', file_id)
+        return
+
+    bucket = Bucket.for_backend(file_doc['backend'])(str(file_doc['project']))
+
+    mime_category = file_doc['content_type'].split('/', 1)[0]
+    if mime_category == 'image' or (mime_category == 'video' and may_encode_video):
+        if spool_path is not None and spool_path.exists():
+            local_file = spool_path.open('rb')
+        else:
+            log.debug('process_stored_file(%s): fetching %s from %s',
+                      file_id, file_doc['file_path'], bucket)
+            local_file = blob_cache.open_blob(bucket.blob(file_doc['file_path']))
+    else:
+        local_file = None
+
+    try:
+        process_file(bucket, file_id, local_file, may_encode_video=may_encode_video)
+    finally:
+        if local_file is not None:
+            local_file.close()
+
+
+def _spool_for_processing(file_id: ObjectId,
+                          local_file: typing.Union[io.BytesIO, typing.BinaryIO]) \
+        -> typing.Optional[pathlib.Path]:
+    """Keep the uploaded file around for processing, without copying it.
+
+    :returns: the path of the spooled file, or None if the file could not be
+        spooled and processing has to download it from storage.
+    """
+
+    if not current_app.config['FILE_PROCESSING_SPOOL']:
+        return None
+
+    local_path = getattr(local_file, 'name', None)
+    if not isinstance(local_path, str) or not os.path.isfile(local_path):
+        return None
+
+    spool_dir = pathlib.Path(current_app.config['STORAGE_DIR']) / 'processing'
+    spool_path = spool_dir / str(file_id)
+    try:
+        spool_dir.mkdir(parents=True, exist_ok=True)
+        os.link(local_path, str(spool_path))
+    except OSError:
+        log.warning('Unable to spool %s to %s for processing, it will be downloaded '
+                    'from storage instead', local_path, spool_path, exc_info=True)
+        return None
+    return spool_path
+
+
 def generate_link(backend, file_path: str, project_id: str=None, is_public=False) -> str:
     """Hook to check the backend of a file resource, to build an appropriate link
     that can be used by the client to retrieve the actual file.
@@ -470,6 +524,54 @@ def before_returning_files(response):
         ensure_valid_link(item)
 
 
+def links_are_deterministic(backend: str) -> bool:
+    """Returns whether links of this backend can be generated without side-effects.
+
+    Such links only depend on the file path and the configuration, and can
+    be generated without talking to the storage backend.
+    """
+
+    if backend in DETERMINISTIC_LINK_BACKENDS:
+        return True
+    try:
+        return Bucket.for_backend(backend).links_are_deterministic
+    except KeyError:
+        return False
+
+
+def links_generated_on_read() -> typing.List[str]:
+    """Returns the backends whose links are generated when files are read.
+
+    Links of these backends are not stored in MongoDB, see ensure_valid_link().
+    """
+
+    if not current_app.config['FILE_LINKS_ON_READ']:
+        return []
+
+    backends = DETERMINISTIC_LINK_BACKENDS | Bucket.backends.keys()
+    return sorted(backend for backend in backends if links_are_deterministic(backend))
+
+
+def generate_links_on_read(response: dict) -> None:
+    """Sets the links of the file and its variations, without saving them."""
+
+    from . import link_cache
+
+    if 'file_path' not in response:
+        return
+
+    project_id = str(response['project']) if 'project' in response else None
+    backend = response['backend']
+
+    response['link'], link_expires = link_cache.get_link(
+        backend, response['file_path'], project_id)
+    for variation in response.get('variations') or ():
+        variation['link'], var_expires = link_cache.get_link(
+            backend, variation['file_path'], project_id)
+        link_expires = min(link_expires, var_expires)
+    response['link_expires'] = link_expires
+
+
 def ensure_valid_link(response: dict) -> None:
     """Ensures the file item has valid file links using generate_link(...)."""
 
@@ -477,6 +579,10 @@ def ensure_valid_link(response: dict) -> None:
     log_link = logging.getLogger('%s.ensure_valid_link' % __name__)
     # log.debug('Inspecting link for file %s', response['_id'])
 
+    if response.get('backend') in links_generated_on_read():
+        generate_links_on_read(response)
+        return
+
     # Check link expiry.
     now = utils.utcnow()
     if 'link_expires' in response:
@@ -503,51 +609,119 @@ def generate_all_links(response: dict, now: datetime.datetime) -> None:
     """
     assert isinstance(response, dict), f'response must be dict, is {response!r}'
 
-    project_id = str(
-        response['project']) if 'project' in response else None
+    refresh_links([response], now)
+
+
+class LinkRefreshStats(typing.NamedTuple):
+    refreshed: int
+    failed: int
+    duration_secs: float
+
+    @property
+    def files_per_second(self) -> float:
+        if self.duration_secs <= 0:
+            return 0.0
+        return (self.refreshed + self.failed) / self.duration_secs
+
+
+def _new_links(file_doc: dict, now: datetime.datetime) -> dict:
+    """Generates new links for the file and its variations.
+
+    :returns: the properties of the file document to update.
+    """
+
+    project_id = str(file_doc['project']) if 'project' in file_doc else None
     # TODO: add project id to all files
-    backend = response['backend']
+    backend = file_doc['backend']
 
-    if 'file_path' in response:
-        response['link'] = generate_link(backend, response['file_path'], project_id)
-    else:
-        import pprint
-        log.error('File without file_path properly, unable to generate links: %s',
-                  pprint.pformat(response))
-        return
+    updates = {'link': generate_link(backend, file_doc['file_path'], project_id)}
 
-    variations = response.get('variations')
+    variations = file_doc.get('variations')
     if variations:
-        for variation in variations:
-            variation['link'] = generate_link(backend, variation['file_path'],
-                                              project_id)
+        updates['variations'] = [
+            {**variation, 'link': generate_link(backend, variation['file_path'], project_id)}
+            for variation in variations
+        ]
 
     # Construct the new expiry datetime.
     validity_secs = current_app.config['FILE_LINK_VALIDITY'][backend]
-    response['link_expires'] = now + datetime.timedelta(seconds=validity_secs)
-
-    patch_info = remove_private_keys(response)
-
-    # The project could have been soft-deleted, in which case it's fine to
-    # update the links to the file. However, Eve/Cerberus doesn't allow this;
-    # removing the 'project' key from the PATCH works around this.
-    patch_info.pop('project', None)
-
-    file_id = ObjectId(response['_id'])
-    (patch_resp, _, _, _) = current_app.patch_internal('files', patch_info,
-                                                       _id=file_id)
-    if patch_resp.get('_status') == 'ERR':
-        log.warning('Unable to save new links for file %s: %r',
-                    response['_id'], patch_resp)
-        # TODO: raise a snag.
-        response['_updated'] = now
-    else:
-        response['_updated'] = patch_resp['_updated']
+    updates['link_expires'] = now + datetime.timedelta(seconds=validity_secs)
 
-    # Be silly and re-fetch the etag ourselves. TODO: handle this better.
-    etag_doc = current_app.data.driver.db['files'].find_one({'_id': file_id},
-                                                            {'_etag': 1})
-    response['_etag'] = etag_doc['_etag']
+    return updates
+
+
+def refresh_links(file_docs: typing.Sequence[dict], now: datetime.datetime) \
+        -> LinkRefreshStats:
+    """Generates new links for the files and saves them in one bulk write.
+
+    The file documents are updated in place, including their _etag and
+    _updated. Only the link properties are written to MongoDB, without going
+    through Eve, so this also works for files of soft-deleted projects.
+
+    Outside of a request, links are generated by LINK_REFRESH_THREADS threads
+    concurrently, as signing a URL may involve a round-trip to the storage
+    backend. Files for which no links could be generated are logged and
+    skipped.
+    """
+    import flask
+
+    start_time = time.monotonic()
+
+    to_refresh = []
+    for file_doc in file_docs:
+        if 'file_path' not in file_doc:
+            import pprint
+            log.error('File without file_path properly, unable to generate links: %s',
+                      pprint.pformat(file_doc))
+            continue
+        to_refresh.append(file_doc)
+
+    def attempt(file_doc: dict) -> typing.Optional[dict]:
+        try:
+            return _new_links(file_doc, now)
+        except Exception as ex:
+            log.warning('Unable to generate links for file %s: %s', file_doc['_id'], ex)
+            return None
+
+    if len(to_refresh) > 1 and not flask.has_request_context():
+        app = current_app.real_app
+
+        def attempt_in_app_context(file_doc: dict) -> typing.Optional[dict]:
+            with app.app_context():
+                return attempt(file_doc)
+
+        thread_count = min(LINK_REFRESH_THREADS, len(to_refresh))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor:
+            all_updates = list(executor.map(attempt_in_app_context, to_refresh))
+    else:
+        all_updates = [attempt(file_doc) for file_doc in to_refresh]
+
+    bulk_ops = []
+    for file_doc, updates in zip(to_refresh, all_updates):
+        if updates is None:
+            continue
+        updates['_updated'] = now
+        updates['_etag'] = utils.random_etag()
+        file_doc.update(updates)
+        bulk_ops.append(pymongo.UpdateOne({'_id': ObjectId(file_doc['_id'])},
+                                          {'$set': updates}))
+
+    if bulk_ops:
+        files_coll = current_app.db('files')
+        files_coll.bulk_write(bulk_ops, ordered=False)
+
+    return LinkRefreshStats(refreshed=len(bulk_ops),
+                            failed=len(to_refresh) - len(bulk_ops),
+                            duration_secs=time.monotonic() - start_time)
+
+
+def _batched(iterable: typing.Iterable, batch_size: int) -> typing.Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
 
 
 def on_pre_get_files(_, lookup):
@@ -566,12 +740,16 @@ def on_pre_get_files(_, lookup):
     lookup_expired = lookup.copy()
     lookup_expired['link_expires'] = {'$lte': now}
 
+    # These links are generated when the file is returned, without saving.
+    on_read = links_generated_on_read()
+    if on_read:
+        lookup_expired = {'$and': [lookup_expired, {'backend': {'$nin': on_read}}]}
+
     cursor, _ = current_app.data.find('files', parsed_req, lookup_expired, perform_count=False)
-    for idx, file_doc in enumerate(cursor):
-        if idx == 0:
-            log.debug('Updating expired links for files that matched lookup %s', lookup_expired)
-        # log.debug('Updating expired links for file %r.', file_doc['_id'])
-        generate_all_links(file_doc, now)
+    for batch in _batched(cursor, LINK_REFRESH_BATCH_SIZE):
+        log.debug('Updating expired links for %d files that matched lookup %s',
+                  len(batch), lookup_expired)
+        refresh_links(batch, now)
 
 
 def refresh_links_for_project(project_uuid, chunk_size, expiry_seconds):
@@ -594,18 +772,14 @@ def refresh_links_for_project(project_uuid, chunk_size, expiry_seconds):
          }).sort([('link_expires', pymongo.ASCENDING)]).limit(chunk_size)
 
     refresh_count = 0
-    for file_doc in to_refresh:
-        log.debug('Refreshing links for file %s', file_doc['_id'])
-        generate_all_links(file_doc, now)
-        refresh_count += 1
+    for batch in _batched(to_refresh, LINK_REFRESH_BATCH_SIZE):
+        refresh_count += refresh_links(batch, now).refreshed
 
     if refresh_count:
         log.info('Refreshed %i links', refresh_count)
 
 
 def refresh_links_for_backend(backend_name, chunk_size, expiry_seconds):
-    import gcloud.exceptions
-
     my_log = log.getChild(f'refresh_links_for_backend.{backend_name}')
     start_time = time.time()
 
@@ -617,7 +791,20 @@ def refresh_links_for_backend(backend_name, chunk_size, expiry_seconds):
     expire_before = now + datetime.timedelta(seconds=expiry_seconds)
     my_log.info('Limiting to links that expire before %s', expire_before)
 
-    base_query = {'backend': backend_name, '_deleted': {'$ne': True}}
+    # Load the projects once, instead of checking the project of every file.
+    live_projects = set()
+    deleted_projects = []
+    for proj in proj_coll.find({}, projection={'_deleted': 1}):
+        if proj.get('_deleted'):
+            deleted_projects.append(proj['_id'])
+        else:
+            live_projects.add(proj['_id'])
+
+    # Skipping files of deleted projects in the query itself prevents them
+    # from taking up the chunk on every run.
+    base_query = {'backend': backend_name,
+                  '_deleted': {'$ne': True},
+                  'project': {'$nin': deleted_projects}}
     to_refresh_query = {
         '$or': [{'link_expires': None, **base_query},
                 {'link_expires': {'$lt': expire_before}, **base_query},
@@ -638,54 +825,44 @@ def refresh_links_for_backend(backend_name, chunk_size, expiry_seconds):
     to_refresh = files_collection.find(to_refresh_query)\
             .sort([('link_expires', pymongo.ASCENDING)])\
             .limit(chunk_size)\
-            .batch_size(5)
+            .batch_size(LINK_REFRESH_BATCH_SIZE)
+
+    def refreshable(file_doc: dict) -> bool:
+        file_id = file_doc['_id']
+        project_id = file_doc.get('project')
+        if project_id is None:
+            my_log.debug('Skipping file %s, it has no project.', file_id)
+            return False
+
+        if project_id not in live_projects:
+            my_log.debug('Skipping file %s, project %s does not exist.',
+                         file_id, project_id)
+            return False
+
+        if 'file_path' not in file_doc:
+            my_log.warning("Skipping file %s, missing 'file_path' property.",
+                           file_id)
+            return False
+        return True
 
     refreshed = 0
-    report_chunks = min(max(5, document_count // 25), 100)
-    for file_doc in to_refresh:
-        try:
-            file_id = file_doc['_id']
-            project_id = file_doc.get('project')
-            if project_id is None:
-                my_log.debug('Skipping file %s, it has no project.', file_id)
-                continue
-
-            count = proj_coll.count_documents({'_id': project_id, '$or': [
-                {'_deleted': {'$exists': False}},
-                {'_deleted': False},
-            ]})
-
-            if count == 0:
-                my_log.debug('Skipping file %s, project %s does not exist.',
-                             file_id, project_id)
-                continue
-
-            if 'file_path' not in file_doc:
-                my_log.warning("Skipping file %s, missing 'file_path' property.",
-                               file_id)
-                continue
-
-            my_log.debug('Refreshing links for file %s', file_id)
-
-            try:
-                generate_all_links(file_doc, now)
-            except gcloud.exceptions.Forbidden:
-                my_log.warning('Skipping file %s, GCS forbids us access to '
-                               'project %s bucket.', file_id, project_id)
-                continue
-            refreshed += 1
-
-            if refreshed % report_chunks == 0:
-                my_log.info('Refreshed %i links', refreshed)
-        except KeyboardInterrupt:
-            my_log.warning('Aborting due to KeyboardInterrupt after refreshing %i '
-                           'links', refreshed)
-            return
+    failed = 0
+    try:
+        for batch in _batched(filter(refreshable, to_refresh), LINK_REFRESH_BATCH_SIZE):
+            stats = refresh_links(batch, now)
+            refreshed += stats.refreshed
+            failed += stats.failed
+            my_log.info('Refreshed %i links, %.1f files/sec in the last batch',
+                        refreshed, stats.files_per_second)
+    except KeyboardInterrupt:
+        my_log.warning('Aborting due to KeyboardInterrupt after refreshing %i '
+                       'links', refreshed)
+        return
 
-    if refreshed % report_chunks != 0:
-        my_log.info('Refreshed %i links', refreshed)
+    duration = time.time() - start_time
+    my_log.info('Refreshed %i links, skipped %i failures, in %.1f seconds (%.1f files/sec)',
+                refreshed, failed, duration, (refreshed + failed) / duration if duration else 0)
 
-    my_log.info('Refresh took %s', datetime.timedelta(seconds=time.time() - start_time))
 
 @require_login()
 def create_file_doc(name, filename, content_type, length, project,
@@ -809,8 +986,7 @@ def stream_to_storage(project_id: str):
                     project_oid)
         raise wz_exceptions.BadRequest('Missing content type.')
 
-    if uploaded_file.content_type.startswith('image/') or uploaded_file.content_type.startswith(
-            'video/'):
+    if _needs_local_copy(uploaded_file.content_type):
         # We need to do local thumbnailing and ffprobe, so we have to write the stream
         # both to Google Cloud Storage and to local storage.
         local_file = tempfile.NamedTemporaryFile(
@@ -822,7 +998,7 @@ def stream_to_storage(project_id: str):
 
     result = upload_and_process(local_file, uploaded_file, project_id)
 
-    # Local processing is done, we can close the local file so it is removed.
+    # Processing uses its own copy, so we can close the local file so it is removed.
     local_file.close()
 
     resp = jsonify(result)
@@ -831,6 +1007,96 @@ def stream_to_storage(project_id: str):
     return resp
 
 
+@file_storage.route('/stream/<string:project_id>/raw', methods=['PUT', 'OPTIONS'])
+@require_login()
+def stream_raw_to_storage(project_id: str):
+    """Streams the request body to storage, without parsing it as a form.
+
+    The body is sent to the storage backend while it is being received, and
+    is only written to local disk when processing needs a local copy. The
+    filename is passed in the 'filename' query parameter and the content type
+    in the Content-Type header. A Content-Length header is required.
+    """
+    from .hashing import HashingReader
+
+    project_oid = utils.str2id(project_id)
+    projects = current_app.data.driver.db['projects']
+    if not projects.count_documents({'_id': project_oid}):
+        raise wz_exceptions.NotFound('Project %s does not exist' % project_id)
+
+    filename = request.args.get('filename', '').strip()
+    if not filename:
+        raise wz_exceptions.BadRequest('Missing filename.')
+
+    file_size = request.content_length
+    if not file_size:
+        raise wz_exceptions.LengthRequired()
+    assert_file_size_allowed(file_size)
+
+    uploaded_file = werkzeug.datastructures.FileStorage(
+        filename=filename,
+        content_type=request.headers.get('Content-Type', ''),
+        content_length=file_size)
+    override_content_type(uploaded_file)
+    if not uploaded_file.content_type:
+        log.warning('File uploaded to project %s without content type.', project_oid)
+        raise wz_exceptions.BadRequest('Missing content type.')
+
+    log.info('Streaming %d bytes to bucket for project=%s user_id=%s', file_size, project_id,
+             current_user.user_id)
+
+    file_id, internal_fname, status = create_file_doc_for_upload(project_id, uploaded_file)
+    blob = default_storage_backend(project_id).blob(internal_fname)
+
+    local_file = None
+    if _needs_local_copy(uploaded_file.mimetype):
+        local_file = tempfile.NamedTemporaryFile(dir=current_app.config['STORAGE_DIR'])
+
+    try:
+        reader = HashingReader(request.stream, tee=local_file)
+        try:
+            blob.create_from_file(reader,
+                                  file_size=file_size,
+                                  content_type=uploaded_file.mimetype)
+        except Exception:
+            log.exception('Error streaming file %s to storage', file_id)
+            update_file_doc(file_id, status='failed')
+            raise wz_exceptions.InternalServerError('Unable to stream file to storage')
+
+        if reader.bytes_read != file_size:
+            log.warning('Upload of file %s was cut short, received %d of %d bytes',
+                        file_id, reader.bytes_read, file_size)
+            update_file_doc(file_id, status='failed')
+            blob.delete()
+            raise wz_exceptions.BadRequest(
+                f'Received {reader.bytes_read} of {file_size} bytes')
+
+        spool_path = None
+        if local_file is not None:
+            local_file.flush()
+            spool_path = _spool_for_processing(file_id, local_file)
+
+        mark_uploaded(file_id, blob, uploaded_file.mimetype,
+                      may_process_file=True, spool_path=spool_path,
+                      md5=reader.md5, sha256=reader.sha256)
+    finally:
+        # Processing uses its own hard link, so we can close the local file so it is removed.
+        if local_file is not None:
+            local_file.close()
+
+    resp = jsonify(dict(status='ok', file_id=str(file_id), status_code=status))
+    resp.status_code = status
+    add_access_control_headers(resp)
+    return resp
+
+
+def _needs_local_copy(content_type: str) -> bool:
+    """Returns whether processing an uploaded file requires a local copy."""
+
+    mime_category = content_type.split('/', 1)[0]
+    return mime_category in {'image', 'video'}
+
+
 def upload_and_process(local_file: typing.Union[io.BytesIO, typing.BinaryIO],
                        uploaded_file: werkzeug.datastructures.FileStorage,
                        project_id: str,
@@ -851,26 +1117,20 @@ def upload_and_process(local_file: typing.Union[io.BytesIO, typing.BinaryIO],
     # Create file document in MongoDB.
     file_id, internal_fname, status = create_file_doc_for_upload(project_id, uploaded_file)
 
-    # Copy the file into storage.
+    # Copy the file into storage, computing its checksums on the way.
+    from .hashing import HashingReader
+
     bucket = default_storage_backend(project_id)
     blob = bucket.blob(internal_fname)
-    blob.create_from_file(local_file,
+    reader = HashingReader(local_file)
+    blob.create_from_file(reader,
                           file_size=file_size,
                           content_type=uploaded_file.mimetype)
 
-    log.debug('Marking uploaded file id=%s, fname=%s, '
-              'size=%i as "queued_for_processing"',
-              file_id, internal_fname, file_size)
-    update_file_doc(file_id,
-                    status='queued_for_processing' if may_process_file else 'complete',
-                    file_path=internal_fname,
-                    length=blob.size,
-                    content_type=uploaded_file.mimetype)
-
-    if may_process_file:
-        log.debug('Processing uploaded file id=%s, fname=%s, size=%i', file_id,
-                  internal_fname, blob.size)
-        process_file(bucket, file_id, local_file)
+    spool_path = _spool_for_processing(file_id, local_file) if may_process_file else None
+    mark_uploaded(file_id, blob, uploaded_file.mimetype,
+                  may_process_file=may_process_file, spool_path=spool_path,
+                  md5=reader.md5, sha256=reader.sha256)
 
     log.debug('Handled uploaded file id=%s, fname=%s, size=%i, status=%i',
               file_id, internal_fname, blob.size, status)
@@ -881,6 +1141,55 @@ def upload_and_process(local_file: typing.Union[io.BytesIO, typing.BinaryIO],
     return dict(status='ok', file_id=str(file_id), status_code=status)
 
 
+def mark_uploaded(file_id: ObjectId, blob: Blob, content_type: str,
+                  *,
+                  may_process_file: bool,
+                  spool_path: typing.Optional[pathlib.Path] = None,
+                  md5: str = '',
+                  sha256: str = ''):
+    """Updates the file document for the stored blob, and queues processing.
+
+    :param spool_path: local copy of the file for processing, see
+        process_stored_file().
+    :param md5: hex digest of the file contents, if known.
+    :param sha256: hex digest of the file contents, if known.
+    """
+
+    log.debug('Marking uploaded file id=%s, fname=%s, size=%i as %s',
+              file_id, blob.name, blob.size,
+              'queued_for_processing' if may_process_file else 'complete')
+    checksums = {}
+    if md5:
+        checksums['md5'] = md5
+    if sha256:
+        checksums['sha256'] = sha256
+    update_file_doc(file_id,
+                    status='queued_for_processing' if may_process_file else 'complete',
+                    file_path=blob.name,
+                    length=blob.size,
+                    content_type=content_type,
+                    **checksums)
+
+    if sha256 and dedup.is_enabled():
+        existing = dedup.find_duplicate(file_id, sha256)
+        if existing:
+            dedup.link_to_duplicate(file_id, blob, existing)
+            if spool_path is not None:
+                spool_path.unlink()
+            return
+
+    if not may_process_file:
+        return
+
+    from pillar.celery import file_processing
+
+    log.debug('Queueing uploaded file id=%s, fname=%s, size=%i for processing', file_id,
+              blob.name, blob.size)
+    file_processing.process_uploaded_file.delay(
+        str(file_id), str(spool_path) if spool_path else '',
+        current_user.has_cap('encode-video'))
+
+
 from ..file_storage_backends.abstract import FileType
 
 
@@ -1038,3 +1347,6 @@ def setup_app(app, url_prefix):
     app.on_insert_files += compute_aggregate_length_items
 
     app.register_api_blueprint(file_storage, url_prefix=url_prefix)
+
+    from . import resumable
+    resumable.setup_app(app, url_prefix=f'{url_prefix}/resumable')
@@ -0,0 +1,155 @@
+"""Content-addressed deduplication of uploaded files.
+
+When DEDUPLICATE_UPLOADS is enabled, an upload whose SHA-256 checksum matches
+an already processed file in the same project (and thus the same bucket)
+doesn't get stored and processed again. Instead, its file document refers to
+the blob and variations of the existing file.
+
+Blobs can thus be shared between file documents. The number of references is
+not stored, but counted from the file documents themselves, so it cannot get
+out of sync. Use delete_file_blobs() to delete the blobs of a file, and
+is_blob_shared() before renaming or otherwise changing a blob in place.
+"""
+
+import logging
+import typing
+
+from bson import ObjectId
+from flask import current_app
+
+from pillar.api.file_storage_backends import Bucket, blob_cache
+from pillar.api.file_storage_backends.abstract import Blob
+
+log = logging.getLogger(__name__)
+
+# Properties copied from the existing file document to the duplicate.
+SHARED_PROPERTIES = ('file_path', 'length', 'md5', 'variations', 'width', 'height',
+                     'duration', 'length_aggregate_in_bytes', 'link', 'link_expires')
+
+
+def is_enabled() -> bool:
+    return bool(current_app.config.get('DEDUPLICATE_UPLOADS', False))
+
+
+def find_duplicate(file_id: ObjectId, sha256: str) -> typing.Optional[dict]:
+    """Returns an existing, processed file with the same contents as this file.
+
+    Only files in the same project, stored with the same backend and with the
+    same content type are considered.
+    """
+
+    files_coll = current_app.db('files')
+    file_doc = files_coll.find_one(file_id, projection={
+        'project': 1, 'backend': 1, 'content_type': 1})
+    if not file_doc:
+        return None
+
+    return files_coll.find_one({
+        '_id': {'$ne': file_id},
+        'project': file_doc['project'],
+        'backend': file_doc['backend'],
+        'content_type': file_doc['content_type'],
+        'sha256': sha256,
+        'status': 'complete',
+        '_deleted': {'$ne': True},
+    })
+
+
+def link_to_duplicate(file_id: ObjectId, uploaded_blob: Blob, existing: dict):
+    """Makes the file document refer to the blobs of the existing file.
+
+    The uploaded blob is deleted, as it is no longer needed.
+    """
+
+    log.info('File %s is a duplicate of file %s, sharing its blob %s',
+             file_id, existing['_id'], existing['file_path'])
+
+    updates = {key: existing[key] for key in SHARED_PROPERTIES if key in existing}
+    updates['status'] = 'complete'
+
+    files_coll = current_app.db('files')
+    files_coll.update_one({'_id': file_id}, {'$set': updates})
+
+    # The uploaded blob has a freshly generated name, so nothing else refers to it.
+    uploaded_blob.delete()
+
+
+def _references_query(file_doc: dict, file_path: typing.Optional[str]) -> dict:
+    """Returns the query for non-deleted file documents referring to a blob of this file.
+
+    :param file_path: path of the blob, which can also be the path of a
+        variation. Defaults to the file's own blob.
+    """
+
+    return {
+        'project': file_doc['project'],
+        'backend': file_doc['backend'],
+        '$or': [{'file_path': file_path or file_doc['file_path']},
+                {'variations.file_path': file_path or file_doc['file_path']}],
+        '_deleted': {'$ne': True},
+    }
+
+
+def blob_ref_count(file_doc: dict, file_path: typing.Optional[str] = None) -> int:
+    """Returns the number of non-deleted file documents referring to a blob of this file.
+
+    :param file_path: path of the blob, which can also be the path of a
+        variation. Defaults to the file's own blob.
+    """
+
+    files_coll = current_app.db('files')
+    return files_coll.count_documents(_references_query(file_doc, file_path))
+
+
+def is_blob_shared(file_doc: dict, file_path: typing.Optional[str] = None) -> bool:
+    """Returns whether other non-deleted file documents refer to a blob of this file.
+
+    :param file_path: path of the blob, which can also be the path of a
+        variation. Defaults to the file's own blob.
+    """
+
+    query = _references_query(file_doc, file_path)
+    query['_id'] = {'$ne': file_doc['_id']}
+
+    files_coll = current_app.db('files')
+    return files_coll.count_documents(query, limit=1) > 0
+
+
+def delete_file_blobs(file_doc: dict) -> bool:
+    """Deletes the blob and variations of the file, unless they are shared.
+
+    Call this after the file document itself has been (soft-)deleted, so that
+    it no longer counts as reference.
+
+    :returns: whether the blobs were deleted.
+    """
+
+    ref_count = blob_ref_count(file_doc)
+    if ref_count:
+        log.info('Not deleting blob %s of file %s, it is still used by %d files',
+                 file_doc['file_path'], file_doc['_id'], ref_count)
+        return False
+
+    bucket = Bucket.for_backend(file_doc['backend'])(str(file_doc['project']))
+    paths = [file_doc['file_path']]
+    paths.extend(var['file_path'] for var in file_doc.get('variations') or ())
+    log.info('Deleting %d blobs of file %s', len(paths), file_doc['_id'])
+    for path in paths:
+        bucket.blob(path).delete()
+    return True
+
+
+def compute_checksums(file_doc: dict) -> typing.Tuple[str, str]:
+    """Fetches the file from storage, and returns its MD5 and SHA-256 hex digests."""
+
+    from .hashing import HashingReader
+
+    bucket = Bucket.for_backend(file_doc['backend'])(str(file_doc['project']))
+    blob = bucket.blob(file_doc['file_path'])
+
+    with blob_cache.open_blob(blob) as local_file:
+        reader = HashingReader(local_file)
+        while reader.read(1024 * 1024):
+            pass
+
+    return reader.md5, reader.sha256
@@ -0,0 +1,117 @@
+"""Hashing of files while they are streamed to storage."""
+
+import hashlib
+import io
+import os
+import typing
+
+from pillar.api.file_storage_backends.abstract import FileType
+
+# Number of most recently read bytes that HashingReader keeps in memory, so
+# that it can seek back to them. GCS resumable uploads seek back to resend
+# (part of) the last chunk after errors, and send chunks of 512 KiB.
+SEEK_WINDOW = 4 * 1024 * 1024
+
+
+class HashingReader:
+    """Read-only file-like object that hashes everything read through it.
+
+    The MD5 and SHA-256 digests and the number of bytes are computed
+    incrementally, so that a stream can be hashed while it is being sent to
+    storage, without keeping it in memory. Everything read can also be
+    written to a second file, for when a local copy is needed for processing.
+
+    The last `seek_window` bytes are kept in memory, so that an upload can
+    seek back to retry sending them. Seeking anywhere else is not supported,
+    and seekable() returns False.
+    """
+
+    def __init__(self, stream: FileType, *,
+                 tee: typing.Optional[typing.BinaryIO] = None,
+                 seek_window: int = SEEK_WINDOW):
+        self._stream = stream
+        self._tee = tee
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+        self.bytes_read = 0  # Number of bytes read from the wrapped stream.
+
+        self._seek_window = seek_window
+        self._window = bytearray()  # The last bytes read from the wrapped stream.
+        self._position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        replayed = self._replay(size)
+        if replayed and size >= 0:
+            size -= len(replayed)
+            if not size:
+                return replayed
+
+        data = self._stream.read(size)
+        if data:
+            self._md5.update(data)
+            self._sha256.update(data)
+            self.bytes_read += len(data)
+            self._position = self.bytes_read
+            self._remember(data)
+            if self._tee is not None:
+                self._tee.write(data)
+        return replayed + data if replayed else data
+
+    def _replay(self, size: int) -> bytes:
+        """Returns previously read bytes, after seeking back."""
+
+        if self._position == self.bytes_read:
+            return b''
+
+        offset = len(self._window) - (self.bytes_read - self._position)
+        end = len(self._window) if size < 0 else min(offset + size, len(self._window))
+        data = bytes(self._window[offset:end])
+        self._position += len(data)
+        return data
+
+    def _remember(self, data: bytes):
+        if len(data) >= self._seek_window:
+            self._window = bytearray(data[len(data) - self._seek_window:])
+            return
+        self._window += data
+        excess = len(self._window) - self._seek_window
+        if excess > 0:
+            del self._window[:excess]
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence != os.SEEK_SET:
+            raise io.UnsupportedOperation('HashingReader can only seek back a little')
+
+        if not self.bytes_read - len(self._window) <= offset <= self.bytes_read:
+            raise io.UnsupportedOperation(
+                f'Unable to seek to {offset}, only {self.bytes_read - len(self._window)}-'
+                f'{self.bytes_read} is available')
+        self._position = offset
+        return offset
+
+    def seekable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self._position
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        # The caller owns the wrapped streams, and is responsible for closing them.
+        pass
+
+    @property
+    def closed(self) -> bool:
+        return False
+
+    @property
+    def md5(self) -> str:
+        return self._md5.hexdigest()
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
@@ -0,0 +1,67 @@
+"""In-process cache of file links that are generated when files are read.
+
+For backends whose links can be computed without talking to the storage
+backend, links are not stored in MongoDB but generated every time a file
+document is returned; see ensure_valid_link(). This module memoises those
+links in a per-process LRU cache. A cached link is used until half its
+validity has passed, so that the link handed out is never close to expiry.
+"""
+
+import collections
+import datetime
+import threading
+import typing
+
+from flask import current_app
+
+from pillar.api.utils import utcnow
+
+CacheKey = typing.Tuple[str, str, str]  # (backend, project ID, file path)
+CacheEntry = typing.NamedTuple('CacheEntry', [
+    ('link', str),
+    ('link_expires', datetime.datetime),
+    ('refresh_after', datetime.datetime),
+])
+
+_cache: typing.MutableMapping[CacheKey, CacheEntry] = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_link(backend: str, file_path: str, project_id: typing.Optional[str]) \
+        -> typing.Tuple[str, datetime.datetime]:
+    """Returns the link to the file and its expiry, from the cache if possible."""
+
+    from pillar.api.file_storage import generate_link
+
+    key = (backend, project_id or '', file_path)
+    now = utcnow()
+
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and now < entry.refresh_after:
+            _cache.move_to_end(key)
+            return entry.link, entry.link_expires
+
+    link = generate_link(backend, file_path, project_id)
+    validity = datetime.timedelta(seconds=current_app.config['FILE_LINK_VALIDITY'][backend])
+    link_expires = now + validity
+    if not link:
+        # Don't cache links to missing blobs, they may appear later.
+        return link, link_expires
+
+    entry = CacheEntry(link=link, link_expires=link_expires, refresh_after=now + validity / 2)
+    max_size = current_app.config['FILE_LINK_CACHE_SIZE']
+    with _cache_lock:
+        _cache[key] = entry
+        _cache.move_to_end(key)
+        while len(_cache) > max_size:
+            _cache.popitem(last=False)
+
+    return link, link_expires
+
+
+def clear() -> None:
+    """Clears the cache. Mostly for testing."""
+
+    with _cache_lock:
+        _cache.clear()
@@ -3,6 +3,7 @@
 import logging
 import os
 import tempfile
+import typing
 
 import requests
 import requests.exceptions
@@ -10,6 +11,7 @@ from bson import ObjectId
 from flask import current_app
 
 from pillar.api import utils
+from pillar.api.file_storage_backends import blob_cache
 from . import stream_to_gcs, generate_all_links, ensure_valid_link
 
 __all__ = ['PrerequisiteNotMetError', 'change_file_storage_backend', 'move_to_bucket']
@@ -58,9 +60,10 @@ def change_file_storage_backend(file_id, dest_backend):
 
     try:
         copy_file_to_backend(file_id, project_id, f, f['backend'], dest_backend)
-    except requests.exceptions.HTTPError as ex:
+    except (requests.exceptions.HTTPError, FileNotFoundError) as ex:
         # allow the main file to be removed from storage.
-        if ex.response.status_code not in {404, 410}:
+        if isinstance(ex, requests.exceptions.HTTPError) \
+                and ex.response.status_code not in {404, 410}:
             raise
         if not variations:
             raise PrerequisiteNotMetError('Main file ({link}) does not exist on server, '
@@ -70,20 +73,26 @@ def change_file_storage_backend(file_id, dest_backend):
     for var in variations:
         copy_file_to_backend(file_id, project_id, var, f['backend'], dest_backend)
 
-    # Generate new links for the file & all variations. This also saves
-    # the new backend we set here.
+    # Save the new backend and file path, then generate new links for the
+    # file & all variations. This also saves the variations' new file paths.
     f['backend'] = dest_backend
+    files_collection.update_one({'_id': file_id},
+                                {'$set': {'backend': dest_backend, 'file_path': f['file_path']}})
     generate_all_links(f, utils.utcnow())
 
 
 def copy_file_to_backend(file_id, project_id, file_or_var, src_backend, dest_backend):
     # Filenames on GCS do not contain paths, by our convention
-    internal_fname = os.path.basename(file_or_var['file_path'])
+    src_file_path = file_or_var['file_path']
+    internal_fname = os.path.basename(src_file_path)
     file_or_var['file_path'] = internal_fname
 
     # If the file is not local already, fetch it
     if src_backend == 'pillar':
         local_finfo = fetch_file_from_local(file_or_var)
+    elif blob_cache.is_cacheable(src_backend):
+        local_finfo = fetch_file_from_storage(src_backend, project_id, src_file_path,
+                                              file_or_var.get('content_type'))
     else:
         local_finfo = fetch_file_from_link(file_or_var['link'])
 
@@ -118,7 +127,7 @@ def fetch_file_from_link(link):
     local_file = tempfile.NamedTemporaryFile(dir=current_app.config['STORAGE_DIR'])
     log.info('Downloading to %s', local_file.name)
 
-    for chunk in r.iter_content(chunk_size=1024):
+    for chunk in r.iter_content(chunk_size=256 * 1024):
         if chunk:
             local_file.write(chunk)
     local_file.seek(0)
@@ -131,6 +140,21 @@ def fetch_file_from_link(link):
     return file_dict
 
 
+def fetch_file_from_storage(backend: str, project_id: ObjectId, file_path: str,
+                            content_type: typing.Optional[str]) -> dict:
+    """Mimicks fetch_file_from_link(), but fetches the blob via the blob cache."""
+
+    from pillar.api.file_storage_backends import Bucket
+
+    bucket = Bucket.for_backend(backend)(str(project_id))
+    local_file = blob_cache.open_blob(bucket.blob(file_path))
+    return {
+        'file_size': os.fstat(local_file.fileno()).st_size,
+        'content_type': content_type or 'application/octet-stream',
+        'local_file': local_file,
+    }
+
+
 def fetch_file_from_local(file_doc):
     """Mimicks fetch_file_from_link(), but just returns the local file.
 
@@ -0,0 +1,345 @@
+"""Resumable uploads of large files.
+
+Instead of sending the entire file in one request, the client creates an
+upload session, sends the file in numbered chunks, and then finalises the
+session:
+
+1. POST /api/storage/resumable/<project_id> with JSON
+   {"filename": ..., "content_type": ..., "size": ...}
+   returns the upload ID, the chunk size and the number of chunks.
+2. PUT /api/storage/resumable/<upload_id>/<chunk_index> with the raw bytes of
+   each chunk, in any order. Chunks can be re-sent when a request fails.
+3. PUT /api/storage/resumable/<upload_id> with an empty body and header
+   'Content-Range: bytes */<size>' returns the upload status: 308 with a
+   'Range' header for the bytes received so far, or 200 when all chunks have
+   been received. GET on the same URL returns the status as JSON.
+4. POST /api/storage/resumable/<upload_id>/finalise assembles the chunks in
+   the storage backend, and creates and processes the file document like a
+   regular upload. Its response is the same as for /api/storage/stream.
+
+Chunks are stored as blobs in the storage backend. Sessions that are not
+finalised expire RESUMABLE_UPLOAD_EXPIRY after the last received chunk,
+after which they are removed by a Celery task.
+"""
+
+import datetime
+import logging
+import math
+import re
+import typing
+
+import bson
+import pymongo
+import werkzeug.datastructures
+import werkzeug.exceptions as wz_exceptions
+from flask import Blueprint, current_app, jsonify, request
+
+from pillar.api import utils
+from pillar.api.file_storage_backends import Bucket
+from pillar.api.file_storage_backends.abstract import Blob
+from pillar.api.utils.authorization import require_login
+from pillar.auth import current_user
+
+log = logging.getLogger(__name__)
+
+blueprint = Blueprint('file_storage_resumable', __name__)
+
+# Chunk sizes are multiples of this many bytes.
+CHUNK_SIZE_MULTIPLE = 256 * 1024
+
+# GCS supports at most 1024 components in a composed object.
+MAX_CHUNK_COUNT = 1000
+
+CONTENT_RANGE_STATUS_RE = re.compile(r'^bytes \*/(\d+)$')
+
+
+def _chunk_size_for(file_size: int) -> int:
+    """Returns the chunk size for a file, keeping the number of chunks limited."""
+
+    chunk_size = max(current_app.config['RESUMABLE_UPLOAD_CHUNK_SIZE'],
+                     math.ceil(file_size / MAX_CHUNK_COUNT))
+    return math.ceil(chunk_size / CHUNK_SIZE_MULTIPLE) * CHUNK_SIZE_MULTIPLE
+
+
+def _chunk_blob_name(upload_id: bson.ObjectId, chunk_index: int) -> str:
+    return f'upload-{upload_id}-chunk-{chunk_index:04d}'
+
+
+def _bucket(session: dict) -> Bucket:
+    return Bucket.for_backend(session['backend'])(str(session['project']))
+
+
+def _expiry() -> datetime.datetime:
+    return utils.utcnow() + current_app.config['RESUMABLE_UPLOAD_EXPIRY']
+
+
+def _find_session(upload_id: str) -> dict:
+    """Returns the upload session, if it belongs to the current user.
+
+    :raises wz_exceptions.NotFound: when there is no such session, or when
+        it belongs to another user.
+    """
+
+    upload_oid = utils.str2id(upload_id)
+    sessions_coll = current_app.db('upload_sessions')
+    session = sessions_coll.find_one({'_id': upload_oid, 'user': current_user.user_id})
+    if session is None:
+        raise wz_exceptions.NotFound(f'Upload {upload_id} does not exist')
+    return session
+
+
+def _missing_chunks(session: dict) -> typing.List[int]:
+    received = set(session.get('chunks', []))
+    return [idx for idx in range(session['chunk_count']) if idx not in received]
+
+
+def _status(session: dict) -> dict:
+    missing = _missing_chunks(session)
+
+    # Number of bytes received without gaps, from the start of the file.
+    contiguous_chunks = missing[0] if missing else session['chunk_count']
+    contiguous_bytes = min(contiguous_chunks * session['chunk_size'], session['size'])
+
+    return {
+        'upload_id': str(session['_id']),
+        'size': session['size'],
+        'chunk_size': session['chunk_size'],
+        'chunk_count': session['chunk_count'],
+        'missing_chunks': missing,
+        'contiguous_bytes': contiguous_bytes,
+        'expires': session['expires'],
+        'file_id': str(session['file_id']) if session.get('file_id') else None,
+    }
+
+
+def _jsonify(result: dict, status_code: int):
+    from . import add_access_control_headers
+
+    resp = jsonify(result)
+    resp.status_code = status_code
+    add_access_control_headers(resp)
+    return resp
+
+
+@blueprint.route('/<string:project_id>', methods=['POST'])
+@require_login()
+def create_session(project_id: str):
+    from . import assert_file_size_allowed, override_content_type
+
+    project_oid = utils.str2id(project_id)
+    projects_coll = current_app.db('projects')
+    if not projects_coll.count_documents({'_id': project_oid}):
+        raise wz_exceptions.NotFound('Project %s does not exist' % project_id)
+
+    payload = request.get_json(silent=True) or {}
+    try:
+        filename = str(payload['filename'])
+        file_size = int(payload['size'])
+    except (KeyError, TypeError, ValueError):
+        raise wz_exceptions.BadRequest('Expected JSON with "filename" and "size"')
+    if file_size <= 0:
+        raise wz_exceptions.BadRequest('Files must not be empty')
+    assert_file_size_allowed(file_size)
+
+    # Determine the content type just like for regular uploads.
+    fake_upload = werkzeug.datastructures.FileStorage(
+        filename=filename, content_type=payload.get('content_type') or '')
+    override_content_type(fake_upload)
+    if not fake_upload.content_type:
+        raise wz_exceptions.BadRequest('Missing content type.')
+
+    chunk_size = _chunk_size_for(file_size)
+    session = {
+        'user': current_user.user_id,
+        'project': project_oid,
+        'backend': current_app.config['STORAGE_BACKEND'],
+        'filename': filename,
+        'content_type': fake_upload.content_type,
+        'size': file_size,
+        'chunk_size': chunk_size,
+        'chunk_count': math.ceil(file_size / chunk_size),
+        'chunks': [],
+        'created': utils.utcnow(),
+        'expires': _expiry(),
+    }
+    result = current_app.db('upload_sessions').insert_one(session)
+    session['_id'] = result.inserted_id
+
+    log.info('User %s started resumable upload %s of %d bytes in %d chunks to project %s',
+             current_user.user_id, session['_id'], file_size, session['chunk_count'],
+             project_id)
+    return _jsonify(_status(session), 201)
+
+
+@blueprint.route('/<string:upload_id>', methods=['GET', 'PUT'])
+@require_login()
+def session_status(upload_id: str):
+    """Returns the status of the upload.
+
+    PUT with 'Content-Range: bytes */<size>' follows the convention of
+    resumable uploads to GCS: it responds with 308 Resume Incomplete and the
+    received byte range, or with 200 when everything has been received.
+    """
+
+    session = _find_session(upload_id)
+    status = _status(session)
+
+    if request.method == 'GET':
+        return _jsonify(status, 200)
+
+    match = CONTENT_RANGE_STATUS_RE.match(request.headers.get('Content-Range', ''))
+    if not match:
+        raise wz_exceptions.BadRequest('Expected header Content-Range: bytes */<size>')
+    if int(match.group(1)) != session['size']:
+        raise wz_exceptions.BadRequest(f'This upload is {session["size"]} bytes')
+
+    if not status['missing_chunks']:
+        return _jsonify(status, 200)
+
+    resp = _jsonify(status, 308)
+    if status['contiguous_bytes']:
+        resp.headers['Range'] = f'bytes=0-{status["contiguous_bytes"] - 1}'
+    return resp
+
+
+@blueprint.route('/<string:upload_id>/<int:chunk_index>', methods=['PUT'])
+@require_login()
+def upload_chunk(upload_id: str, chunk_index: int):
+    from werkzeug.wsgi import LimitedStream
+    from .hashing import HashingReader
+
+    session = _find_session(upload_id)
+    if session.get('file_id'):
+        raise wz_exceptions.Conflict('This upload has been finalised already')
+    if chunk_index >= session['chunk_count']:
+        raise wz_exceptions.NotFound(f'This upload has only {session["chunk_count"]} chunks')
+
+    expected_size = min(session['chunk_size'],
+                        session['size'] - chunk_index * session['chunk_size'])
+    if request.content_length is not None and request.content_length != expected_size:
+        raise wz_exceptions.BadRequest(f'Chunk {chunk_index} should be {expected_size} bytes')
+
+    # Stream the raw body to storage, so that it isn't parsed, spooled or kept
+    # in memory. The reader counts the bytes, and allows GCS to retry parts.
+    reader = HashingReader(LimitedStream(request.stream, expected_size))
+    blob = _bucket(session).blob(_chunk_blob_name(session['_id'], chunk_index))
+    blob.create_from_file(reader, file_size=expected_size,
+                          content_type='application/octet-stream')
+    sessions_coll = current_app.db('upload_sessions')
+    if reader.bytes_read != expected_size or request.stream.read(1):
+        # This may have overwritten a previously received copy of the chunk.
+        blob.delete()
+        sessions_coll.update_one({'_id': session['_id']}, {'$pull': {'chunks': chunk_index}})
+        raise wz_exceptions.BadRequest(f'Chunk {chunk_index} should be {expected_size} bytes')
+
+    # $addToSet makes re-sending the same chunk harmless.
+    session = sessions_coll.find_one_and_update(
+        {'_id': session['_id']},
+        {'$addToSet': {'chunks': chunk_index},
+         '$set': {'expires': _expiry()}},
+        return_document=pymongo.ReturnDocument.AFTER)
+    if session is None:
+        # Expired and cleaned up while we were uploading.
+        raise wz_exceptions.NotFound(f'Upload {upload_id} does not exist')
+
+    return _jsonify(_status(session), 200)
+
+
+@blueprint.route('/<string:upload_id>/finalise', methods=['POST'])
+@require_login()
+def finalise(upload_id: str):
+    from . import create_file_doc_for_upload, mark_uploaded, update_file_doc
+
+    session = _find_session(upload_id)
+    sessions_coll = current_app.db('upload_sessions')
+
+    if session.get('file_id'):
+        # Finalising again, for example because the response got lost.
+        return _jsonify(dict(status='ok', file_id=str(session['file_id']), status_code=200),
+                        200)
+
+    if _missing_chunks(session):
+        return _jsonify(_status(session), 409)
+
+    # Make sure that concurrent requests don't both create a file.
+    claimed = sessions_coll.update_one({'_id': session['_id'], 'finalising': {'$ne': True}},
+                                       {'$set': {'finalising': True}})
+    if not claimed.modified_count:
+        raise wz_exceptions.Conflict('This upload is being finalised already')
+
+    uploaded_file = werkzeug.datastructures.FileStorage(
+        filename=session['filename'], content_type=session['content_type'],
+        content_length=session['size'])
+    file_id, internal_fname, status = create_file_doc_for_upload(session['project'],
+                                                                 uploaded_file)
+
+    bucket = _bucket(session)
+    chunks = [bucket.blob(_chunk_blob_name(session['_id'], idx))
+              for idx in range(session['chunk_count'])]
+    try:
+        blob = bucket.compose(internal_fname, chunks, content_type=session['content_type'])
+        if blob.size != session['size']:
+            blob.delete()
+            raise IOError(f'Assembled {blob.size} bytes instead of {session["size"]}')
+    except Exception:
+        log.exception('Unable to assemble resumable upload %s into file %s',
+                      upload_id, file_id)
+        update_file_doc(file_id, status='failed')
+        sessions_coll.update_one({'_id': session['_id']}, {'$unset': {'finalising': True}})
+        raise wz_exceptions.InternalServerError('Unable to assemble the uploaded file')
+
+    mark_uploaded(file_id, blob, session['content_type'], may_process_file=True)
+
+    # Keep the session until it expires, so that finalising is idempotent.
+    sessions_coll.update_one({'_id': session['_id']},
+                             {'$set': {'file_id': file_id, 'chunks': []}})
+    _delete_chunks(chunks)
+
+    log.info('Finalised resumable upload %s into file %s', upload_id, file_id)
+    return _jsonify(dict(status='ok', file_id=str(file_id), status_code=status), status)
+
+
+@blueprint.route('/<string:upload_id>', methods=['DELETE'])
+@require_login()
+def abort(upload_id: str):
+    session = _find_session(upload_id)
+    _remove_session(session)
+    return '', 204
+
+
+def _delete_chunks(chunks: typing.Iterable[Blob]):
+    for chunk in chunks:
+        try:
+            chunk.delete()
+        except Exception:
+            log.warning('Unable to delete chunk %s, ignoring this but it will need '
+                        'cleanup later.', chunk, exc_info=True)
+
+
+def _remove_session(session: dict):
+    bucket = _bucket(session)
+    _delete_chunks((bucket.blob(_chunk_blob_name(session['_id'], idx))
+                            for idx in session.get('chunks', [])))
+    current_app.db('upload_sessions').delete_one({'_id': session['_id']})
+
+
+def remove_expired_sessions() -> int:
+    """Removes expired upload sessions and their chunks.
+
+    :returns: the number of removed sessions.
+    """
+
+    sessions_coll = current_app.db('upload_sessions')
+    expired = sessions_coll.find({'expires': {'$lt': utils.utcnow()}})
+
+    count = 0
+    for session in expired:
+        log.info('Removing expired upload session %s of user %s with %d chunks',
+                 session['_id'], session['user'], len(session.get('chunks', [])))
+        _remove_session(session)
+        count += 1
+    return count
+
+
+def setup_app(app, url_prefix):
+    app.register_api_blueprint(blueprint, url_prefix=url_prefix)
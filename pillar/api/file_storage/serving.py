@@ -0,0 +1,153 @@
+"""Serving of files stored with the local storage backend.
+
+Depending on LOCAL_STORAGE_SERVE_MODE, files are either sent by Pillar itself
+('direct'), or the transfer is handed off to the front-end proxy with an
+X-Accel-Redirect (nginx) or X-Sendfile (Apache, Lighttpd) header. In the
+latter case Pillar only resolves the path, and the worker is free again as
+soon as the headers are sent.
+
+When serving directly, conditional requests and single byte ranges are
+supported, so that browsers can seek in videos. The file is handed to the WSGI
+server as a file object, which allows servers like gunicorn and uWSGI to use
+os.sendfile() for a zero-copy transfer.
+"""
+
+import calendar
+import datetime
+import logging
+import mimetypes
+import os
+import stat
+import typing
+import urllib.parse
+
+import werkzeug.exceptions as wz_exceptions
+from flask import Response, current_app, helpers, request
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import is_resource_modified, unquote_etag
+from werkzeug.wsgi import wrap_file
+
+log = logging.getLogger(__name__)
+
+SERVE_MODES = {'direct', 'x-accel-redirect', 'x-sendfile'}
+
+# Buffer size used when the WSGI server cannot send the file itself.
+BUFFER_SIZE = 256 * 1024
+
+
+def serve_local_file(file_name: str) -> Response:
+    """Returns a response for the file, relative to STORAGE_DIR."""
+
+    path = helpers.safe_join(current_app.config['STORAGE_DIR'], file_name)
+    try:
+        file_stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise wz_exceptions.NotFound()
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise wz_exceptions.NotFound()
+
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    mode = current_app.config.get('LOCAL_STORAGE_SERVE_MODE', 'direct')
+    if mode not in SERVE_MODES:
+        log.warning('Unknown LOCAL_STORAGE_SERVE_MODE %r, serving %s directly', mode, path)
+        mode = 'direct'
+
+    if mode == 'x-accel-redirect':
+        prefix = current_app.config['LOCAL_STORAGE_ACCEL_PREFIX'].rstrip('/')
+        resp = Response(mimetype=mimetype)
+        resp.headers['X-Accel-Redirect'] = f'{prefix}/{urllib.parse.quote(file_name)}'
+        return resp
+
+    if mode == 'x-sendfile':
+        resp = Response(mimetype=mimetype)
+        resp.headers['X-Sendfile'] = os.path.abspath(path)
+        return resp
+
+    return _serve_directly(path, file_stat, mimetype)
+
+
+def _serve_directly(path: str, file_stat: os.stat_result, mimetype: str) -> Response:
+    size = file_stat.st_size
+    # Cheap to compute, and changes whenever the file is replaced.
+    etag = f'{file_stat.st_mtime_ns:x}-{size:x}'
+    last_modified = int(file_stat.st_mtime)
+
+    resp = Response(mimetype=mimetype, direct_passthrough=True)
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    resp.accept_ranges = 'bytes'
+    resp.cache_control.public = True
+    resp.cache_control.max_age = current_app.get_send_file_max_age(path)
+
+    if not is_resource_modified(request.environ, etag=etag,
+                                last_modified=datetime.datetime.utcfromtimestamp(last_modified)):
+        resp.status_code = 304
+        return resp
+
+    start, stop = 0, size
+    byte_range = _requested_range(etag, last_modified, size)
+    if byte_range is not None:
+        start, stop = byte_range
+        if start >= stop:
+            resp.status_code = 416
+            resp.content_range = ContentRange('bytes', None, None, size)
+            resp.content_length = 0
+            return resp
+        resp.status_code = 206
+        resp.content_range = ContentRange('bytes', start, stop, size)
+
+    file_obj = open(path, 'rb')
+    try:
+        file_obj.seek(start)
+    except Exception:
+        file_obj.close()
+        raise
+
+    resp.content_length = stop - start
+    if stop == size:
+        # The WSGI server may use os.sendfile() from the current file position.
+        resp.response = wrap_file(request.environ, file_obj, BUFFER_SIZE)
+    else:
+        # wsgi.file_wrapper has no way to stop before the end of the file.
+        resp.response = _read_part(file_obj, stop - start)
+    return resp
+
+
+def _requested_range(etag: str, last_modified: int, size: int) \
+        -> typing.Optional[typing.Tuple[int, int]]:
+    """Returns the (start, stop) byte range to send, or None for the entire file.
+
+    Returns an empty range when the requested range cannot be satisfied.
+    """
+
+    range_header = request.range
+    if range_header is None or range_header.units != 'bytes':
+        return None
+    # Multiple ranges would require a multipart/byteranges response; the
+    # entire file is a valid response to such a request too.
+    if len(range_header.ranges) != 1:
+        return None
+
+    if_range = request.if_range
+    if if_range.etag is not None:
+        etag_value, weak = unquote_etag(if_range.etag)
+        if weak or etag_value != etag:
+            return None
+    elif if_range.date is not None:
+        if calendar.timegm(if_range.date.utctimetuple()) != last_modified:
+            return None
+
+    byte_range = range_header.range_for_length(size)
+    if byte_range is None:
+        return 0, 0
+    return byte_range
+
+
+def _read_part(file_obj: typing.BinaryIO, length: int) -> typing.Iterator[bytes]:
+    with file_obj:
+        while length > 0:
+            data = file_obj.read(min(BUFFER_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
@@ -14,6 +14,7 @@ from .abstract import Bucket
 # Import the other backends so that they register.
 from . import local
 from . import gcs
+from . import blob_cache
 
 
 def default_storage_backend(name: str) -> Bucket:
@@ -1,4 +1,5 @@
 import abc
+import copy
 import io
 import logging
 import typing
@@ -30,6 +31,14 @@ class Bucket(metaclass=abc.ABCMeta):
 
     backend_name: str = None  # define in subclass.
 
+    # Set to True in subclasses whose blob URLs only depend on the blob name
+    # and configuration, and can be generated without contacting the backend.
+    links_are_deterministic = False
+
+    # Set to True in subclasses for remote storage, to keep downloaded blobs
+    # in the local blob cache. See pillar.api.file_storage_backends.blob_cache.
+    cache_downloads = False
+
     def __init__(self, name: str) -> None:
         self.name = str(name)
 
@@ -45,6 +54,13 @@ class Bucket(metaclass=abc.ABCMeta):
         """Returns the Bucket subclass for the given backend."""
         return cls.backends[backend_name]
 
+    def clone(self) -> 'Bucket':
+        """Returns a copy of this bucket with the same settings.
+
+        Use this to give each thread its own Bucket instance.
+        """
+        return copy.copy(self)
+
     @abc.abstractmethod
     def blob(self, blob_name: str) -> 'Blob':
         """Factory constructor for blob object.
@@ -71,6 +87,14 @@ class Bucket(metaclass=abc.ABCMeta):
     def rename_blob(self, blob: 'Blob', new_name: str) -> 'Blob':
         """Rename the blob, returning the new Blob."""
 
+    @abc.abstractmethod
+    def compose(self, blob_name: str, sources: typing.List['Blob'], *,
+                content_type: str) -> 'Blob':
+        """Creates a blob from the concatenated contents of the source blobs.
+
+        The source blobs are not removed.
+        """
+
     @classmethod
     def copy_to_bucket(cls, blob_name, src_project_id: ObjectId, dest_project_id: ObjectId):
         """Copies a file from one bucket to the other."""
@@ -124,6 +148,10 @@ class Blob(metaclass=abc.ABCMeta):
         :param file_size: The size of the file in bytes, or -1 if unknown
         """
 
+    @abc.abstractmethod
+    def download_to_file(self, file_obj: FileType):
+        """Copies the contents of the blob into the file object."""
+
     def upload_from_path(self, path: pathlib.Path, content_type: str):
         file_size = path.stat().st_size
 
@@ -131,6 +159,17 @@ class Blob(metaclass=abc.ABCMeta):
             self.create_from_file(infile, content_type=content_type,
                                   file_size=file_size)
 
+    def cache_validator(self) -> typing.Optional[str]:
+        """Returns a string that changes whenever the contents of the blob change.
+
+        Used to validate cached copies of the blob, and may also update
+        self.size. Returns None when the blob cannot be validated, which
+        prevents it from being cached.
+
+        :raises FileNotFoundError: when the blob does not exist.
+        """
+        return None
+
     @abc.abstractmethod
     def update_filename(self, filename: str, *, is_attachment=True):
         """Sets the filename which is used when downloading the file.
@@ -163,5 +202,9 @@ class Blob(metaclass=abc.ABCMeta):
     def exists(self) -> bool:
         """Returns True iff the file exists on the storage backend."""
 
+    @abc.abstractmethod
+    def delete(self):
+        """Removes the file from the storage backend, if it exists."""
+
 
 Bl = typing.TypeVar('Bl', bound=Blob)
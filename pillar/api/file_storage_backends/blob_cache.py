@@ -0,0 +1,238 @@
+"""Read-through cache of remote blobs on local disk.
+
+Moving, re-processing and checksumming files all need a local copy of the
+blob. For remote storage backends this means a download every time, even
+when the same file was fetched a minute earlier. This module keeps such
+downloads in BLOB_CACHE_DIR, evicting the least recently used ones when the
+cache grows beyond BLOB_CACHE_MAX_BYTES.
+
+Buckets opt in by setting `cache_downloads = True`, and their blobs by
+implementing Blob.cache_validator(). Cache entries are named after the
+validator, so a blob that changed on the storage backend is never served
+from the cache; its old entry is simply evicted over time. The cache lives on
+disk, and can be shared by all processes on the machine.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import typing
+import uuid
+
+from flask import current_app
+
+from .abstract import Blob, FileType
+
+log = logging.getLogger(__name__)
+
+CacheStats = typing.NamedTuple('CacheStats', [
+    ('hits', int),
+    ('misses', int),
+    ('evictions', int),
+])
+
+# Length of the file names of cache entries, which are SHA-256 hex digests.
+DIGEST_LENGTH = 64
+
+# Per-process counters, see stats().
+_counters: typing.Counter[str] = collections.Counter()
+_counters_lock = threading.Lock()
+
+
+def is_enabled() -> bool:
+    return current_app.config.get('BLOB_CACHE_MAX_BYTES', 0) > 0
+
+
+def is_cacheable(backend_name: str) -> bool:
+    """Returns whether downloads from this storage backend are cached."""
+
+    from . import Bucket
+
+    if not is_enabled():
+        return False
+    try:
+        bucket_class = Bucket.for_backend(backend_name)
+    except KeyError:
+        return False
+    return bucket_class.cache_downloads
+
+
+def cache_dir() -> pathlib.Path:
+    configured = current_app.config.get('BLOB_CACHE_DIR')
+    if configured:
+        return pathlib.Path(configured)
+    return pathlib.Path(current_app.config['STORAGE_DIR']) / 'blob-cache'
+
+
+def stats() -> CacheStats:
+    """Returns the hit/miss counters of this process."""
+
+    with _counters_lock:
+        return CacheStats(hits=_counters['hits'],
+                          misses=_counters['misses'],
+                          evictions=_counters['evictions'])
+
+
+def disk_usage() -> typing.Tuple[int, int]:
+    """Returns the number of cached blobs and their total size in bytes."""
+
+    entries = _entries()
+    return len(entries), sum(size for _, size, _ in entries)
+
+
+def open_blob(blob: Blob) -> typing.BinaryIO:
+    """Returns a local file with the contents of the blob.
+
+    The file is opened for reading and positioned at the start. It is served
+    from the cache when possible, and otherwise downloaded (and cached if
+    the blob supports this). The caller is responsible for closing it.
+
+    :raises FileNotFoundError: when the blob does not exist.
+    """
+
+    cache_path = _cache_path(blob)
+    if cache_path is None:
+        local_file = tempfile.NamedTemporaryFile(dir=current_app.config['STORAGE_DIR'])
+        blob.download_to_file(local_file)
+        local_file.flush()
+        local_file.seek(0)
+        return local_file
+
+    try:
+        cached_file = cache_path.open('rb')
+    except FileNotFoundError:
+        pass
+    else:
+        if blob.size is None or os.fstat(cached_file.fileno()).st_size == blob.size:
+            _count('hits')
+            # Eviction is based on modification time.
+            os.utime(cached_file.fileno())
+            log.debug('Serving %s from blob cache %s', blob, cache_path)
+            return cached_file
+        log.warning('Cached copy %s of %s has the wrong size, downloading again',
+                    cache_path, blob)
+        cached_file.close()
+
+    _count('misses')
+    return _download(blob, cache_path)
+
+
+def download_to_file(blob: Blob, file_obj: FileType):
+    """Copies the contents of the blob into the file object, using the cache if possible."""
+
+    with open_blob(blob) as infile:
+        shutil.copyfileobj(infile, typing.cast(typing.IO, file_obj))
+
+
+def clear():
+    """Removes all cached blobs."""
+
+    for path, _, _ in _entries():
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _count(counter: str, amount=1):
+    with _counters_lock:
+        _counters[counter] += amount
+
+
+def _cache_path(blob: Blob) -> typing.Optional[pathlib.Path]:
+    if not is_enabled() or not blob.bucket.cache_downloads:
+        return None
+
+    validator = blob.cache_validator()
+    if validator is None:
+        return None
+
+    key = '\0'.join((blob.bucket.backend_name, blob.bucket.name, blob.name, validator))
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return cache_dir() / digest[:2] / digest
+
+
+def _download(blob: Blob, cache_path: pathlib.Path) -> typing.BinaryIO:
+    """Downloads the blob into the cache, returning the opened cache file."""
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = cache_path.with_name(f'.{cache_path.name}.{uuid.uuid4().hex[:12]}.tmp')
+
+    log.info('Downloading %s into blob cache', blob)
+    try:
+        with temp_path.open('wb') as local_file:
+            blob.download_to_file(local_file)
+
+        size = temp_path.stat().st_size
+        if blob.size is not None and size != blob.size:
+            raise IOError(f'Downloaded {size} bytes of {blob}, expected {blob.size}')
+        os.replace(str(temp_path), str(cache_path))
+    except BaseException:
+        try:
+            temp_path.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+
+    # Open before evicting, so that the file remains available to us even
+    # when it is evicted right away.
+    cached_file = cache_path.open('rb')
+    _evict()
+    return cached_file
+
+
+def _entries() -> typing.List[typing.Tuple[pathlib.Path, int, float]]:
+    """Returns (path, size, mtime) of the cached blobs.
+
+    Incomplete downloads are skipped, as are other files, like thumbnails
+    that processing writes next to the file it is given.
+    """
+
+    entries = []
+    root = cache_dir()
+    if not root.exists():
+        return entries
+
+    for subdir in root.iterdir():
+        if not subdir.is_dir():
+            continue
+        for path in subdir.iterdir():
+            if len(path.name) != DIGEST_LENGTH or path.name.startswith('.'):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def _evict():
+    """Removes the least recently used blobs until the cache fits BLOB_CACHE_MAX_BYTES."""
+
+    max_bytes = current_app.config['BLOB_CACHE_MAX_BYTES']
+    entries = _entries()
+    total_size = sum(size for _, size, _ in entries)
+    if total_size <= max_bytes:
+        return
+
+    entries.sort(key=lambda entry: entry[2])
+    evicted = 0
+    for path, size, _ in entries:
+        if total_size <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            # Evicted by another process.
+            pass
+        total_size -= size
+        evicted += 1
+
+    log.debug('Evicted %d blobs from blob cache', evicted)
+    _count('evictions', evicted)
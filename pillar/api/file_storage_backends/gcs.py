@@ -1,13 +1,15 @@
 import os
 import datetime
 import logging
+import queue
+import threading
 import typing
 
 from bson import ObjectId
 from gcloud.storage.client import Client
 import gcloud.storage.blob
 import gcloud.exceptions as gcloud_exc
-from flask import current_app, g
+from flask import current_app
 from werkzeug.local import LocalProxy
 
 from pillar.api import utils
@@ -15,17 +17,109 @@ from .abstract import Bucket, Blob, FileType
 
 log = logging.getLogger(__name__)
 
+# Maximum number of source blobs in a single GCS compose request.
+MAX_COMPOSE_SOURCES = 32
+
+_client: typing.Optional[Client] = None
+_client_pid: typing.Optional[int] = None
+_client_lock = threading.Lock()
+
+# Mapping from bucket name to (client, gcloud bucket), so that we don't have
+# to fetch the bucket from GCS every time a GoogleCloudStorageBucket is created.
+_gcs_buckets: typing.Dict[str, typing.Tuple[Client, gcloud.storage.Bucket]] = {}
+_gcs_buckets_lock = threading.Lock()
+
+
+class HttpPool:
+    """Thread-safe replacement for the httplib2.Http object of the GCS client.
+
+    httplib2.Http objects keep their connections alive, but cannot be used
+    by multiple threads at once. This pool hands out an Http object to every
+    concurrent request, and keeps at most `max_size` of them (and thus their
+    connections) around for reuse.
+    """
+
+    def __init__(self, credentials, max_size: int) -> None:
+        self._credentials = credentials
+        self._idle: queue.LifoQueue = queue.LifoQueue(maxsize=max_size)
+
+        # gcloud.streaming inspects this to override connection types per URL
+        # scheme; we never do that.
+        self.connections: typing.Dict[str, typing.Any] = {}
+
+    def _checkout(self):
+        import httplib2
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        http = httplib2.Http()
+        if self._credentials is not None:
+            http = self._credentials.authorize(http)
+        return http
+
+    def _checkin(self, http) -> None:
+        try:
+            self._idle.put_nowait(http)
+        except queue.Full:
+            for connection in http.connections.values():
+                connection.close()
+
+    def request(self, *args, **kwargs):
+        http = self._checkout()
+        try:
+            return http.request(*args, **kwargs)
+        finally:
+            self._checkin(http)
+
+
+def _create_client() -> Client:
+    from gcloud.credentials import get_credentials
+    from gcloud.storage.connection import Connection
+
+    pool_size = current_app.config.get('GCS_HTTP_POOL_SIZE', 10)
+    endpoint = current_app.config.get('GCS_API_ENDPOINT', '')
+
+    if endpoint:
+        # Requests to an alternative endpoint, such as a fake GCS server, are
+        # not authenticated.
+        log.info('Using GCS API endpoint %s', endpoint)
+        credentials = None
+        connection_class = type('Connection', (Connection,), {'API_BASE_URL': endpoint})
+        client_class = type('Client', (Client,), {'_connection_class': connection_class})
+    else:
+        credentials = get_credentials()
+        if credentials.create_scoped_required():
+            credentials = credentials.create_scoped(Connection.SCOPE)
+        client_class = Client
+
+    return client_class(credentials=credentials, http=HttpPool(credentials, pool_size))
+
 
 def get_client() -> Client:
-    """Stores the GCS client on the global Flask object.
+    """Returns the GCS client of this process.
 
-    The GCS client is not user-specific anyway.
+    The client is thread-safe, and keeps its connections to GCS alive, so it
+    is shared by all requests and tasks handled by this process. It is
+    created again after forking, as connections cannot be shared between
+    processes.
     """
 
-    _gcs = getattr(g, '_gcs_client', None)
-    if _gcs is None:
-        _gcs = g._gcs_client = Client()
-    return _gcs
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            _client = _create_client()
+            _client_pid = pid
+            with _gcs_buckets_lock:
+                _gcs_buckets.clear()
+        return _client
 
 
 # This hides the specifics of how/where we store the GCS client,
@@ -34,6 +128,39 @@ def get_client() -> Client:
 gcs: Client = LocalProxy(get_client)
 
 
+def _get_gcs_bucket(name: str) -> gcloud.storage.Bucket:
+    """Returns the gcloud bucket, creating it if it doesn't exist yet."""
+
+    client = gcs._get_current_object() if isinstance(gcs, LocalProxy) else gcs
+
+    with _gcs_buckets_lock:
+        cached = _gcs_buckets.get(name)
+    if cached is not None and cached[0] is client:
+        return cached[1]
+
+    try:
+        gcs_bucket = client.get_bucket(name)
+    except gcloud_exc.NotFound:
+        gcs_bucket = client.bucket(name)
+        # Hardcode the bucket location to EU
+        gcs_bucket.location = 'EU'
+        # Optionally enable CORS from * (currently only used for vrview)
+        # self.gcs_bucket.cors = [
+        #     {
+        #       "origin": ["*"],
+        #       "responseHeader": ["Content-Type"],
+        #       "method": ["GET", "HEAD", "DELETE"],
+        #       "maxAgeSeconds": 3600
+        #     }
+        # ]
+        gcs_bucket.create()
+        log.info('Created GCS instance for project %s', name)
+
+    with _gcs_buckets_lock:
+        _gcs_buckets[name] = (client, gcs_bucket)
+    return gcs_bucket
+
+
 class GoogleCloudStorageBucket(Bucket):
     """Cloud Storage bucket interface. We create a bucket for every project. In
     the bucket we create first level subdirs as follows:
@@ -51,30 +178,14 @@ class GoogleCloudStorageBucket(Bucket):
     """
 
     backend_name = 'gcs'
+    cache_downloads = True
 
     def __init__(self, name: str, subdir='_') -> None:
         super().__init__(name=name)
 
         self._log = logging.getLogger(f'{__name__}.GoogleCloudStorageBucket')
 
-        try:
-            self._gcs_bucket = gcs.get_bucket(name)
-        except gcloud_exc.NotFound:
-            self._gcs_bucket = gcs.bucket(name)
-            # Hardcode the bucket location to EU
-            self._gcs_bucket.location = 'EU'
-            # Optionally enable CORS from * (currently only used for vrview)
-            # self.gcs_bucket.cors = [
-            #     {
-            #       "origin": ["*"],
-            #       "responseHeader": ["Content-Type"],
-            #       "method": ["GET", "HEAD", "DELETE"],
-            #       "maxAgeSeconds": 3600
-            #     }
-            # ]
-            self._gcs_bucket.create()
-            log.info('Created GCS instance for project %s', name)
-
+        self._gcs_bucket = _get_gcs_bucket(name)
         self.subdir = subdir
 
     def blob(self, blob_name: str) -> 'GoogleCloudStorageBlob':
@@ -133,6 +244,34 @@ class GoogleCloudStorageBucket(Bucket):
 
         return self._gcs_bucket.copy_blob(blob.gblob, to_bucket._gcs_bucket)
 
+    def compose(self, blob_name: str, sources: typing.List[Blob], *,
+                content_type: str) -> 'GoogleCloudStorageBlob':
+        assert all(isinstance(source, GoogleCloudStorageBlob) for source in sources)
+
+        self._log.info('Composing %s from %d blobs', blob_name, len(sources))
+        dest_blob = self.blob(blob_name)
+        gsources = [source.gblob for source in sources]
+
+        # GCS can only compose a limited number of blobs per request, so
+        # larger sets are composed in steps via intermediate blobs.
+        intermediates = []
+        while len(gsources) > MAX_COMPOSE_SOURCES:
+            partial = self._gcs_get(f'{blob_name}.part{len(intermediates)}')
+            partial.content_type = content_type
+            partial.compose(gsources[:MAX_COMPOSE_SOURCES])
+            intermediates.append(partial)
+            gsources = [partial] + gsources[MAX_COMPOSE_SOURCES:]
+
+        dest_blob.gblob.content_type = content_type
+        dest_blob.gblob.compose(gsources)
+
+        for partial in intermediates:
+            partial.delete()
+
+        dest_blob.gblob.reload()
+        dest_blob._size_in_bytes = dest_blob.gblob.size
+        return dest_blob
+
     def rename_blob(self, blob: 'GoogleCloudStorageBlob', new_name: str) \
             -> 'GoogleCloudStorageBlob':
         """Rename the blob, returning the new Blob."""
@@ -174,6 +313,21 @@ class GoogleCloudStorageBlob(Blob):
         self.gblob.reload()
         self._size_in_bytes = self.gblob.size
 
+    def download_to_file(self, file_obj: FileType):
+        self._log.debug('Downloading %r from GCS', self)
+        self.gblob.download_to_file(file_obj)
+
+    def cache_validator(self) -> typing.Optional[str]:
+        try:
+            self.gblob.reload()
+        except gcloud_exc.NotFound:
+            raise FileNotFoundError(f'{self} does not exist')
+
+        self._size_in_bytes = self.gblob.size
+        if not self.gblob.etag:
+            return None
+        return f'{self.gblob.generation}-{self.gblob.etag}'
+
     def update_filename(self, filename: str, *, is_attachment=True):
         """Set the ContentDisposition metadata so that when a file is downloaded
         it has a human-readable name.
@@ -213,12 +367,20 @@ class GoogleCloudStorageBlob(Blob):
             return False
         return self.gblob.exists()
 
+    def delete(self):
+        try:
+            self.gblob.delete()
+        except gcloud_exc.NotFound:
+            pass
+
 
 def update_file_name(node):
     """Assign to the CGS blob the same name of the asset node. This way when
     downloading an asset we get a human-readable name.
     """
 
+    from pillar.api.file_storage import dedup
+
     # Process only files that are not processing
     if node['properties'].get('status', '') == 'processing':
         return
@@ -236,6 +398,13 @@ def update_file_name(node):
         if file_doc is None or file_doc.get('backend') != 'gcs':
             return
 
+        # The blobs can only have one name, so don't let this node rename those
+        # of other files.
+        if dedup.is_blob_shared(file_doc):
+            log.info('Not renaming blobs of file %s, they are used by other files',
+                     file_doc['_id'])
+            return
+
         # For textures -- the map type should be part of the name.
         map_type = file_props.get('map_type', '')
 
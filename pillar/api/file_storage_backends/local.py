@@ -1,6 +1,12 @@
+import contextlib
+import errno
+import io
 import logging
+import os
 import pathlib
+import stat
 import typing
+import uuid
 
 from flask import current_app
 
@@ -8,9 +14,24 @@ __all__ = ['LocalBucket', 'LocalBlob']
 
 from .abstract import Bucket, Blob, FileType, Path
 
+log = logging.getLogger(__name__)
+
+# ioctl to create a copy-on-write clone of a file, from linux/fs.h.
+FICLONE = 0x40049409
+
+# Maximum number of bytes copied per copy_file_range()/sendfile() call.
+KERNEL_COPY_CHUNK = 1 << 30
+
+# Errors indicating that the kernel cannot copy or link between the given
+# files, and that we should fall back to the next method.
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                    errno.ENOTSUP, errno.ENOTSOCK, errno.ESPIPE, errno.EBADF,
+                    errno.EPERM, errno.EMLINK, errno.ENOTTY}
+
 
 class LocalBucket(Bucket):
     backend_name = 'local'
+    links_are_deterministic = True
 
     def __init__(self, name: str) -> None:
         super().__init__(name)
@@ -54,8 +75,24 @@ class LocalBucket(Bucket):
                                         f' unable to copy to {to_bucket}')
             raise FileNotFoundError(f'File {fpath} does not exist, unable to copy to {to_bucket}')
 
-        with open(fpath, 'rb') as src_file:
-            dest_blob.create_from_file(src_file, content_type='application/x-octet-stream')
+        allow_hardlink = current_app.config.get('LOCAL_STORAGE_HARDLINK_COPIES', True)
+        _copy_file(fpath, dest_blob.abspath(), allow_hardlink=allow_hardlink)
+        dest_blob._size_in_bytes = fpath.stat().st_size
+
+    def compose(self, blob_name: str, sources: typing.List[Blob], *,
+                content_type: str) -> 'LocalBlob':
+        self._log.info('Composing %s from %d blobs', blob_name, len(sources))
+        dest_blob = self.blob(blob_name)
+        dest_path = dest_blob.abspath()
+
+        with _atomic_write(dest_path) as outfile:
+            for source in sources:
+                assert isinstance(source, LocalBlob)
+                with source.abspath().open('rb') as infile:
+                    _copy_stream(infile, outfile)
+
+        dest_blob._size_in_bytes = dest_path.stat().st_size
+        return dest_blob
 
     def rename_blob(self, blob: 'LocalBlob', new_name: str) -> 'LocalBlob':
         """Rename the blob, returning the new Blob."""
@@ -102,17 +139,15 @@ class LocalBlob(Blob):
                          file_size: int = -1):
         assert hasattr(file_obj, 'read')
 
-        import shutil
-
-        # Ensure path exists before saving
-        my_path = self.abspath()
-        my_path.parent.mkdir(exist_ok=True, parents=True)
-
-        with my_path.open('wb') as outfile:
-            shutil.copyfileobj(typing.cast(typing.IO, file_obj), outfile)
+        with _atomic_write(self.abspath()) as outfile:
+            _copy_stream(file_obj, outfile)
 
         self._size_in_bytes = file_size
 
+    def download_to_file(self, file_obj: FileType):
+        with self.abspath().open('rb') as infile:
+            _copy_stream(infile, file_obj)
+
     def update_filename(self, filename: str, *, is_attachment=True):
         # TODO: implement this for local storage.
         self._log.info('update_filename(%r) not supported', filename)
@@ -127,8 +162,168 @@ class LocalBlob(Blob):
     def exists(self) -> bool:
         return self.abspath().exists()
 
+    def delete(self):
+        try:
+            self.abspath().unlink()
+        except FileNotFoundError:
+            pass
+
     def touch(self):
         """Touch the file, creating parent directories if needed."""
         path = self.abspath()
         path.parent.mkdir(parents=True, exist_ok=True)
         path.touch(exist_ok=True)
+
+
+def _temp_path(path: pathlib.Path) -> pathlib.Path:
+    """Returns a unique, hidden path next to the given path."""
+    return path.with_name(f'.{path.name}.{uuid.uuid4().hex[:12]}.tmp')
+
+
+@contextlib.contextmanager
+def _atomic_write(path: pathlib.Path) -> typing.Iterator[typing.BinaryIO]:
+    """Opens a temporary file that replaces the file at path when the context exits.
+
+    Readers thus never see a partially written file. When an exception is
+    raised, the temporary file is removed and the file at path is untouched.
+    """
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = _temp_path(path)
+    # Unlike tempfile.mkstemp(), this respects the umask, so that the
+    # front-end proxy can still read the file.
+    fd = os.open(str(temp_path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with open(fd, 'wb') as outfile:
+            yield outfile
+        os.replace(str(temp_path), str(path))
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            temp_path.unlink()
+        raise
+
+
+def _copy_file(src: pathlib.Path, dest: pathlib.Path, *, allow_hardlink: bool):
+    """Copies src to dest, as cheaply as the filesystem allows.
+
+    In order of preference, creates a copy-on-write clone (reflink), a hard
+    link, or an actual copy performed by the kernel. Blobs are never modified
+    in place, only replaced by _atomic_write(), so a hard link behaves as a
+    copy-on-write copy as well.
+    """
+
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if dest.exists() and os.path.samefile(str(src), str(dest)):
+        log.debug('%s and %s are already the same file', src, dest)
+        return
+
+    if _reflink(src, dest):
+        log.debug('Cloned %s to %s', src, dest)
+        return
+
+    if allow_hardlink:
+        temp_path = _temp_path(dest)
+        try:
+            os.link(str(src), str(temp_path))
+        except OSError as ex:
+            if ex.errno not in _FALLBACK_ERRNOS:
+                raise
+            log.debug('Unable to hard-link %s to %s: %s', src, dest, ex)
+        else:
+            os.replace(str(temp_path), str(dest))
+            log.debug('Hard-linked %s to %s', src, dest)
+            return
+
+    with src.open('rb') as infile, _atomic_write(dest) as outfile:
+        _copy_stream(infile, outfile)
+
+
+def _reflink(src: pathlib.Path, dest: pathlib.Path) -> bool:
+    """Creates dest as copy-on-write clone of src, returning False if unsupported."""
+
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    try:
+        with src.open('rb') as infile, _atomic_write(dest) as outfile:
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+    except OSError as ex:
+        if ex.errno not in _FALLBACK_ERRNOS:
+            raise
+        return False
+    return True
+
+
+def _regular_file_fd(file_obj) -> typing.Optional[int]:
+    """Returns the file descriptor of a binary file object backed by a regular file."""
+
+    if not isinstance(file_obj, io.IOBase):
+        # tempfile.NamedTemporaryFile() returns a wrapper around the real file.
+        file_obj = getattr(file_obj, 'file', None)
+    if not isinstance(file_obj, (io.BufferedIOBase, io.RawIOBase)):
+        return None
+
+    try:
+        fd = file_obj.fileno()
+    except (OSError, io.UnsupportedOperation):
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    return fd
+
+
+def _copy_stream(src: FileType, dest: FileType):
+    """Copies src from its current position to dest, at its current position.
+
+    When both are regular files, the kernel copies the data without passing
+    it through Python. Otherwise this falls back to shutil.copyfileobj().
+    """
+
+    in_fd = _regular_file_fd(src)
+    out_fd = _regular_file_fd(dest)
+    if in_fd is not None and out_fd is not None:
+        src_offset = src.tell()
+        dest.flush()
+        dest_offset = dest.tell()
+        os.lseek(out_fd, dest_offset, os.SEEK_SET)
+
+        copied = _kernel_copy(in_fd, src_offset, out_fd)
+        if copied is not None:
+            # Leave both files positioned as if they were copied in Python.
+            src.seek(src_offset + copied)
+            dest.seek(dest_offset + copied)
+            return
+
+    import shutil
+    shutil.copyfileobj(typing.cast(typing.IO, src), typing.cast(typing.IO, dest))
+
+
+def _kernel_copy(in_fd: int, offset: int, out_fd: int) -> typing.Optional[int]:
+    """Copies in_fd from the offset to the end, to the current position of out_fd.
+
+    :returns: the number of bytes copied, or None when the kernel cannot copy
+        between these files, in which case nothing was copied.
+    """
+
+    copy_funcs = []
+    if hasattr(os, 'copy_file_range'):
+        copy_funcs.append(lambda in_offset: os.copy_file_range(
+            in_fd, out_fd, KERNEL_COPY_CHUNK, in_offset))
+    if hasattr(os, 'sendfile'):
+        copy_funcs.append(lambda in_offset: os.sendfile(
+            out_fd, in_fd, in_offset, KERNEL_COPY_CHUNK))
+
+    for copy_func in copy_funcs:
+        copied = 0
+        try:
+            while True:
+                count = copy_func(offset + copied)
+                if not count:
+                    return copied
+                copied += count
+        except OSError as ex:
+            if copied or ex.errno not in _FALLBACK_ERRNOS:
+                raise
+    return None
@@ -0,0 +1,246 @@
+"""Video encoding with FFmpeg on our own Celery workers.
+
+Used when ENCODING_BACKEND = 'local'. Encoder.job_create() queues a Celery
+task per file (see pillar.celery.video_encoding), which encodes the
+variations that _process_video() declared, uploads them to the file's bucket,
+and updates the file document like a Zencoder notification would.
+"""
+
+import contextlib
+import hashlib
+import logging
+import pathlib
+import tempfile
+import time
+import typing
+
+from bson import ObjectId
+from flask import current_app
+
+from pillar.api import encoding, utils
+from pillar.api.file_storage_backends import Bucket, blob_cache
+from pillar.api.file_storage_backends.abstract import Blob
+from pillar.api.file_storage_backends.local import LocalBlob
+from pillar.api.utils import imaging
+
+log = logging.getLogger(__name__)
+
+# Minimum number of seconds between progress updates in MongoDB.
+PROGRESS_UPDATE_INTERVAL = 5
+
+# Number of lines of FFmpeg output to log when it fails.
+ERROR_OUTPUT_LINES = 20
+
+
+class JobNotReady(Exception):
+    """Raised when the file document doesn't refer to the encoding job (yet).
+
+    Encoding jobs are queued before the file document that refers to them
+    is saved, so the task may have to wait for that.
+    """
+
+
+class EncodingError(Exception):
+    """Raised when FFmpeg fails to encode a video."""
+
+
+def create_job(file_id: ObjectId) -> dict:
+    """Queues a Celery task to encode the file, returning the job info."""
+
+    from pillar.celery import video_encoding
+
+    job_id = str(ObjectId())
+    log.info('Queueing local encoding job %s for file %s', job_id, file_id)
+    video_encoding.encode_video.delay(str(file_id), job_id)
+
+    return {'process_id': job_id,
+            'backend': 'local'}
+
+
+def job_progress(job_id: str) -> typing.Optional[dict]:
+    """Returns the status and progress (in percent) of the job."""
+
+    files_coll = current_app.db('files')
+    file_doc = files_coll.find_one({'processing.backend': 'local',
+                                    'processing.job_id': job_id},
+                                   projection={'processing': 1})
+    if not file_doc:
+        return None
+    processing = file_doc['processing']
+    return {'state': processing.get('status'),
+            'progress': processing.get('progress', 0)}
+
+
+def encode_file(file_id: ObjectId, job_id: str):
+    """Encodes the variations of the video file, and updates the file document.
+
+    :raises JobNotReady: when the file document doesn't refer to this job yet.
+    :raises EncodingError: when FFmpeg fails.
+    """
+
+    files_coll = current_app.db('files')
+    file_doc = files_coll.find_one(file_id)
+    if not file_doc or file_doc.get('_deleted'):
+        log.warning('Not encoding file %s for job %s, it does not exist', file_id, job_id)
+        return
+
+    processing = file_doc.get('processing') or {}
+    if processing.get('job_id') != job_id:
+        if file_doc.get('status') == 'processing':
+            raise JobNotReady(f'File {file_id} does not refer to encoding job {job_id} yet')
+        log.warning('Not encoding file %s, job %s was superseded by job %r',
+                    file_id, job_id, processing.get('job_id'))
+        return
+    if processing.get('status') == 'finished':
+        log.info('Encoding job %s for file %s was finished already', job_id, file_id)
+        return
+
+    log.info('Encoding file %s with local encoding job %s', file_id, job_id)
+    progress = _ProgressReporter(file_id, job_id, len(file_doc['variations']))
+    progress.report(0, force=True)
+
+    bucket = Bucket.for_backend(file_doc['backend'])(str(file_doc['project']))
+    source_blob = bucket.blob(file_doc['file_path'])
+    threads = current_app.config['ENCODING_LOCAL_THREADS']
+
+    with tempfile.TemporaryDirectory(dir=current_app.config['STORAGE_DIR']) as tmpdir, \
+            _local_source(source_blob) as source_path:
+        duration = _duration_seconds(file_doc, source_path)
+
+        outputs = []
+        for idx, variation in enumerate(file_doc['variations']):
+            dst = pathlib.Path(tmpdir) / pathlib.PurePosixPath(variation['file_path']).name
+            cli_args = imaging.ffmpeg_encode_args(
+                source_path, dst, variation['format'],
+                variation.get('width', 0), variation.get('height', 0),
+                threads=threads)
+            _run_ffmpeg(cli_args, duration,
+                        lambda fraction: progress.report(idx + fraction))
+            outputs.append(_upload_output(bucket, variation, dst))
+
+    file_doc = utils.remove_private_keys(file_doc)
+    file_doc['processing'] = {'backend': 'local',
+                              'job_id': job_id,
+                              'status': 'finished',
+                              'progress': 100}
+    encoding.apply_encoded_outputs(file_id, file_doc, outputs,
+                                   duration_secs=int(duration) if duration else 0)
+
+    r, _, _, status = current_app.put_internal('files', file_doc, _id=file_id)
+    if status != 200:
+        raise RuntimeError(f'Unable to save file {file_id} after encoding: {r}')
+    log.info('Local encoding job %s for file %s finished', job_id, file_id)
+
+
+def mark_failed(file_id: ObjectId, job_id: str):
+    """Marks the file and the encoding job as failed."""
+
+    files_coll = current_app.db('files')
+    files_coll.update_one(
+        {'_id': file_id, 'processing.job_id': job_id},
+        {'$set': {'status': 'failed',
+                  'processing.status': 'failed',
+                  '_updated': utils.utcnow(),
+                  '_etag': utils.random_etag()}})
+
+
+class _ProgressReporter:
+    """Stores the progress of an encoding job in the file document, at most every few seconds."""
+
+    def __init__(self, file_id: ObjectId, job_id: str, variation_count: int) -> None:
+        self.file_id = file_id
+        self.job_id = job_id
+        self.variation_count = max(variation_count, 1)
+        self._last_report = 0.0
+
+    def report(self, variations_done: float, *, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_report < PROGRESS_UPDATE_INTERVAL:
+            return
+        self._last_report = now
+
+        percent = round(100 * min(variations_done / self.variation_count, 1.0), 1)
+        files_coll = current_app.db('files')
+        files_coll.update_one(
+            {'_id': self.file_id, 'processing.job_id': self.job_id},
+            {'$set': {'processing.status': 'processing',
+                      'processing.progress': percent}})
+
+
+@contextlib.contextmanager
+def _local_source(blob: Blob) -> typing.Iterator[pathlib.Path]:
+    """Yields the path of a local copy of the blob."""
+
+    if isinstance(blob, LocalBlob):
+        # No need to copy files that are on the local filesystem already.
+        yield blob.abspath()
+        return
+
+    with blob_cache.open_blob(blob) as local_file:
+        yield pathlib.Path(local_file.name)
+
+
+def _duration_seconds(file_doc: dict, source_path: pathlib.Path) -> typing.Optional[float]:
+    """Returns the duration of the video, preferably from the stored probe result."""
+
+    probe_info = file_doc.get('video_probe')
+    if probe_info and probe_info.get('duration'):
+        return probe_info['duration']
+
+    probe = imaging.probe_video(source_path)
+    return probe.duration if probe else None
+
+
+def _run_ffmpeg(cli_args: typing.List[str], duration: typing.Optional[float],
+                report_progress: typing.Callable[[float], None]):
+    """Runs FFmpeg, reporting the encoded fraction of the video while it runs."""
+
+    import collections
+    import shlex
+    import subprocess
+
+    cmd = ' '.join(shlex.quote(arg) for arg in cli_args)
+    log.info('Calling %s', cmd)
+
+    # Keep the last lines that are not progress info, to log in case of errors.
+    other_output = collections.deque(maxlen=ERROR_OUTPUT_LINES)
+    with subprocess.Popen(cli_args,
+                          stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT,
+                          universal_newlines=True) as ffmpeg:
+        for line in ffmpeg.stdout:
+            key, sep, value = line.strip().partition('=')
+            if not sep:
+                other_output.append(line.rstrip())
+                continue
+            # Despite its name, FFmpeg reports out_time_ms in microseconds.
+            if key in {'out_time_us', 'out_time_ms'} and duration and value.isdigit():
+                report_progress(min(int(value) / 1e6 / duration, 1.0))
+
+    if ffmpeg.returncode:
+        log.error('Error running %s: stopped with return code %i', cmd, ffmpeg.returncode)
+        log.error('Output was: %s', '\n'.join(other_output))
+        raise EncodingError(f'FFmpeg stopped with return code {ffmpeg.returncode}')
+
+
+def _upload_output(bucket: Bucket, variation: dict, path: pathlib.Path) -> dict:
+    """Uploads the encoded variation, returning its properties like Zencoder reports them."""
+
+    md5 = hashlib.md5()
+    with path.open('rb') as infile:
+        for chunk in iter(lambda: infile.read(1024 * 1024), b''):
+            md5.update(chunk)
+
+    probe = imaging.probe_video(path)
+    width, height = probe.display_size if probe else (variation.get('width', 0),
+                                                       variation.get('height', 0))
+
+    blob = bucket.blob(variation['file_path'])
+    blob.upload_from_path(path, content_type=variation['content_type'])
+
+    return {'format': variation['format'],
+            'width': width,
+            'height': height,
+            'file_size_in_bytes': path.stat().st_size,
+            'md5_checksum': md5.hexdigest()}
@@ -249,6 +249,7 @@ def setup_app(app, url_prefix):
     from . import patch
     patch.setup_app(app, url_prefix=url_prefix)
 
+    app.on_pre_GET_nodes += eve_hooks.before_listing_nodes
     app.on_fetched_item_nodes += eve_hooks.before_returning_node
     app.on_fetched_resource_nodes += eve_hooks.before_returning_nodes
 
@@ -257,6 +258,7 @@ def setup_app(app, url_prefix):
     app.on_replace_nodes += eve_hooks.deduct_content_type_and_duration
     app.on_replace_nodes += eve_hooks.node_set_default_picture
     app.on_replaced_nodes += eve_hooks.after_replacing_node
+    app.on_replaced_nodes += eve_hooks.after_replacing_node_update_descendants
 
     app.on_insert_nodes += eve_hooks.before_inserting_nodes
     app.on_insert_nodes += eve_hooks.nodes_deduct_content_type_and_duration
@@ -264,7 +266,9 @@ def setup_app(app, url_prefix):
     app.on_insert_nodes += eve_hooks.textures_sort_files
     app.on_inserted_nodes += eve_hooks.after_inserting_nodes
 
+    app.on_update_nodes += eve_hooks.before_updating_node
     app.on_update_nodes += eve_hooks.texture_sort_files
+    app.on_updated_nodes += eve_hooks.after_updating_node
 
     app.on_delete_item_nodes += eve_hooks.before_deleting_node
     app.on_deleted_item_nodes += eve_hooks.after_deleting_node
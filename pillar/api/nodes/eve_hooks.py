@@ -9,9 +9,10 @@ from werkzeug import exceptions as wz_exceptions
 from pillar import current_app
 from pillar.api.activities import activity_subscribe, activity_object_add
 from pillar.api.file_storage_backends.gcs import update_file_name
+from pillar.api.nodes import hierarchy
 from pillar.api.node_types import PILLAR_NAMED_NODE_TYPES
 from pillar.api.utils import random_etag
-from pillar.api.utils.authorization import check_permissions
+from pillar.api.utils.authorization import check_permissions, node_permission_filter
 
 log = logging.getLogger(__name__)
 
@@ -26,6 +27,30 @@ def before_returning_node(node):
         node['short_link'] = short_link_info(short_code)['short_link']
 
 
+def before_listing_nodes(request, lookup: dict):
+    """Only lets listings find the nodes the current user is allowed to see.
+
+    This makes pagination and counts match what is actually returned. Lookups
+    of a single node are left alone, so that they still result in a 403
+    Forbidden rather than a 404 Not Found.
+    """
+
+    if '_id' in lookup:
+        return
+
+    permission_filter = node_permission_filter('GET')
+    if permission_filter is None:
+        return
+
+    # Eve combines the lookup with the 'where' clause of the request.
+    if lookup:
+        existing = dict(lookup)
+        lookup.clear()
+        lookup['$and'] = [existing, permission_filter]
+    else:
+        lookup.update(permission_filter)
+
+
 def before_returning_nodes(nodes):
     for node in nodes['_items']:
         before_returning_node(node)
@@ -68,6 +93,33 @@ def only_for_node_type_decorator(*required_node_type_names):
 def before_replacing_node(item, original):
     check_permissions('nodes', original, 'PUT')
     update_file_name(item)
+    hierarchy.set_ancestors(item, original)
+
+
+def after_replacing_node_update_descendants(item, original):
+    """Updates the ancestors of the node's descendants when it got a new parent."""
+
+    if item.get('parent') == original.get('parent') and '_ancestors' in original:
+        return
+    hierarchy.update_descendants(item['_id'], item['_ancestors'])
+
+
+def before_updating_node(updates, original):
+    """Sets the new ancestors when a PATCH changes the parent.
+
+    Ancestors sent by the client are always ignored.
+    """
+
+    updates.pop('_ancestors', None)
+    if 'parent' not in updates or updates['parent'] == original.get('parent'):
+        return
+    hierarchy.set_ancestors(updates)
+
+
+def after_updating_node(updates, original):
+    if '_ancestors' not in updates:
+        return
+    hierarchy.update_descendants(original['_id'], updates['_ancestors'])
 
 
 def after_replacing_node(item, original):
@@ -98,25 +150,16 @@ def before_inserting_nodes(items):
     """
     from pillar.auth import current_user
 
-    nodes_collection = current_app.data.driver.db['nodes']
-
-    def find_parent_project(node):
-        """Recursive function that finds the ultimate parent of a node."""
-        if node and 'parent' in node:
-            parent = nodes_collection.find_one({'_id': node['parent']})
-            return find_parent_project(parent)
-        if node:
-            return node
-        else:
-            return None
-
     for item in items:
         check_permissions('nodes', item, 'POST')
-        if 'parent' in item and 'project' not in item:
-            parent = nodes_collection.find_one({'_id': item['parent']})
-            project = find_parent_project(parent)
-            if project:
-                item['project'] = project['_id']
+        ancestors = hierarchy.ancestors_for_parent(item.get('parent'))
+        if ancestors is None:
+            # Non-existing parent; leave it to Eve's data_relation validation.
+            ancestors = [item['parent']]
+        elif ancestors and 'project' not in item:
+            # The top-level ancestor is the ultimate parent.
+            item['project'] = ancestors[0]
+        item['_ancestors'] = ancestors
 
         # Default the 'user' property to the current user.
         item.setdefault('user', current_user.user_id)
@@ -127,13 +170,22 @@ def get_comment_verb_and_context_object_id(comment):
     verb = 'commented'
     parent = nodes_collection.find_one({'_id': comment['parent']})
     context_object_id = comment['parent']
+
+    # Fetch all ancestors at once, instead of one query per level of replies.
+    ancestors = {}
+    if parent['node_type'] == 'comment' and parent.get('_ancestors'):
+        found = nodes_collection.find({'_id': {'$in': parent['_ancestors']}},
+                                      projection={'node_type': 1, 'parent': 1})
+        ancestors = {ancestor['_id']: ancestor for ancestor in found}
+
     while parent['node_type'] == 'comment':
         # If the parent is a comment, we provide its own parent as
         # context. We do this in order to point the user to an asset
         # or group when viewing the notification.
         verb = 'replied'
         context_object_id = parent['parent']
-        parent = nodes_collection.find_one({'_id': parent['parent']})
+        parent = ancestors.get(parent['parent']) or \
+            nodes_collection.find_one({'_id': parent['parent']})
     return verb, context_object_id
 
 
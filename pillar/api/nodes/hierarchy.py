@@ -0,0 +1,186 @@
+"""Materialised ancestor paths of nodes.
+
+Every node has an `_ancestors` list with the IDs of its ancestors, the
+top-level node first and the parent last. Top-level nodes have an empty list.
+This allows finding all ancestors or all descendants of a node with a single
+indexed query, instead of following `parent` pointers one query at a time.
+
+The list is maintained by the Eve hooks in pillar.api.nodes.eve_hooks and by
+pillar.api.nodes.moving.NodeMover. Existing databases can be updated with
+`manage.py maintenance backfill_node_ancestors`.
+"""
+
+import logging
+import typing
+
+import bson
+import pymongo
+from flask import current_app
+
+log = logging.getLogger(__name__)
+
+
+def find_ancestor_ids(node_id: bson.ObjectId) -> typing.List[bson.ObjectId]:
+    """Returns the IDs of the node's ancestors, nearest first.
+
+    Uses the stored `_ancestors` when available, and otherwise a single
+    $graphLookup aggregation instead of following the parent pointers one
+    query at a time. Does NOT check permissions.
+    """
+
+    nodes_coll = current_app.db('nodes')
+    node = nodes_coll.find_one({'_id': node_id}, projection={'_ancestors': 1})
+    if node is None:
+        return []
+    if '_ancestors' in node:
+        return list(reversed(node['_ancestors']))
+
+    agg = nodes_coll.aggregate([
+        {'$match': {'_id': node_id}},
+        {'$graphLookup': {
+            'from': 'nodes',
+            'startWith': '$parent',
+            'connectFromField': 'parent',
+            'connectToField': '_id',
+            'as': 'ancestors',
+            'depthField': 'depth',
+        }},
+        {'$project': {'ancestors._id': 1, 'ancestors.depth': 1}},
+    ])
+
+    for node in agg:
+        ancestors = sorted(node['ancestors'], key=lambda ancestor: ancestor['depth'])
+        return [ancestor['_id'] for ancestor in ancestors]
+    return []
+
+
+def ancestors_for_parent(parent_id: typing.Optional[bson.ObjectId]) \
+        -> typing.Optional[typing.List[bson.ObjectId]]:
+    """Returns the `_ancestors` list for a child of the given parent node.
+
+    :returns: the ancestors, or None if the parent node does not exist.
+    """
+
+    if not parent_id:
+        return []
+
+    nodes_coll = current_app.db('nodes')
+    parent = nodes_coll.find_one({'_id': parent_id}, projection={'_ancestors': 1, 'parent': 1})
+    if parent is None:
+        return None
+
+    if '_ancestors' in parent:
+        parent_ancestors = parent['_ancestors']
+    elif parent.get('parent'):
+        # The parent hasn't been backfilled yet.
+        parent_ancestors = list(reversed(find_ancestor_ids(parent_id)))
+    else:
+        parent_ancestors = []
+
+    return parent_ancestors + [parent_id]
+
+
+def set_ancestors(node: dict, original: typing.Optional[dict] = None) -> None:
+    """Sets node['_ancestors'] for the node's current parent.
+
+    :param original: the node as it is in the database, if it exists already.
+        Its ancestors are reused when the parent didn't change.
+    """
+
+    parent_id = node.get('parent')
+    if original is not None and original.get('parent') == parent_id \
+            and '_ancestors' in original:
+        node['_ancestors'] = original['_ancestors']
+        return
+
+    ancestors = ancestors_for_parent(parent_id)
+    if ancestors is None:
+        log.warning('Node %s refers to non-existing parent %s', node.get('_id'), parent_id)
+        ancestors = [parent_id]
+    node['_ancestors'] = ancestors
+
+
+def update_descendants(node_id: bson.ObjectId,
+                       node_ancestors: typing.List[bson.ObjectId]) -> int:
+    """Updates `_ancestors` of all descendants of the node, after it got new ancestors.
+
+    :returns: the number of updated descendants.
+    """
+
+    nodes_coll = current_app.db('nodes')
+    updates = []
+    for descendant in nodes_coll.find({'_ancestors': node_id}, projection={'_ancestors': 1}):
+        old_ancestors = descendant['_ancestors']
+        below_node = old_ancestors[old_ancestors.index(node_id):]
+        updates.append(pymongo.UpdateOne({'_id': descendant['_id']},
+                                         {'$set': {'_ancestors': node_ancestors + below_node}}))
+
+    if not updates:
+        return 0
+
+    log.debug('Updating ancestors of %d descendants of node %s', len(updates), node_id)
+    result = nodes_coll.bulk_write(updates, ordered=False)
+    return result.modified_count
+
+
+def backfill(*, go: bool) -> typing.Tuple[int, int]:
+    """Sets `_ancestors` on all nodes that are missing it.
+
+    Processes the tree top-down, one level at a time, so that every node's
+    ancestors can be computed from its parent.
+
+    :param go: when False, only counts the nodes without changing anything.
+    :returns: tuple (number of nodes missing ancestors, number of nodes updated)
+    """
+
+    nodes_coll = current_app.db('nodes')
+    missing_count = nodes_coll.count_documents({'_ancestors': {'$exists': False}})
+    if not go or not missing_count:
+        return missing_count, 0
+
+    # Top-level nodes first.
+    result = nodes_coll.update_many(
+        {'_ancestors': {'$exists': False}, 'parent': {'$exists': False}},
+        {'$set': {'_ancestors': []}})
+    updated_count = result.modified_count
+    result = nodes_coll.update_many(
+        {'_ancestors': {'$exists': False}, 'parent': None},
+        {'$set': {'_ancestors': []}})
+    updated_count += result.modified_count
+
+    # Then every level below that, as long as we make progress.
+    while True:
+        updates = []
+        # Find nodes whose parent already has its ancestors.
+        cursor = nodes_coll.aggregate([
+            {'$match': {'_ancestors': {'$exists': False}}},
+            {'$lookup': {
+                'from': 'nodes',
+                'localField': 'parent',
+                'foreignField': '_id',
+                'as': '_parent',
+            }},
+            {'$unwind': '$_parent'},
+            {'$match': {'_parent._ancestors': {'$exists': True}}},
+            {'$project': {'parent': 1, '_parent._ancestors': 1}},
+        ])
+        for node in cursor:
+            ancestors = node['_parent']['_ancestors'] + [node['parent']]
+            updates.append(pymongo.UpdateOne({'_id': node['_id']},
+                                             {'$set': {'_ancestors': ancestors}}))
+        if not updates:
+            break
+
+        result = nodes_coll.bulk_write(updates, ordered=False)
+        updated_count += result.modified_count
+        log.info('Set ancestors on %d nodes', result.modified_count)
+
+    # Whatever is left refers to non-existing parents.
+    orphans = nodes_coll.find({'_ancestors': {'$exists': False}}, projection={'parent': 1})
+    for node in orphans:
+        log.warning('Node %s refers to non-existing parent %s', node['_id'], node.get('parent'))
+        nodes_coll.update_one({'_id': node['_id']},
+                              {'$set': {'_ancestors': [node['parent']]}})
+        updated_count += 1
+
+    return missing_count, updated_count
@@ -99,12 +99,31 @@ class NodeMover(object):
         raise TypeError('File ref is of type %s, not implemented' % type(file_ref))
 
     def _children(self, node):
-        """Generator, recursively yields the node and its children."""
+        """Generator, yields the node and all its descendants.
+
+        Descendants are found through their stored ancestors, and also by
+        following the parent pointers one tree level at a time. The latter
+        finds descendants whose ancestors have not been stored (yet).
+        """
 
         yield node
 
         nodes_coll = self.db['nodes']
-        for child in nodes_coll.find({'parent': node['_id']}):
-            # "yield from self.children(child)" was introduced in Python 3.3
-            for grandchild in self._children(child):
-                yield grandchild
+        seen = {node['_id']}
+        if '_ancestors' in node:
+            for descendant in nodes_coll.find({'_ancestors': node['_id']}):
+                seen.add(descendant['_id'])
+                yield descendant
+
+        walked = {node['_id']}
+        parent_ids = [node['_id']]
+        while parent_ids:
+            children = list(nodes_coll.find({'parent': {'$in': parent_ids}}))
+            parent_ids = [child['_id'] for child in children if child['_id'] not in walked]
+            walked.update(parent_ids)
+
+            for child in children:
+                if child['_id'] in seen:
+                    continue
+                seen.add(child['_id'])
+                yield child
@@ -5,7 +5,10 @@ start with the string "org-".
 """
 
 import logging
+import threading
+import time
 import typing
+import uuid
 
 import attr
 import bson
@@ -14,6 +17,7 @@ import werkzeug.exceptions as wz_exceptions
 
 from pillar import attrs_extra, current_app
 from pillar.api.utils import remove_private_keys, utcnow
+from . import ip_ranges
 
 
 class OrganizationError(Exception):
@@ -29,6 +33,17 @@ class NotEnoughSeats(OrganizationError):
     attempted_seat_count = attr.ib(validator=attr.validators.instance_of(int))
 
 
+IPIndexState = typing.NamedTuple('IPIndexState', [
+    ('index', ip_ranges.IPRangeIndex),
+    ('generation', typing.Optional[str]),
+    ('checked_at', float),  # time.monotonic() of the last generation check
+    ('built_at', float),  # time.monotonic() of building the index
+])
+
+# Shared-cache key that changes whenever IP ranges or roles of any organization change.
+IP_INDEX_GENERATION_KEY = 'org-ip-ranges/generation'
+
+
 @attr.s
 class OrgManager:
     """Organization manager.
@@ -39,6 +54,9 @@ class OrgManager:
 
     _log = attrs_extra.log('%s.OrgManager' % __name__)
 
+    _ip_index: typing.Optional[IPIndexState] = attr.ib(default=None, init=False)
+    _ip_index_lock = attr.ib(default=attr.Factory(threading.Lock), init=False)
+
     def create_new_org(self,
                        name: str,
                        admin_uid: bson.ObjectId,
@@ -402,23 +420,75 @@ class OrgManager:
     def roles_for_ip_address(self, remote_addr: str) -> typing.Set[str]:
         """Find the roles given to the user via org IP range definitions."""
 
-        from . import ip_ranges
-
-        org_coll = current_app.db('organizations')
         try:
-            q = ip_ranges.query(remote_addr)
+            roles = self._current_ip_index().roles_for(remote_addr)
         except ValueError as ex:
             self._log.warning('Invalid remote address %s, ignoring IP-based roles: %s',
                               remote_addr, ex)
             return set()
 
-        orgs = org_coll.find(
-            {'ip_ranges': q},
-            projection={'org_roles': True},
-        )
-        return set(role
-                   for org in orgs
-                   for role in org.get('org_roles', []))
+        return set(roles)
+
+    def _current_ip_index(self) -> ip_ranges.IPRangeIndex:
+        """Returns the IP range index, rebuilding it when it is outdated.
+
+        Other processes signal changes through the generation in the shared
+        cache, which is checked at most every ORG_IP_RANGES_CHECK_INTERVAL
+        seconds. When the shared cache doesn't know the generation, the index
+        is used for at most ORG_IP_RANGES_CACHE_TIMEOUT seconds.
+        """
+
+        state = self._ip_index
+        if state is not None:
+            now = time.monotonic()
+            if now - state.checked_at < current_app.config['ORG_IP_RANGES_CHECK_INTERVAL']:
+                return state.index
+            generation = current_app.cache.get(IP_INDEX_GENERATION_KEY)
+            if generation is None:
+                # The shared cache isn't available, so fall back to a timeout.
+                is_fresh = now - state.built_at < current_app.config['ORG_IP_RANGES_CACHE_TIMEOUT']
+            else:
+                is_fresh = generation == state.generation
+            if is_fresh:
+                self._ip_index = state._replace(checked_at=now)
+                return state.index
+
+        return self.rebuild_ip_index()
+
+    def rebuild_ip_index(self) -> ip_ranges.IPRangeIndex:
+        """Builds the IP range index from the database."""
+
+        with self._ip_index_lock:
+            # Get the generation before loading, so that changes made during
+            # loading cause another rebuild.
+            current_app.cache.add(IP_INDEX_GENERATION_KEY, uuid.uuid4().hex, timeout=0)
+            generation = current_app.cache.get(IP_INDEX_GENERATION_KEY)
+
+            org_coll = current_app.db('organizations')
+            orgs = org_coll.find(
+                {'ip_ranges': {'$exists': True, '$ne': []},
+                 'org_roles': {'$exists': True, '$ne': []}},
+                projection={'ip_ranges.start': True, 'ip_ranges.end': True, 'org_roles': True},
+            )
+            index = ip_ranges.IPRangeIndex(
+                (ipr['start'], ipr['end'], org['org_roles'])
+                for org in orgs
+                for ipr in org['ip_ranges'])
+            self._log.debug('Built IP range index with %d segments', len(index))
+
+            now = time.monotonic()
+            self._ip_index = IPIndexState(index, generation, now, now)
+        return index
+
+    def invalidate_ip_index(self):
+        """Rebuilds the IP range index in all processes on their next lookup.
+
+        Call this after changing 'ip_ranges' or 'org_roles' of an organization.
+        """
+
+        with self._ip_index_lock:
+            self._ip_index = None
+        current_app.cache.set(IP_INDEX_GENERATION_KEY, uuid.uuid4().hex, timeout=0)
 
     def roles_for_request(self) -> typing.Set[str]:
         """Find roles for user via the request's remote IP address."""
@@ -442,3 +512,7 @@ def setup_app(app):
 
     hooks.setup_app(app)
     patch.setup_app(app)
+
+    @app.before_first_request
+    def build_ip_index():
+        app.org_manager.rebuild_ip_index()
@@ -1,7 +1,11 @@
 import werkzeug.exceptions as wz_exceptions
 
+from pillar import current_app
 from pillar.api.utils.authentication import current_user
 
+# Fields that determine the IP-based roles of organizations.
+IP_ROLE_FIELDS = {'ip_ranges', 'org_roles'}
+
 
 def pre_get_organizations(request, lookup):
     user = current_user()
@@ -40,9 +44,34 @@ def pre_post_organizations(request):
         raise wz_exceptions.Forbidden()
 
 
+def after_inserting_organizations(items):
+    if any(IP_ROLE_FIELDS.intersection(org_doc) for org_doc in items):
+        current_app.org_manager.invalidate_ip_index()
+
+
+def after_replacing_organization(item: dict, original: dict):
+    if any(item.get(field) != original.get(field) for field in IP_ROLE_FIELDS):
+        current_app.org_manager.invalidate_ip_index()
+
+
+def after_updating_organization(updates: dict, original: dict):
+    if IP_ROLE_FIELDS.intersection(updates):
+        current_app.org_manager.invalidate_ip_index()
+
+
+def after_deleting_organization(item: dict):
+    if item.get('ip_ranges'):
+        current_app.org_manager.invalidate_ip_index()
+
+
 def setup_app(app):
     app.on_pre_GET_organizations += pre_get_organizations
     app.on_pre_POST_organizations += pre_post_organizations
 
     app.on_fetched_item_organizations += on_fetched_item_organizations
     app.on_fetched_resource_organizations += on_fetched_resource_organizations
+
+    app.on_inserted_organizations += after_inserting_organizations
+    app.on_replaced_organizations += after_replacing_organization
+    app.on_updated_organizations += after_updating_organization
+    app.on_deleted_item_organizations += after_deleting_organization
@@ -1,5 +1,9 @@
 """IP range support for Organizations."""
 
+import bisect
+import collections
+import typing
+
 from IPy import IP
 
 # 128 bits all set to 1
@@ -64,12 +68,79 @@ def query(address: str) -> dict:
         {$elemMatch: {'start': {$lte: b'xxxxx'}, 'end': {$gte: b'xxxxx'}}}
     """
 
-    ip = IP(address)
-    if ip.version() == 4:
-        ip = ip.v46map()
-    for_mongo = ip.ip.to_bytes(16, 'big')
+    for_mongo = address_int(address).to_bytes(16, 'big')
 
     return {'$elemMatch': {
         'start': {'$lte': for_mongo},
         'end': {'$gte': for_mongo},
     }}
+
+
+def address_int(address: str) -> int:
+    """Return the address as 128-bit integer, with IPv4 mapped to IPv6.
+
+    :raises ValueError: when the address is invalid.
+    """
+
+    ip = IP(address)
+    if ip.version() == 4:
+        ip = ip.v46map()
+    return ip.int()
+
+
+class IPRangeIndex:
+    """Maps IP addresses to the roles of all ranges containing them.
+
+    The (possibly overlapping) ranges are split into consecutive segments,
+    each with the union of the roles of the ranges covering it, so that a
+    lookup is a binary search over the segment start addresses.
+    """
+
+    def __init__(self, ranges: typing.Iterable[typing.Tuple[bytes, bytes, typing.Iterable[str]]]):
+        """Build the index.
+
+        :param ranges: (start, end, roles) tuples, with start and end as
+            stored in the database by doc().
+        """
+
+        # Per address, the role counts that change there.
+        deltas = collections.defaultdict(collections.Counter)
+        for start, end, roles in ranges:
+            roles = set(roles)
+            start_int = int.from_bytes(start, 'big')
+            end_int = int.from_bytes(end, 'big')
+            if not roles or end_int < start_int:
+                continue
+            deltas[start_int].update(roles)
+            deltas[end_int + 1].subtract(roles)
+
+        self._starts: typing.List[int] = []
+        self._roles: typing.List[typing.FrozenSet[str]] = []
+
+        interned: typing.Dict[typing.FrozenSet[str], typing.FrozenSet[str]] = {}
+        active = collections.Counter()
+        for address in sorted(deltas):
+            active.update(deltas[address])
+            active = +active  # drops the roles that are no longer active
+            roles = frozenset(active)
+            if self._roles and self._roles[-1] == roles:
+                continue
+            self._starts.append(address)
+            self._roles.append(interned.setdefault(roles, roles))
+
+    def __len__(self) -> int:
+        """Return the number of segments."""
+        return len(self._starts)
+
+    def roles_for_int(self, address: int) -> typing.FrozenSet[str]:
+        idx = bisect.bisect_right(self._starts, address) - 1
+        if idx < 0:
+            return frozenset()
+        return self._roles[idx]
+
+    def roles_for(self, address: str) -> typing.FrozenSet[str]:
+        """Return the roles for the given IPv4 or IPv6 address.
+
+        :raises ValueError: when the address is invalid.
+        """
+        return self.roles_for_int(address_int(address))
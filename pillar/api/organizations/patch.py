@@ -216,6 +216,9 @@ class OrganizationPatchHandler(patch_handler.AbstractPatchHandler):
                              current_user_id, org_id, result.matched_count)
             raise wz_exceptions.BadRequest()
 
+        # IP ranges are always set or unset by this operation.
+        current_app.org_manager.invalidate_ip_index()
+
         if refresh_user_roles:
             self.log.info('Organization roles set for org %s, refreshing users', org_id)
             current_app.org_manager.refresh_all_user_roles(org_id)
@@ -63,6 +63,11 @@ def before_edit_check_permissions(document, original):
     check_permissions('projects', original, request.method)
 
 
+def after_edit_invalidate_permissions(document, original):
+    """Makes sure the cached permission tables of the project are recomputed."""
+    authorization.invalidate_project_permissions(original['_id'])
+
+
 def before_delete_project(document):
     """Checks permissions before we allow deletion"""
 
@@ -76,6 +81,7 @@ def after_delete_project(project: dict):
     from eve.methods.delete import delete
 
     pid = project['_id']
+    authorization.invalidate_project_permissions(pid)
     log.info('Project %s was deleted, also deleting its files.', pid)
 
     try:
@@ -203,6 +209,11 @@ def after_inserting_project(project, db_user):
         log.error('Unable to update project %s: %s', project_id, result.raw_result)
         abort_with_error(500)
 
+    # The etag isn't changed here, as the client got it in the POST response.
+    # The project was only just created, so only this process can have cached
+    # its permissions before they were set here.
+    authorization.invalidate_project_permissions(project_id)
+
 
 def before_returning_project_permissions(response):
     # Run validation process, since GET on nodes entry point is public
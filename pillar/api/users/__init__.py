@@ -3,6 +3,7 @@ import logging
 import bson
 from flask import current_app
 
+from pillar.api.utils import token_cache
 from . import hooks
 from .routes import blueprint_api
 
@@ -53,12 +54,18 @@ def user_group_action(user_id: bson.ObjectId, group_id: bson.ObjectId, action: s
         raise ValueError(f'Unable to {action} user {user_id} membership of group {group_id}; '
                          f'user not found.')
 
+    token_cache.invalidate_user(user_id)
+
 
 def _update_search_user_changed_role(sender, user: dict):
     log.debug('Sending updated user %s to Algolia due to role change', user['_id'])
     hooks.push_updated_user_to_search(user, original=None)
 
 
+def _invalidate_cached_tokens(sender, user: dict):
+    token_cache.invalidate_user(user['_id'])
+
+
 def setup_app(app, api_prefix):
     from pillar.api import service
     from . import patch
@@ -71,6 +78,8 @@ def setup_app(app, api_prefix):
     app.on_pre_PUT_users += hooks.before_replacing_user
     app.on_replaced_users += hooks.push_updated_user_to_search
     app.on_replaced_users += hooks.send_blinker_signal_roles_changed
+    app.on_replaced_users += hooks.invalidate_cached_tokens
+    app.on_updated_users += hooks.invalidate_cached_tokens
     app.on_fetched_item_users += hooks.after_fetching_user
     app.on_fetched_resource_users += hooks.after_fetching_user_resource
 
@@ -80,3 +89,4 @@ def setup_app(app, api_prefix):
     app.register_api_blueprint(blueprint_api, url_prefix=api_prefix)
 
     service.signal_user_changed_role.connect(_update_search_user_changed_role)
+    service.signal_user_changed_role.connect(_invalidate_cached_tokens)
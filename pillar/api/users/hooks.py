@@ -75,6 +75,14 @@ def push_updated_user_to_search(user, original):
     searchindex.updated_user.delay(str(user['_id']))
 
 
+def invalidate_cached_tokens(user, original):
+    """Removes the user's tokens from the token cache, so that the change is seen."""
+
+    from pillar.api.utils import token_cache
+
+    token_cache.invalidate_user(original.get('_id') or user.get('_id'))
+
+
 def send_blinker_signal_roles_changed(user, original):
     """
     Sends a Blinker signal that the user roles were
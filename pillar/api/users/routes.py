@@ -6,6 +6,7 @@ import werkzeug.exceptions as wz_exceptions
 
 from pillar import current_app
 from pillar.api import utils
+from pillar.api.utils import token_cache
 from pillar.api.utils.authorization import require_login
 from pillar.auth import current_user
 
@@ -140,5 +141,6 @@ def set_video_progress(video_id: str):
     if result.matched_count == 0:
         my_log.error('Current user %r could not be updated', current_user.user_id)
         raise wz_exceptions.InternalServerError('Unable to find logged-in user')
+    token_cache.invalidate_user(current_user.user_id)
 
     return '', 204
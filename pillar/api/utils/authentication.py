@@ -18,9 +18,13 @@ from flask import request
 from werkzeug import exceptions as wz_exceptions
 
 from pillar.api.utils import remove_private_keys, utcnow
+from pillar.api.utils import token_cache
 
 log = logging.getLogger(__name__)
 
+# Expired tokens are deleted by MongoDB this long after they expired.
+EXPIRED_TOKEN_GRACE_PERIOD = datetime.timedelta(days=7)
+
 # Construction is done when requested, since constructing a UserClass instance
 # requires an application context to look up capabilities. We set the initial
 # value to a not-None singleton to be able to differentiate between
@@ -164,7 +168,33 @@ def validate_this_token(token, oauth_subclient=None):
     from pillar.auth import UserClass, AnonymousUser, user_authenticated
 
     g.current_user = None
-    _delete_expired_tokens()
+
+    # The cache is keyed on the hashed token, so it never contains actual tokens.
+    token_hashed = hash_auth_token(token)
+    is_subclient_token = bool(oauth_subclient)
+    db_user = token_cache.get(token_hashed, is_subclient_token)
+    if db_user is not None:
+        log.debug('Token found in cache, user %s', db_user['_id'])
+    else:
+        db_user = _find_user_for_token(token, token_hashed, oauth_subclient)
+
+    if db_user is None:
+        log.debug('Validation failed, user not logged in')
+        g.current_user = AnonymousUser()
+        return None
+
+    g.current_user = UserClass.construct(token, db_user)
+    user_authenticated.send(g.current_user)
+
+    return db_user
+
+
+def _find_user_for_token(token: str, token_hashed: str, oauth_subclient) \
+        -> typing.Optional[dict]:
+    """Finds the user for this token in our database or at Blender ID.
+
+    Users found in our database are stored in the token cache.
+    """
 
     # Check the users to see if there is one with this Blender ID token.
     db_token = find_token(token, oauth_subclient)
@@ -178,19 +208,13 @@ def validate_this_token(token, oauth_subclient=None):
         from pillar.api import blender_id
 
         db_user, status = blender_id.validate_create_user('', token, oauth_subclient)
-    else:
-        # log.debug("User is already in our database and token hasn't expired yet.")
-        users = current_app.data.driver.db['users']
-        db_user = users.find_one(db_token['user'])
-
-    if db_user is None:
-        log.debug('Validation failed, user not logged in')
-        g.current_user = AnonymousUser()
-        return None
-
-    g.current_user = UserClass.construct(token, db_user)
-    user_authenticated.send(g.current_user)
+        return db_user
 
+    # log.debug("User is already in our database and token hasn't expired yet.")
+    users = current_app.data.driver.db['users']
+    db_user = users.find_one(db_token['user'])
+    if db_user is not None:
+        token_cache.put(token_hashed, bool(oauth_subclient), db_token['expire_time'], db_user)
     return db_user
 
 
@@ -205,6 +229,8 @@ def remove_token(token: str):
     del_res = tokens_coll.delete_many(lookup)
     log.debug('Removed token %r, matched %d documents', token, del_res.deleted_count)
 
+    token_cache.invalidate_token(token_hashed)
+
 
 def find_token(token, is_subclient_token=False, **extra_filters):
     """Returns the token document, or None if it doesn't exist (or is expired)."""
@@ -337,19 +363,42 @@ def make_unique_username(email):
         suffix += 1
 
 
-def _delete_expired_tokens():
-    """Deletes tokens that have expired.
+def create_token_expiry_index(tokens_coll, *, replace_existing=False) -> bool:
+    """Creates the TTL index that lets MongoDB delete expired tokens.
 
     For debugging, we keep expired tokens around for a few days, so that we
     can determine that a token was expired rather than not created in the
     first place. It also grants some leeway in clock synchronisation.
-    """
 
-    token_coll = current_app.data.driver.db['tokens']
+    :param replace_existing: replace an existing index on 'expire_time' that
+        has different options. Without this, such an index is left alone.
+    :returns: whether the TTL index exists now.
+    """
+    import pymongo.errors
+
+    expire_after = int(EXPIRED_TOKEN_GRACE_PERIOD.total_seconds())
+    key = [('expire_time', pymongo.ASCENDING)]
+
+    try:
+        tokens_coll.create_index(key, expireAfterSeconds=expire_after)
+        return True
+    except pymongo.errors.OperationFailure as ex:
+        # 85 = IndexOptionsConflict, 86 = IndexKeySpecsConflict
+        if ex.code not in {85, 86}:
+            raise
+
+    if not replace_existing:
+        log.warning('Another index on %s.expire_time exists, expired tokens will not be '
+                    'deleted; run "manage.py maintenance create_token_expiry_index"',
+                    tokens_coll.name)
+        return False
 
-    expiry_date = utcnow() - datetime.timedelta(days=7)
-    result = token_coll.delete_many({'expire_time': {"$lt": expiry_date}})
-    # log.debug('Deleted %i expired authentication tokens', result.deleted_count)
+    for index in tokens_coll.list_indexes():
+        if dict(index['key']) == {'expire_time': pymongo.ASCENDING}:
+            log.info('Dropping index %r on %s', index['name'], tokens_coll.name)
+            tokens_coll.drop_index(index['name'])
+    tokens_coll.create_index(key, expireAfterSeconds=expire_after)
+    return True
 
 
 def current_user_id() -> typing.Optional[bson.ObjectId]:
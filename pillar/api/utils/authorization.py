@@ -1,5 +1,6 @@
 import logging
 import functools
+import time
 import typing
 
 from bson import ObjectId
@@ -10,6 +11,9 @@ from werkzeug.exceptions import Forbidden
 
 CHECK_PERMISSIONS_IMPLEMENTED_FOR = {'projects', 'nodes', 'flamenco_jobs'}
 
+# How long the project etags are kept in the shared cache, in seconds.
+PROJECT_ETAG_CACHE_TIMEOUT = 24 * 3600
+
 log = logging.getLogger(__name__)
 
 
@@ -63,6 +67,10 @@ def compute_allowed_methods(collection_name, resource, check_node_type=None):
     if check_node_type is not None and collection_name != 'projects':
         raise ValueError('check_node_type parameter is only valid for checking projects.')
 
+    if collection_name == 'nodes' and 'node_type' in resource \
+            and not isinstance(resource.get('project'), dict):
+        return _compute_allowed_methods_for_node(resource)
+
     computed_permissions = compute_aggr_permissions(collection_name, resource, check_node_type)
 
     if not computed_permissions:
@@ -95,6 +103,32 @@ def compute_allowed_methods(collection_name, resource, check_node_type=None):
     return allowed_methods
 
 
+def _compute_allowed_methods_for_node(node: dict) -> typing.Set[str]:
+    """Computes the allowed methods on a node from the compiled permission tables.
+
+    The permissions of the node's project and node type are compiled once
+    and cached (see _project_node_type_entry()), so this only needs to look
+    at the node's own permissions.
+    """
+
+    import pillar.auth
+
+    entry = _project_node_type_entry(node['project'], node['node_type'])
+    if entry is None:
+        log.warning('Resource %s from "nodes" refers to a project that does not exist.',
+                    node['_id'])
+        raise Forbidden()
+
+    user = pillar.auth.get_current_user()
+    allowed_methods = entry.table.allowed_methods(user)
+
+    node_permissions = node.get('permissions')
+    if node_permissions:
+        allowed_methods |= PermissionTable.compile(node_permissions).allowed_methods(user)
+
+    return allowed_methods
+
+
 def has_permissions(collection_name: str, resource: dict, method: str,
                     append_allowed_methods=False,
                     check_node_type: typing.Optional[str] = None):
@@ -192,30 +226,284 @@ def compute_aggr_permissions(collection_name, resource, check_node_type=None):
     return merge_permissions(project_permissions, node_type_permissions, node_permissions)
 
 
-def _find_project_node_type(project_id, node_type_name):
-    """Returns the project with just the one named node type."""
+class PermissionTable(typing.NamedTuple):
+    """Permissions compiled for quick lookup of the allowed methods."""
+
+    groups: typing.Mapping[ObjectId, typing.FrozenSet[str]]
+    users: typing.Mapping[ObjectId, typing.FrozenSet[str]]
+    world: typing.FrozenSet[str]
+    # Methods granted to any group or user, which are all granted to admins.
+    any_methods: typing.FrozenSet[str]
+
+    @classmethod
+    def compile(cls, permissions: dict) -> 'PermissionTable':
+        """Compiles a {'groups': ..., 'users': ..., 'world': ...} permissions dict."""
+
+        def by_key(plural_name: str, field_name: str) -> dict:
+            compiled = {}
+            for permission in permissions.get(plural_name, ()):
+                key = permission.get(field_name)
+                if key is None:
+                    continue
+                compiled[key] = compiled.get(key, frozenset()) | frozenset(permission['methods'])
+            return compiled
+
+        groups = by_key('groups', 'group')
+        users = by_key('users', 'user')
+        any_methods = frozenset().union(*groups.values(), *users.values())
+        return cls(groups=groups,
+                   users=users,
+                   world=frozenset(permissions.get('world', ())),
+                   any_methods=any_methods)
+
+    def allowed_methods(self, user) -> typing.Set[str]:
+        """Returns the methods allowed for the user, like compute_allowed_methods()."""
+
+        allowed_methods = set(self.world)
+        if not user.is_authenticated:
+            return allowed_methods
+
+        if is_admin(user):
+            allowed_methods.update(self.any_methods)
+            return allowed_methods
+
+        for group_id in user.group_ids:
+            allowed_methods.update(self.groups.get(group_id, ()))
+        allowed_methods.update(self.users.get(user.user_id, ()))
+        return allowed_methods
+
+
+class _ProjectNodeTypeEntry(typing.NamedTuple):
+    project: dict  # the project with just one node type, see _find_project_node_type()
+    table: PermissionTable  # merged project and node type permissions
+    loaded_at: float  # time.monotonic() timestamp
+
+
+# Process-wide cache, mapping (project ID, node type name) to _ProjectNodeTypeEntry.
+_project_node_type_cache: typing.Dict[typing.Tuple[ObjectId, str], _ProjectNodeTypeEntry] = {}
+
+
+def _project_etag_cache_key(project_id) -> str:
+    return f'project-etag/{project_id}'
+
+
+def _current_project_etag(project_id: ObjectId) -> typing.Optional[str]:
+    """Returns the project etag as known in the shared cache, or None if not known.
+
+    The result is memoised for the remainder of the request.
+    """
+
+    etags = g.get('_current_project_etags')
+    if etags is None:
+        etags = g._current_project_etags = {}
+
+    try:
+        return etags[project_id]
+    except KeyError:
+        pass
+
+    etag = current_app.cache.get(_project_etag_cache_key(project_id))
+    etags[project_id] = etag
+    return etag
+
+
+def _is_fresh(entry: _ProjectNodeTypeEntry, project_id: ObjectId) -> bool:
+    current_etag = _current_project_etag(project_id)
+    if current_etag is not None:
+        return current_etag == entry.project.get('_etag')
+
+    # The shared cache doesn't know the project (yet), so fall back to a timeout.
+    timeout = current_app.config['PROJECT_PERMISSIONS_CACHE_TIMEOUT']
+    return time.monotonic() - entry.loaded_at < timeout
+
+
+def _project_node_type_entry(project_id, node_type_name: str) \
+        -> typing.Optional[_ProjectNodeTypeEntry]:
+    """Returns the project with just the one named node type, and its compiled permissions.
+
+    The result is cached per request, and when PROJECT_PERMISSIONS_CACHE_TIMEOUT
+    is set, also in a process-wide cache. That cache is invalidated by the
+    project's etag; see invalidate_project_permissions().
+
+    :returns: the entry, or None if the project does not exist.
+    """
+
+    project_id = ObjectId(project_id)
+    key = (project_id, node_type_name)
 
     # Cache result per request, as many nodes of the same project can be checked.
-    cache = g.get('_find_project_node_type_cache')
-    if cache is None:
-        cache = g._find_project_node_type_cache = {}
+    request_cache = g.get('_find_project_node_type_cache')
+    if request_cache is None:
+        request_cache = g._find_project_node_type_cache = {}
 
     try:
-        return cache[(project_id, node_type_name)]
+        return request_cache[key]
     except KeyError:
         pass
 
+    use_process_cache = current_app.config.get('PROJECT_PERMISSIONS_CACHE_TIMEOUT', 0) > 0
+    entry = _project_node_type_cache.get(key) if use_process_cache else None
+    if entry is None or not _is_fresh(entry, project_id):
+        entry = _load_project_node_type_entry(project_id, node_type_name)
+        if use_process_cache and entry is not None:
+            _project_node_type_cache[key] = entry
+
+    request_cache[key] = entry
+    return entry
+
+
+def _load_project_node_type_entry(project_id: ObjectId, node_type_name: str) \
+        -> typing.Optional[_ProjectNodeTypeEntry]:
     projects_collection = current_app.data.driver.db['projects']
     project = projects_collection.find_one(
-        ObjectId(project_id),
+        project_id,
         {'permissions': 1,
+         '_etag': 1,
          'node_types': {'$elemMatch': {'name': node_type_name}},
          'node_types.name': 1,
          'node_types.permissions': 1})
+    if project is None:
+        return None
+
+    node_types = project.get('node_types') or [{}]
+    table = PermissionTable.compile(merge_permissions(
+        project.get('permissions', {}), node_types[0].get('permissions', {})))
+
+    if project.get('_etag'):
+        # Let other processes know which version of the project we're caching;
+        # doesn't overwrite the etag of a more recent modification.
+        current_app.cache.add(_project_etag_cache_key(project_id), project['_etag'],
+                              timeout=PROJECT_ETAG_CACHE_TIMEOUT)
+
+    return _ProjectNodeTypeEntry(project=project, table=table, loaded_at=time.monotonic())
 
-    cache[(project_id, node_type_name)] = project
 
-    return project
+def _permission_table(project: dict, node_type: typing.Optional[dict]) -> PermissionTable:
+    """Returns the compiled permissions of the project and node type.
+
+    Uses the process-wide cache of _project_node_type_entry() when its entry
+    has the same etag as the given project, and stores a newly compiled table
+    in it otherwise. The project permissions without any node type are
+    cached under the node type name ''.
+
+    :param project: project with its '_etag', 'permissions' and 'node_types'.
+    :param node_type: one of the project's node types, or None for just the
+        project permissions.
+    """
+
+    node_type = node_type or {}
+    key = (project['_id'], node_type.get('name', ''))
+
+    use_process_cache = current_app.config.get('PROJECT_PERMISSIONS_CACHE_TIMEOUT', 0) > 0
+    entry = _project_node_type_cache.get(key) if use_process_cache else None
+    if entry is not None and project.get('_etag') \
+            and entry.project.get('_etag') == project['_etag']:
+        return entry.table
+
+    table = PermissionTable.compile(merge_permissions(
+        project.get('permissions', {}), node_type.get('permissions', {})))
+    if use_process_cache:
+        entry_project = {'_id': project['_id'],
+                         '_etag': project.get('_etag'),
+                         'permissions': project.get('permissions', {}),
+                         'node_types': [node_type] if node_type else []}
+        _project_node_type_cache[key] = _ProjectNodeTypeEntry(
+            project=entry_project, table=table, loaded_at=time.monotonic())
+    return table
+
+
+def invalidate_project_permissions(project_id) -> None:
+    """Removes the project's compiled permissions from the cache.
+
+    Also stores the project's new etag in the shared cache, so that other
+    processes know that their cached permissions are outdated.
+    """
+
+    project_id = ObjectId(project_id)
+    for key in [key for key in _project_node_type_cache if key[0] == project_id]:
+        _project_node_type_cache.pop(key, None)
+
+    request_cache = g.get('_find_project_node_type_cache')
+    if request_cache:
+        for key in [key for key in request_cache if key[0] == project_id]:
+            del request_cache[key]
+
+    etags = g.get('_current_project_etags')
+    if etags:
+        etags.pop(project_id, None)
+
+    projects_collection = current_app.data.driver.db['projects']
+    project = projects_collection.find_one(project_id, {'_etag': 1})
+    cache_key = _project_etag_cache_key(project_id)
+    if project and project.get('_etag'):
+        current_app.cache.set(cache_key, project['_etag'], timeout=PROJECT_ETAG_CACHE_TIMEOUT)
+    else:
+        current_app.cache.delete(cache_key)
+
+
+def node_permission_filter(method: str = 'GET', user=None) -> typing.Optional[dict]:
+    """Returns a MongoDB filter that matches the nodes the user has 'method' access to.
+
+    Matches the same nodes as has_permissions('nodes', node, method) does,
+    taking project, node type and node permissions into account. The
+    projects that grant access are found with one query.
+
+    :returns: the filter, or None when no filtering is needed (CLI user).
+    """
+
+    import pillar.auth
+    from .authentication import CLI_USER
+
+    if user is None:
+        user = pillar.auth.get_current_user()
+    if user is CLI_USER:
+        return None
+
+    def grants(prefix: str) -> typing.List[dict]:
+        """Returns conditions for permissions at 'prefix' granting access to the user."""
+        conditions = [{f'{prefix}.world': method}]
+        if not user.is_authenticated:
+            return conditions
+
+        if is_admin(user):
+            # Admins get all methods granted to any group or user.
+            group_match = user_match = {}
+        else:
+            group_match = {'group': {'$in': list(user.group_ids)}}
+            user_match = {'user': user.user_id}
+        conditions.append({f'{prefix}.groups': {'$elemMatch': {**group_match, 'methods': method}}})
+        conditions.append({f'{prefix}.users': {'$elemMatch': {**user_match, 'methods': method}}})
+        return conditions
+
+    projects_coll = current_app.db('projects')
+    projects = projects_coll.find(
+        {'$or': grants('permissions') + grants('node_types.permissions'),
+         '_deleted': {'$ne': True}},
+        {'permissions': 1, '_etag': 1, 'node_types.name': 1, 'node_types.permissions': 1})
+
+    all_node_types_of = []
+    node_types_of: typing.Dict[ObjectId, typing.List[str]] = {}
+    for project in projects:
+        if method in _permission_table(project, None).allowed_methods(user):
+            all_node_types_of.append(project['_id'])
+            continue
+        node_types_of[project['_id']] = [
+            node_type['name'] for node_type in project.get('node_types', ())
+            if method in _permission_table(project, node_type).allowed_methods(user)]
+
+    visible = [{'project': {'$in': all_node_types_of}}]
+    visible.extend({'project': project_id, 'node_type': {'$in': node_type_names}}
+                   for project_id, node_type_names in node_types_of.items()
+                   if node_type_names)
+    visible.extend(grants('permissions'))
+    return {'$or': visible}
+
+
+def _find_project_node_type(project_id, node_type_name):
+    """Returns the project with just the one named node type."""
+
+    entry = _project_node_type_entry(project_id, node_type_name)
+    return entry.project if entry is not None else None
 
 
 def merge_permissions(*args):
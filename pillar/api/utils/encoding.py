@@ -12,12 +12,20 @@ class Encoder:
     """
 
     @staticmethod
-    def job_create(src_file):
+    def job_create(src_file, file_id=None):
         """Create an encoding job. Return the backend used as well as an id.
         """
+        if current_app.config['ENCODING_BACKEND'] == 'local':
+            from pillar.api import local_encoding
+
+            if file_id is None:
+                log.error('Unable to create local encoding job without file ID')
+                return None
+            return local_encoding.create_job(file_id)
+
         if current_app.config['ENCODING_BACKEND'] != 'zencoder' or \
                         current_app.encoding_service_client is None:
-            log.error('I can only work with Zencoder, check the config file.')
+            log.error('I can only work with Zencoder or local encoding, check the config file.')
             return None
 
         if src_file['backend'] != 'gcs':
@@ -48,6 +56,10 @@ class Encoder:
 
     @staticmethod
     def job_progress(job_id):
+        if current_app.config['ENCODING_BACKEND'] == 'local':
+            from pillar.api import local_encoding
+            return local_encoding.job_progress(job_id)
+
         from zencoder import Zencoder
 
         if isinstance(current_app.encoding_service_client, Zencoder):
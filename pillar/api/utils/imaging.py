@@ -1,4 +1,7 @@
+import functools
 import json
+import logging
+import shlex
 import typing
 
 import os
@@ -8,45 +11,88 @@ import subprocess
 from PIL import Image
 from flask import current_app
 
+log = logging.getLogger(__name__)
+
 # Images with these modes will be thumbed to PNG, others to JPEG.
 MODES_FOR_PNG = {'RGBA', 'LA'}
 
 
+# Thumbnails are resampled from an earlier, larger thumbnail instead of the
+# original when that is at least this many times larger than the thumbnail.
+# At this factor the difference with resampling from the original is smaller
+# than JPEG compression artefacts.
+CASCADE_MIN_FACTOR = 2
+
+Size = typing.Tuple[int, int]
+Box = typing.Tuple[int, int, int, int]
+
+
 def generate_local_thumbnails(fp_base: str, src: pathlib.Path):
     """Given a source image, use Pillow to generate thumbnails according to the
     application settings.
 
+    The source image is decoded only once; for JPEG images at a reduced
+    resolution when all thumbnails are small enough. The thumbnails are
+    produced from large to small, each resampled from the smallest earlier
+    result that is at least CASCADE_MIN_FACTOR times as large.
+
     :param fp_base: the thumbnail will get a field
         'file_path': '{fp_base}-{thumbsize}.{ext}'
     :param src: the path of the image to be thumbnailed
     """
 
     thumbnail_settings = current_app.config['UPLOADS_LOCAL_STORAGE_THUMBNAILS']
-    thumbnails = []
 
-    for size, settings in thumbnail_settings.items():
-        im = Image.open(src)
-        extra_args = {}
+    im = Image.open(src)
+    extra_args = {}
 
-        # If the source image has transparency, save as PNG
-        if im.mode in MODES_FOR_PNG:
-            suffix = '.png'
-            imformat = 'PNG'
-        else:
-            suffix = '.jpg'
-            imformat = 'JPEG'
-            extra_args = {'quality': 95}
-        dst = src.with_name(f'{src.stem}-{size}{suffix}')
+    # If the source image has transparency, save as PNG
+    if im.mode in MODES_FOR_PNG:
+        suffix = '.png'
+        imformat = 'PNG'
+    else:
+        suffix = '.jpg'
+        imformat = 'JPEG'
+        extra_args = {'quality': 95}
 
+    # Per thumbnail size, the size to resample to and the box to crop afterwards.
+    plans: typing.Dict[str, typing.Tuple[Size, typing.Optional[Box]]] = {}
+    for size, settings in thumbnail_settings.items():
         if settings['crop']:
-            im = resize_and_crop(im, settings['size'])
+            plans[size] = crop_sizes(im.size, settings['size'])
         else:
-            im.thumbnail(settings['size'], resample=Image.LANCZOS)
-        width, height = im.size
+            plans[size] = (thumbnail_size(im.size, settings['size']), None)
+
+    # Let the JPEG decoder downscale, as long as it stays large enough for all thumbnails.
+    im.draft(im.mode, (max(resized[0] for resized, _ in plans.values()),
+                       max(resized[1] for resized, _ in plans.values())))
+    im.load()
+
+    def area(plan: typing.Tuple[Size, typing.Optional[Box]]) -> int:
+        resized, _ = plan
+        return resized[0] * resized[1]
+
+    # Sources to resample from, smallest first.
+    resampled: typing.List[Image.Image] = [im]
+    thumb_images: typing.Dict[str, Image.Image] = {}
+    for size, (resized, box) in sorted(plans.items(), key=lambda item: area(item[1]),
+                                       reverse=True):
+        thumb = _resample_from_smallest(resampled, resized)
+        if thumb.size != resampled[0].size:
+            resampled.insert(0, thumb)
+        if box is not None:
+            thumb = thumb.crop(box)
+        thumb_images[size] = thumb
+
+    thumbnails = []
+    for size in thumbnail_settings:
+        thumb = thumb_images[size]
+        dst = src.with_name(f'{src.stem}-{size}{suffix}')
+        width, height = thumb.size
 
         if imformat == 'JPEG':
-            im = im.convert('RGB')
-        im.save(dst, format=imformat, optimize=True, **extra_args)
+            thumb = thumb.convert('RGB')
+        thumb.save(dst, format=imformat, optimize=True, **extra_args)
 
         thumb_info = {'size': size,
                       'file_path': f'{fp_base}-{size}{suffix}',
@@ -65,17 +111,53 @@ def generate_local_thumbnails(fp_base: str, src: pathlib.Path):
     return thumbnails
 
 
-def resize_and_crop(img: Image, size: typing.Tuple[int, int]) -> Image:
-    """Resize and crop an image to fit the specified size.
+def _resample_from_smallest(sources: typing.List[Image.Image], size: Size) -> Image.Image:
+    """Resample the smallest source that is large enough to the given size.
 
-    Thanks to: https://gist.github.com/sigilioso/2957026
+    :param sources: images to choose from, smallest first. The last one is
+        the original image, which is used when none of the others is large
+        enough.
+    """
 
-    :param img: opened PIL.Image to work on
-    :param size: `(width, height)` tuple.
+    for source in sources:
+        if source.size == size:
+            return source
+        width, height = source.size
+        if width >= CASCADE_MIN_FACTOR * size[0] and height >= CASCADE_MIN_FACTOR * size[1]:
+            break
+    else:
+        source = sources[-1]
+
+    if source.size == size:
+        return source
+    return source.resize(size, Image.LANCZOS)
+
+
+def thumbnail_size(img_size: Size, max_size: Size) -> Size:
+    """Compute the size Image.thumbnail() would produce.
+
+    Keeps the aspect ratio and never enlarges the image.
+    """
+    x, y = img_size
+    if x > max_size[0]:
+        y = int(max(y * max_size[0] / x, 1))
+        x = int(max_size[0])
+    if y > max_size[1]:
+        x = int(max(x * max_size[1] / y, 1))
+        y = int(max_size[1])
+    return x, y
+
+
+def crop_sizes(img_size: Size, size: Size) -> typing.Tuple[Size, Box]:
+    """Compute how resize_and_crop() resizes and crops an image.
+
+    :param img_size: `(width, height)` of the image to work on.
+    :param size: `(width, height)` of the result.
+    :returns: the size to resize to, and the box to crop from the resized image.
     """
     # If height is higher we resize vertically, if not we resize horizontally
     # Get current and desired ratio for the images
-    cur_w, cur_h = img.size  # current
+    cur_w, cur_h = img_size  # current
     img_ratio = cur_w / cur_h
 
     w, h = size  # desired
@@ -84,87 +166,219 @@ def resize_and_crop(img: Image, size: typing.Tuple[int, int]) -> Image:
     # The image is scaled/cropped vertically or horizontally depending on the ratio
     if ratio > img_ratio:
         uncropped_h = (w * cur_h) // cur_w
-        img = img.resize((w, uncropped_h), Image.ANTIALIAS)
-        box = (0, (uncropped_h - h) // 2,
-               w, (uncropped_h + h) // 2)
-        img = img.crop(box)
-    elif ratio < img_ratio:
+        return (w, uncropped_h), (0, (uncropped_h - h) // 2,
+                                  w, (uncropped_h + h) // 2)
+    if ratio < img_ratio:
         uncropped_w = (h * cur_w) // cur_h
-        img = img.resize((uncropped_w, h), Image.ANTIALIAS)
-        box = ((uncropped_w - w) // 2, 0,
-               (uncropped_w + w) // 2, h)
-        img = img.crop(box)
-    else:
-        img = img.resize((w, h), Image.ANTIALIAS)
+        return (uncropped_w, h), ((uncropped_w - w) // 2, 0,
+                                  (uncropped_w + w) // 2, h)
+    return (w, h), (0, 0, w, h)
+
+
+def resize_and_crop(img: Image, size: typing.Tuple[int, int]) -> Image:
+    """Resize and crop an image to fit the specified size.
+
+    Thanks to: https://gist.github.com/sigilioso/2957026
+
+    :param img: opened PIL.Image to work on
+    :param size: `(width, height)` tuple.
+    """
+    resized, box = crop_sizes(img.size, size)
+    img = img.resize(resized, Image.ANTIALIAS)
 
     # If the scale is the same, we do not need to crop
-    return img
+    if box == (0, 0) + resized:
+        return img
+    return img.crop(box)
 
 
-def get_video_data(filepath):
-    """Return video duration and resolution given an input file path"""
-    outdata = None
-    ffprobe_inspect = [
-        current_app.config['BIN_FFPROBE'],
-        '-loglevel',
-        'error',
-        '-show_streams',
-        filepath,
-        '-print_format',
-        'json']
-
-    ffprobe_ouput = json.loads(subprocess.check_output(ffprobe_inspect))
-
-    video_stream = None
-    # Loop throught audio and video streams searching for the video
-    for stream in ffprobe_ouput['streams']:
-        if stream['codec_type'] == 'video':
-            video_stream = stream
-
-    if video_stream:
-        # If video is webm we can't get the duration (seems to be an ffprobe
-        # issue)
-        if video_stream['codec_name'] == 'vp8':
-            duration = None
-        else:
-            duration = int(float(video_stream['duration']))
-        outdata = dict(
-            duration=duration,
-            res_x=video_stream['width'],
-            res_y=video_stream['height'],
-        )
-        if video_stream['sample_aspect_ratio'] != '1:1':
-            print('[warning] Pixel aspect ratio is not square!')
+class VideoProbe(typing.NamedTuple):
+    """Properties of the first video stream of a file, as reported by ffprobe."""
+
+    duration: typing.Optional[float]  # in seconds
+    width: int
+    height: int
+    codec: str
+    rotation: int  # in degrees clockwise; 0, 90, 180 or 270
 
-    return outdata
+    @property
+    def display_size(self) -> Size:
+        """The size of the video when played, taking rotation into account."""
+        if self.rotation in {90, 270}:
+            return self.height, self.width
+        return self.width, self.height
 
+    def to_dict(self) -> dict:
+        """Returns the properties for storing in a file document."""
+        return {key: value for key, value in self._asdict().items() if value is not None}
 
-def ffmpeg_encode(src, format, res_y=720):
-    # The specific FFMpeg command, called multiple times
-    args = []
-    args.append("-i")
-    args.append(src)
+    @classmethod
+    def from_dict(cls, info: dict) -> 'VideoProbe':
+        return cls(duration=info.get('duration'),
+                   width=info.get('width', 0),
+                   height=info.get('height', 0),
+                   codec=info.get('codec', ''),
+                   rotation=info.get('rotation', 0))
 
-    if format == 'mp4':
-        # Example mp4 encoding
-        # ffmpeg -i INPUT -vcodec libx264 -pix_fmt yuv420p -preset fast -crf 20
-        # -acodec libfdk_aac -ab 112k -ar 44100 -movflags +faststart OUTPUT
+
+def probe_video(filepath: typing.Union[str, pathlib.Path]) -> typing.Optional[VideoProbe]:
+    """Inspects a video file with a single ffprobe call.
+
+    The result is cached per file path, modification time and size, so
+    probing the same file again is free.
+
+    :returns: the properties of the first video stream, or None if the file
+        could not be probed or has no video stream.
+    """
+
+    path = pathlib.Path(filepath)
+    try:
+        stat = path.stat()
+    except OSError as ex:
+        log.error('Unable to probe video %s: %s', path, ex)
+        return None
+
+    return _probe_video(str(path), stat.st_mtime_ns, stat.st_size,
+                        current_app.config['BIN_FFPROBE'])
+
+
+@functools.lru_cache(maxsize=128)
+def _probe_video(filepath: str, mtime_ns: int, size: int, ffprobe_bin: str) \
+        -> typing.Optional[VideoProbe]:
+    cli_args = [
+        ffprobe_bin,
+        '-loglevel', 'error',
+        '-hide_banner',
+        '-print_format', 'json',
+        '-select_streams', 'v:0',  # we only care about the first video stream
+        '-show_streams',
+        '-show_format',
+        filepath,
+    ]
+    cmd = ' '.join(shlex.quote(arg) for arg in cli_args)
+    log.info('Calling %s', cmd)
+
+    try:
+        ffprobe = subprocess.run(
+            cli_args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=10,  # seconds
+        )
+    except (OSError, subprocess.TimeoutExpired) as ex:
+        log.error('Error running %s: %s', cmd, ex)
+        return None
+
+    if ffprobe.returncode:
+        log.error('Error running %s: stopped with return code %i', cmd, ffprobe.returncode)
+        log.error('Output was: %s', ffprobe.stderr)
+        return None
+
+    try:
+        ffprobe_info = json.loads(ffprobe.stdout)
+        stream = ffprobe_info['streams'][0]
+        width, height = stream['width'], stream['height']
+    except (ValueError, KeyError, IndexError):
+        log.exception('ffprobe produced unexpected output: %s', ffprobe.stdout)
+        return None
+
+    return VideoProbe(
+        duration=_probe_duration(stream, ffprobe_info.get('format') or {}),
+        width=width,
+        height=height,
+        codec=stream.get('codec_name', ''),
+        rotation=_probe_rotation(stream),
+    )
+
+
+def _probe_duration(stream: dict, container: dict) -> typing.Optional[float]:
+    """Returns the duration of the stream, falling back to that of the container."""
+
+    candidates = [stream.get('duration'),
+                  container.get('duration'),
+                  # Matroska stores the duration per stream as tag, like '00:00:01.000000000'.
+                  (stream.get('tags') or {}).get('DURATION')]
+    for candidate in candidates:
+        if not candidate:
+            continue
+        try:
+            if ':' in str(candidate):
+                hours, minutes, seconds = str(candidate).split(':')
+                duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+            else:
+                duration = float(candidate)
+        except ValueError:
+            continue
+        if duration > 0:
+            return duration
+    return None
+
+
+def _probe_rotation(stream: dict) -> int:
+    """Returns the clockwise rotation of the stream in degrees."""
+
+    rotate_tag = (stream.get('tags') or {}).get('rotate')
+    if rotate_tag:
+        try:
+            return int(rotate_tag) % 360
+        except ValueError:
+            pass
+
+    # Newer FFmpeg versions report the display matrix, which rotates counter-clockwise.
+    for side_data in stream.get('side_data_list') or ():
+        if 'rotation' in side_data:
+            try:
+                return -int(side_data['rotation']) % 360
+            except (TypeError, ValueError):
+                pass
+    return 0
+
+
+def ffmpeg_encode_args(src: pathlib.Path, dst: pathlib.Path, video_format: str,
+                       width: int, height: int, *, threads: int = 0) -> typing.List[str]:
+    """Returns the FFmpeg CLI arguments to encode a video.
+
+    Progress is written to stdout in FFmpeg's `-progress` key=value format.
+
+    :param video_format: 'mp4' (H.264 + AAC) or 'webm' (VP8).
+    :param width: width of the output, or 0 to keep the aspect ratio.
+    :param height: height of the output, or 0 to use the source height up to 1080.
+    :param threads: number of threads FFmpeg may use, or 0 to let FFmpeg decide.
+    """
+
+    if width and height:
+        scale = f'scale={width}:{height}'
+    elif height:
+        scale = f'scale=-2:{height}'
+    else:
+        scale = "scale=-2:'min(ih,1080)'"
+
+    args = [
+        current_app.config['BIN_FFMPEG'],
+        '-nostdin',
+        '-hide_banner',
+        '-loglevel', 'error',
+        '-nostats',
+        '-progress', 'pipe:1',
+        '-y',
+        '-i', str(src),
+        '-threads', str(threads),
+        '-vf', scale,
+    ]
+
+    if video_format == 'mp4':
         args.extend([
-            '-threads', '1',
-            '-vf', 'scale=-2:{0}'.format(res_y),
             '-vcodec', 'libx264',
             '-pix_fmt', 'yuv420p',
             '-preset', 'fast',
             '-crf', '20',
-            '-acodec', 'libfdk_aac', '-ab', '112k', '-ar', '44100',
-            '-movflags', '+faststart'])
-    elif format == 'webm':
-        # Example webm encoding
-        # ffmpeg -i INPUT -vcodec libvpx -g 120 -lag-in-frames 16 -deadline good
-        # -cpu-used 0 -vprofile 0 -qmax 51 -qmin 11 -slices 4 -b:v 2M -f webm
-
+            '-acodec', 'aac', '-ab', '112k', '-ar', '44100',
+            '-movflags', '+faststart',
+            '-f', 'mp4',
+        ])
+    elif video_format == 'webm':
         args.extend([
-            '-vf', 'scale=-2:{0}'.format(res_y),
             '-vcodec', 'libvpx',
             '-g', '120',
             '-lag-in-frames', '16',
@@ -172,23 +386,11 @@ def ffmpeg_encode(src, format, res_y=720):
             '-cpu-used', '0',
             '-vprofile', '0',
             '-qmax', '51', '-qmin', '11', '-slices', '4', '-b:v', '2M',
-            # '-acodec', 'libmp3lame', '-ab', '112k', '-ar', '44100',
-            '-f', 'webm'])
-
-    if not os.environ.get('VERBOSE'):
-        args.extend(['-loglevel', 'quiet'])
-
-    dst = os.path.splitext(src)
-    dst = "{0}-{1}p.{2}".format(dst[0], res_y, format)
-    args.append(dst)
-    print("Encoding {0} to {1}".format(src, format))
-    returncode = subprocess.call([current_app.config['BIN_FFMPEG']] + args)
-    if returncode == 0:
-        print("Successfully encoded {0}".format(dst))
+            '-acodec', 'libvorbis', '-ab', '112k', '-ar', '44100',
+            '-f', 'webm',
+        ])
     else:
-        print("Error during encode")
-        print("Code:    {0}".format(returncode))
-        print("Command: {0}".format(current_app.config['BIN_FFMPEG'] + " " + " ".join(args)))
-        dst = None
-    # return path of the encoded video
-    return dst
+        raise ValueError(f'Unsupported video format {video_format!r}')
+
+    args.append(str(dst))
+    return args
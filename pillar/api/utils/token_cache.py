@@ -0,0 +1,163 @@
+"""Cache for resolving authentication tokens to user documents.
+
+Authenticating a request requires finding the token and then the user in
+MongoDB. This module caches the result in two tiers: a per-process LRU cache,
+and the application cache (app.cache, Redis in production) shared between
+processes. Both are keyed on the hashed token, so the tokens themselves are
+never stored in the cache.
+
+A cached entry is never used after its token's expiry time. Entries are
+removed when the token is removed and when the user is changed; other
+processes may still use their local copy for AUTH_TOKEN_CACHE_LOCAL_TIMEOUT
+seconds.
+"""
+
+import collections
+import datetime
+import logging
+import threading
+import typing
+
+import bson.tz_util
+from flask import current_app
+
+from pillar.api.utils import utcnow
+
+log = logging.getLogger(__name__)
+
+CacheEntry = typing.NamedTuple('CacheEntry', [
+    ('user', dict),
+    ('user_id', bson.ObjectId),
+    ('expire_time', datetime.datetime),  # expiry of the token
+    ('cached_until', datetime.datetime),  # expiry of this cache entry
+])
+
+_local_cache: typing.MutableMapping[str, CacheEntry] = collections.OrderedDict()
+_local_cache_lock = threading.Lock()
+
+
+def _cache_key(token_hashed: str, is_subclient_token: bool) -> str:
+    return f'auth-token/{"sub" if is_subclient_token else "main"}/{token_hashed}'
+
+
+def _is_valid(entry: typing.Optional[CacheEntry], now: datetime.datetime) -> bool:
+    return entry is not None and now < entry.expire_time and now < entry.cached_until
+
+
+def is_enabled() -> bool:
+    return current_app.config.get('AUTH_TOKEN_CACHE_TIMEOUT', 0) > 0
+
+
+def get(token_hashed: str, is_subclient_token: bool) -> typing.Optional[dict]:
+    """Returns the cached user document for this token, or None if not cached.
+
+    The returned document is shared with the cache, so do not modify it.
+    """
+
+    if not is_enabled():
+        return None
+
+    key = _cache_key(token_hashed, is_subclient_token)
+    now = utcnow()
+
+    with _local_cache_lock:
+        entry = _local_cache.get(key)
+        if _is_valid(entry, now):
+            _local_cache.move_to_end(key)
+            return entry.user
+        _local_cache.pop(key, None)
+
+    entry = current_app.cache.get(key)
+    if not _is_valid(entry, now):
+        return None
+
+    _store_locally(key, entry, now)
+    return entry.user
+
+
+def put(token_hashed: str, is_subclient_token: bool, token_expire_time: datetime.datetime,
+        user: dict) -> None:
+    """Caches the user document for this token."""
+
+    if not is_enabled():
+        return
+
+    if token_expire_time.tzinfo is None:
+        token_expire_time = token_expire_time.replace(tzinfo=bson.tz_util.utc)
+
+    timeout = current_app.config['AUTH_TOKEN_CACHE_TIMEOUT']
+    now = utcnow()
+    entry = CacheEntry(user=user,
+                       user_id=user['_id'],
+                       expire_time=token_expire_time,
+                       cached_until=now + datetime.timedelta(seconds=timeout))
+    if not _is_valid(entry, now):
+        return
+
+    key = _cache_key(token_hashed, is_subclient_token)
+    # Don't keep the entry in the shared cache any longer than the token is valid.
+    ttl = min(timeout, (token_expire_time - now).total_seconds())
+    current_app.cache.set(key, entry, timeout=max(1, int(ttl)))
+    _store_locally(key, entry, now)
+
+
+def _store_locally(key: str, entry: CacheEntry, now: datetime.datetime) -> None:
+    timeout = current_app.config.get('AUTH_TOKEN_CACHE_LOCAL_TIMEOUT', 10)
+    local_until = now + datetime.timedelta(seconds=timeout)
+    if local_until < entry.cached_until:
+        entry = entry._replace(cached_until=local_until)
+
+    max_size = current_app.config.get('AUTH_TOKEN_CACHE_LOCAL_SIZE', 1024)
+    with _local_cache_lock:
+        _local_cache[key] = entry
+        _local_cache.move_to_end(key)
+        while len(_local_cache) > max_size:
+            _local_cache.popitem(last=False)
+
+
+def invalidate_token(token_hashed: str) -> None:
+    """Removes the token from the cache."""
+
+    keys = [_cache_key(token_hashed, is_subclient_token)
+            for is_subclient_token in (False, True)]
+
+    with _local_cache_lock:
+        for key in keys:
+            _local_cache.pop(key, None)
+    if is_enabled():
+        current_app.cache.delete_many(*keys)
+
+
+def invalidate_user(user_id: bson.ObjectId) -> None:
+    """Removes all tokens of this user from the cache."""
+
+    if not user_id:
+        return
+
+    with _local_cache_lock:
+        for key in [key for key, entry in _local_cache.items() if entry.user_id == user_id]:
+            del _local_cache[key]
+
+    if not is_enabled():
+        return
+
+    from pillar.api.utils.authentication import hash_auth_token
+
+    tokens_coll = current_app.db('tokens')
+    keys = []
+    for db_token in tokens_coll.find({'user': user_id},
+                                     projection={'token': 1, 'token_hashed': 1}):
+        token_hashed = db_token.get('token_hashed') or hash_auth_token(db_token['token'])
+        keys.extend(_cache_key(token_hashed, is_subclient_token)
+                    for is_subclient_token in (False, True))
+
+    if keys:
+        log.debug('Invalidating %d cached tokens of user %s', len(keys) // 2, user_id)
+        current_app.cache.delete_many(*keys)
+
+
+def clear_local() -> None:
+    """Clears the per-process cache. Mostly for testing."""
+
+    with _local_cache_lock:
+        _local_cache.clear()
@@ -8,7 +8,7 @@ import bson
 import requests
 
 from pillar import current_app, auth
-from pillar.api.utils import utcnow
+from pillar.api.utils import token_cache, utcnow
 
 SyncUser = collections.namedtuple('SyncUser', 'user_id token bid_user_id')
 BadgeHTML = collections.namedtuple('BadgeHTML', 'html expires')
@@ -252,6 +252,7 @@ def update_badges(user_info: SyncUser, badge_html: str, badge_expiry: datetime.t
                                    {'$set': update})
     if result.matched_count != 1:
         my_log.warning('Unable to update badges for user %s', user_info.user_id)
+    token_cache.invalidate_user(user_info.user_id)
 
 
 def badge_expiry_config() -> datetime.timedelta:
@@ -0,0 +1,62 @@
+"""Processing of uploaded files, and cleanup of unfinished uploads.
+
+Note that this module can only be imported when an application context is
+active. Best to late-import this in the functions where it's needed.
+"""
+import logging
+import pathlib
+
+from bson import ObjectId
+import celery
+
+from pillar import current_app
+
+log = logging.getLogger(__name__)
+
+
+@current_app.celery.task(bind=True, ignore_result=True, acks_late=True)
+def process_uploaded_file(self: celery.Task, file_id: str, spool_path: str,
+                          may_encode_video: bool):
+    """Creates the variations of an uploaded file, and submits videos for encoding.
+
+    :param spool_path: local copy of the uploaded file, or an empty string
+        when it should be downloaded from storage. It is removed when
+        processing is done.
+    """
+    # WARNING: when changing the signature of this function, also change the
+    # self.retry() call below.
+    from pillar.api import file_storage
+
+    spooled = pathlib.Path(spool_path) if spool_path else None
+    try:
+        file_storage.process_stored_file(ObjectId(file_id), spooled,
+                                         may_encode_video=may_encode_video)
+    except Exception:
+        max_retries = current_app.config['FILE_PROCESSING_CELERY_RETRY']
+        if self.request.retries < max_retries:
+            log.exception('Error processing file %s, will retry later', file_id)
+            raise self.retry((file_id, spool_path, may_encode_video),
+                             countdown=60 * 2 ** self.request.retries,
+                             max_retries=max_retries)
+
+        log.exception('Error processing file %s, giving up', file_id)
+        file_storage.update_file_doc(file_id, status='failed')
+
+    if spooled is not None:
+        try:
+            spooled.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError:
+            log.warning('Unable to remove %s, ignoring this but it will need cleanup later.',
+                        spooled, exc_info=True)
+
+
+@current_app.celery.task(ignore_result=True)
+def remove_expired_upload_sessions():
+    """Removes resumable uploads that were abandoned, including their chunks."""
+    from pillar.api.file_storage import resumable
+
+    count = resumable.remove_expired_sessions()
+    if count:
+        log.info('Removed %d expired upload sessions', count)
@@ -0,0 +1,54 @@
+"""Video encoding with FFmpeg, for ENCODING_BACKEND = 'local'.
+
+These tasks are routed to ENCODING_LOCAL_QUEUE, which is served by
+'manage.py celery encoding_worker'.
+
+Note that this module can only be imported when an application context is
+active. Best to late-import this in the functions where it's needed.
+"""
+import logging
+
+from bson import ObjectId
+import celery
+
+from pillar import current_app
+
+log = logging.getLogger(__name__)
+
+# How often, and how many seconds apart, to check whether the file document
+# refers to the encoding job.
+JOB_NOT_READY_RETRIES = 12
+JOB_NOT_READY_COUNTDOWN = 5
+
+
+@current_app.celery.task(bind=True, ignore_result=True, acks_late=True)
+def encode_video(self: celery.Task, file_id: str, job_id: str):
+    """Encodes the variations of a video file, and uploads them to storage."""
+    # WARNING: when changing the signature of this function, also change the
+    # self.retry() calls below.
+    from pillar.api import local_encoding
+
+    try:
+        local_encoding.encode_file(ObjectId(file_id), job_id)
+    except local_encoding.JobNotReady:
+        if self.request.retries < JOB_NOT_READY_RETRIES:
+            log.debug('File %s does not refer to encoding job %s yet, will retry later',
+                      file_id, job_id)
+            raise self.retry((file_id, job_id),
+                             countdown=JOB_NOT_READY_COUNTDOWN,
+                             max_retries=JOB_NOT_READY_RETRIES)
+        log.error('File %s never referred to encoding job %s, giving up', file_id, job_id)
+    except local_encoding.EncodingError:
+        # FFmpeg will fail again on the same input, so don't retry.
+        log.exception('Error encoding file %s, giving up', file_id)
+        local_encoding.mark_failed(ObjectId(file_id), job_id)
+    except Exception:
+        max_retries = current_app.config['FILE_PROCESSING_CELERY_RETRY']
+        if self.request.retries < max_retries:
+            log.exception('Error encoding file %s, will retry later', file_id)
+            raise self.retry((file_id, job_id),
+                             countdown=60 * 2 ** self.request.retries,
+                             max_retries=max_retries)
+
+        log.exception('Error encoding file %s, giving up', file_id)
+        local_encoding.mark_failed(ObjectId(file_id), job_id)
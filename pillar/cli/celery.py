@@ -29,6 +29,39 @@ def worker(args):
     current_app.celery.worker_main([argv0] + argvother)
 
 
+@manager_celery.option('args', nargs='*')
+def encoding_worker(args):
+    """Runs Celery workers for local video encoding.
+
+    Starts ENCODING_LOCAL_CONCURRENCY workers that only serve the video
+    encoding queue. Each is a separate process, as the workers can't fork.
+    """
+
+    import subprocess
+    import sys
+
+    concurrency = current_app.config['ENCODING_LOCAL_CONCURRENCY']
+    queue_name = current_app.config['ENCODING_LOCAL_QUEUE']
+    log.info('Starting %d video encoding workers on queue %r', concurrency, queue_name)
+
+    workers = [
+        subprocess.Popen([sys.executable, sys.argv[0], 'celery', 'worker', '--',
+                          '-Q', queue_name,
+                          '-n', f'encoder{idx}@%h',
+                          *args])
+        for idx in range(concurrency)
+    ]
+    try:
+        for worker_proc in workers:
+            worker_proc.wait()
+    except KeyboardInterrupt:
+        log.info('Stopping video encoding workers')
+        for worker_proc in workers:
+            worker_proc.terminate()
+        for worker_proc in workers:
+            worker_proc.wait()
+
+
 @manager_celery.command
 def queue():
     """Shows queued Celery tasks."""
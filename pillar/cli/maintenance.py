@@ -926,6 +926,105 @@ def delete_orphan_files():
     log.info('%d files have been soft-deleted', res.modified_count)
 
 
+@manager_maintenance.option('-p', '--project', dest='proj_url', default=None,
+                            help='Only inspect the files of this project.')
+@manager_maintenance.option('-c', '--compute', dest='compute', action='store_true', default=False,
+                            help='Download files without SHA-256 checksum from storage, '
+                                 'and store their checksums.')
+def find_duplicate_files(proj_url=None, compute=False):
+    """Reports how much storage deduplication of uploaded files could save.
+
+    Only files with a SHA-256 checksum are considered, use --compute to
+    compute the checksums of older files. This downloads those files, so use
+    with care.
+    """
+    from jinja2.filters import do_filesizeformat
+    from pillar.api.file_storage import dedup
+    from pillar.api.file_storage_backends import blob_cache
+
+    start_timestamp = datetime.datetime.now()
+    files_coll = current_app.db('files')
+
+    file_filter = {'_deleted': {'$ne': True}, 'status': 'complete'}
+    if proj_url:
+        proj = current_app.db('projects').find_one({'url': proj_url, '_deleted': {'$ne': True}},
+                                                   projection={'_id': 1})
+        if not proj:
+            log.error('Project %s not found', proj_url)
+            return 3
+        file_filter['project'] = proj['_id']
+
+    if compute:
+        to_hash = files_coll.find({**file_filter, 'sha256': {'$exists': False}},
+                                  projection={'project': 1, 'backend': 1, 'file_path': 1})
+        hashed_count = 0
+        for file_doc in to_hash:
+            try:
+                md5, sha256 = dedup.compute_checksums(file_doc)
+            except Exception as ex:
+                log.warning('Unable to compute checksums of file %s: %s', file_doc['_id'], ex)
+                continue
+            files_coll.update_one({'_id': file_doc['_id']},
+                                  {'$set': {'md5': md5, 'sha256': sha256}})
+            hashed_count += 1
+        log.info('Computed checksums of %d files', hashed_count)
+        log.info('Blob cache: %i hits, %i misses, %i evictions', *blob_cache.stats())
+
+    aggr = files_coll.aggregate([
+        {'$match': {**file_filter, 'sha256': {'$exists': True}}},
+        {'$group': {
+            '_id': {'project': '$project', 'backend': '$backend', 'sha256': '$sha256'},
+            'file_count': {'$sum': 1},
+            # Files that were deduplicated already share their file path.
+            'file_paths': {'$addToSet': '$file_path'},
+            'size': {'$max': {'$ifNull': ['$length_aggregate_in_bytes', '$length']}},
+        }},
+        {'$match': {'file_count': {'$gt': 1}}},
+    ])
+
+    duplicate_count = 0
+    savable_count = 0
+    savable_size = 0
+    for group in aggr:
+        duplicate_count += group['file_count'] - 1
+        redundant_blobs = len(group['file_paths']) - 1
+        savable_count += redundant_blobs
+        savable_size += redundant_blobs * (group['size'] or 0)
+
+    hashed_count = files_coll.count_documents({**file_filter, 'sha256': {'$exists': True}})
+    total_count = files_coll.count_documents(file_filter)
+    log.info('Total nr of files          : %d', total_count)
+    log.info('Files with checksum        : %d', hashed_count)
+    log.info('Duplicate files            : %d', duplicate_count)
+    log.info('Of which not yet shared    : %d', savable_count)
+    log.info('Potential storage savings  : %s', do_filesizeformat(savable_size, binary=True))
+
+    duration = datetime.datetime.now() - start_timestamp
+    log.info('Finding duplicate files took %s', duration)
+
+
+@manager_maintenance.option('-c', '--clear', dest='clear', action='store_true', default=False,
+                            help='Remove all blobs from the cache.')
+def blob_cache_info(clear=False):
+    """Shows the disk usage of the local cache of remote blobs."""
+    from jinja2.filters import do_filesizeformat
+    from pillar.api.file_storage_backends import blob_cache
+
+    if not blob_cache.is_enabled():
+        log.info('The blob cache is disabled, set BLOB_CACHE_MAX_BYTES to enable it.')
+
+    blob_count, size = blob_cache.disk_usage()
+    max_size = current_app.config['BLOB_CACHE_MAX_BYTES']
+    log.info('Cache directory : %s', blob_cache.cache_dir())
+    log.info('Cached blobs    : %d', blob_count)
+    log.info('Size            : %s of %s', do_filesizeformat(size, binary=True),
+             do_filesizeformat(max_size, binary=True))
+
+    if clear:
+        blob_cache.clear()
+        log.info('Removed %d blobs from the cache', blob_count)
+
+
 @manager_maintenance.command
 def find_video_files_without_duration():
     """Finds video files without any duration
@@ -943,7 +1042,9 @@ def find_video_files_without_duration():
     starts_with_video = re.compile("^video", re.IGNORECASE)
     aggr = files_coll.aggregate([
         {'$match': {'content_type': starts_with_video,
-                    '_deleted': {'$ne': True}}},
+                    '_deleted': {'$ne': True},
+                    # Duration found by probing the uploaded file.
+                    'duration': {'$not': {'$gt': 0}}}},
         {'$unwind': '$variations'},
         {'$match': {
             'variations.duration': {'$not': {'$gt': 0}}
@@ -1038,16 +1139,21 @@ def reconcile_node_video_duration(nodes_to_update=None, all_nodes=False, go=Fals
                 'as': '_files',
             }},
             {'$unwind': '$_files'},
-            {'$unwind': '$_files.variations'},
-            {'$match': {'_files.variations.duration': {'$gt': 0}}},
+            {'$unwind': {'path': '$_files.variations', 'preserveNullAndEmptyArrays': True}},
+            # Fall back to the duration found by probing the uploaded file.
             {'$addFields': {
-                'need_update': {
-                    '$ne': ['$_files.variations.duration', '$properties.duration_seconds']}
+                'duration': {'$cond': [{'$gt': ['$_files.variations.duration', 0]},
+                                       '$_files.variations.duration',
+                                       '$_files.duration']},
+            }},
+            {'$match': {'duration': {'$gt': 0}}},
+            {'$addFields': {
+                'need_update': {'$ne': ['$duration', '$properties.duration_seconds']}
             }},
             {'$match': {'need_update': True}},
             {'$project': {
                 '_id': 1,
-                'duration': '$_files.variations.duration',
+                'duration': 1,
             }}]
     )
 
@@ -1331,3 +1437,31 @@ def fix_missing_activities_subscription_defaults(user=None, context_object=None,
                         num_need_notification_web_update, resp['nModified'])
 
     log.info("Done updating 'activities-subscriptions' documents")
+
+
+@manager_maintenance.option('-g', '--go', dest='go', action='store_true', default=False,
+                            help='Actually perform the changes (otherwise just show as dry-run).')
+def backfill_node_ancestors(go=False):
+    """Stores the materialised ancestor path on nodes that don't have one yet."""
+
+    from pillar.api.nodes import hierarchy
+
+    missing_count, updated_count = hierarchy.backfill(go=go)
+    if not go:
+        log.info('Would set ancestors on %d nodes', missing_count)
+        return
+    log.info('Set ancestors on %d of %d nodes', updated_count, missing_count)
+
+
+@manager_maintenance.command
+def create_token_expiry_index():
+    """Creates the TTL index that deletes expired authentication tokens.
+
+    Replaces any existing index on tokens.expire_time.
+    """
+
+    from pillar.api.utils import authentication
+
+    authentication.create_token_expiry_index(current_app.db('tokens'), replace_existing=True)
+    log.info('Expired tokens will be deleted %s after they expired',
+             authentication.EXPIRED_TOKEN_GRACE_PERIOD)
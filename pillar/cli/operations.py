@@ -63,6 +63,9 @@ def mass_copy_between_backends(src_backend='cdnsun', dest_backend='gcs'):
     log.info('%i files copied ok', copied_ok)
     log.info('%i files we did not copy', copy_errs)
 
+    from pillar.api.file_storage_backends import blob_cache
+    log.info('Blob cache: %i hits, %i misses, %i evictions', *blob_cache.stats())
+
 
 @manager_operations.option('dest_proj_url', help='Destination project URL')
 @manager_operations.option('node_uuid', help='ID of the node to move')
@@ -34,6 +34,15 @@ SECRET_KEY = ''
 # Not used to hash new tokens, but it is used to check pre-existing hashed tokens.
 AUTH_TOKEN_HMAC_KEY = b''
 
+# Caching of authentication token -> user lookups. The shared tier uses the
+# Flask-Caching backend (see CACHE_TYPE, for example Redis), and is fronted by
+# a small per-process LRU cache. Changes to users are visible in other
+# processes after at most AUTH_TOKEN_CACHE_LOCAL_TIMEOUT seconds.
+# Set AUTH_TOKEN_CACHE_TIMEOUT to 0 to disable the cache.
+AUTH_TOKEN_CACHE_TIMEOUT = 60  # seconds
+AUTH_TOKEN_CACHE_LOCAL_TIMEOUT = 10  # seconds
+AUTH_TOKEN_CACHE_LOCAL_SIZE = 1024
+
 # Authentication settings
 BLENDER_ID_ENDPOINT = 'http://id.local:8000/'
 
@@ -65,6 +74,11 @@ BIN_RSYNC = '/usr/bin/rsync'
 
 GCLOUD_APP_CREDENTIALS = 'google_app.json'
 GCLOUD_PROJECT = '-SECRET-'
+# Maximum number of idle keep-alive HTTP connections to GCS, per process.
+GCS_HTTP_POOL_SIZE = 10
+# Alternative GCS API endpoint, such as 'http://localhost:4443' for a local
+# fake GCS server. Requests to this endpoint are not authenticated.
+GCS_API_ENDPOINT = ''
 # Used for cross-verification on various Google sites (eg. YouTube)
 GOOGLE_SITE_VERIFICATION = ''
 
@@ -97,7 +111,16 @@ ZENCODER_API_KEY = '-SECRET-'
 ZENCODER_NOTIFICATIONS_SECRET = '-SECRET-'
 ZENCODER_NOTIFICATIONS_URL = 'http://zencoderfetcher/'
 
-ENCODING_BACKEND = 'zencoder'  # local, flamenco
+ENCODING_BACKEND = 'zencoder'  # zencoder, local
+
+# Settings for ENCODING_BACKEND = 'local', which encodes videos with FFmpeg on
+# Celery workers. Encoding tasks are sent to ENCODING_LOCAL_QUEUE, which is
+# only served by 'manage.py celery encoding_worker'. That runs
+# ENCODING_LOCAL_CONCURRENCY workers, each encoding one video at a time with
+# ENCODING_LOCAL_THREADS FFmpeg threads (0 lets FFmpeg decide).
+ENCODING_LOCAL_QUEUE = 'video-encoding'
+ENCODING_LOCAL_CONCURRENCY = 2
+ENCODING_LOCAL_THREADS = 0
 
 # Storage solution for uploaded files. If 'local' is selected, make sure you specify the SERVER_NAME
 # config value as well, since it will help building correct URLs when indexing.
@@ -110,6 +133,48 @@ FILE_LINK_VALIDITY = defaultdict(
     gcs=3600 * 23,  # 23 hours for Google Cloud Storage.
 )
 
+# When True, links of backends that can generate them without contacting the
+# storage backend (like 'local') are generated when a file is returned, instead
+# of being stored in MongoDB. Reading files then no longer writes to MongoDB.
+FILE_LINKS_ON_READ = False
+# Maximum number of such links cached per process.
+FILE_LINK_CACHE_SIZE = 10000
+
+# How files of the 'local' storage backend are served:
+# 'direct': by Pillar itself, with support for Range and conditional requests.
+# 'x-accel-redirect': handed off to nginx, from the internal location
+#     LOCAL_STORAGE_ACCEL_PREFIX that maps to STORAGE_DIR.
+# 'x-sendfile': handed off to Apache (mod_xsendfile) or Lighttpd.
+LOCAL_STORAGE_SERVE_MODE = 'direct'
+LOCAL_STORAGE_ACCEL_PREFIX = '/protected-storage/'
+# Copies between buckets of the 'local' backend are copy-on-write clones when the
+# filesystem supports this. Otherwise they are hard links when this is True, and
+# actual copies when False. Blobs are never modified in place, so hard links are
+# safe as long as no other software writes to STORAGE_DIR.
+LOCAL_STORAGE_HARDLINK_COPIES = True
+
+# Downloads from remote storage backends (like GCS) are cached on local disk,
+# for moving, re-processing and checksumming files. The least recently used
+# blobs are evicted when the cache grows beyond BLOB_CACHE_MAX_BYTES; set to 0
+# to disable the cache. BLOB_CACHE_DIR defaults to STORAGE_DIR/blob-cache.
+BLOB_CACHE_DIR = ''
+BLOB_CACHE_MAX_BYTES = 10 * 2 ** 30
+
+# Transport used by the web layer for its internal PillarSDK calls:
+# 'test-client': full Werkzeug test client request, including JSON (de)serialisation.
+# 'direct': dispatch straight into Eve as the current user, see pillar.sdk.DirectInternalApi.
+SDK_INTERNAL_TRANSPORT = 'test-client'
+
+# Maximum number of levels of children /p/<project_url>/jstree?depth=N will prefetch.
+JSTREE_MAX_PREFETCH_DEPTH = 3
+
+# Compiled permission tables of projects and their node types are cached per
+# process. Modifications of a project are seen by other processes through the
+# project's etag in the shared cache (see CACHE_TYPE); when that is not
+# available, cached permissions are used for at most this many seconds.
+# Set to 0 to disable the cache.
+PROJECT_PERMISSIONS_CACHE_TIMEOUT = 60
+
 # Capability with GET-access to all variations of files.
 FULL_FILE_ACCESS_CAP = 'subscriber'
 
@@ -123,6 +188,17 @@ BLENDER_ID_SUBCLIENT_ID = 'PILLAR'
 BLENDER_ID_USER_INFO_API = 'http://blender-id:8000/api/user/'
 BLENDER_ID_USER_INFO_TOKEN = '-set-in-config-local-'
 
+# Roles given by organization IP ranges are looked up in a per-process index.
+# Changes made by other processes are picked up after at most this many seconds.
+ORG_IP_RANGES_CHECK_INTERVAL = 10
+# When the shared cache (see CACHE_TYPE) is not available, the index is
+# rebuilt after at most this many seconds.
+ORG_IP_RANGES_CACHE_TIMEOUT = 60
+
+# Tokens rejected by Blender ID are not validated again for this many seconds.
+# Set to 0 to disable.
+BLENDER_ID_NEGATIVE_CACHE_TIMEOUT = 30
+
 # Collection of supported OAuth providers (Blender ID, Facebook and Google).
 # Example entry:
 # OAUTH_CREDENTIALS = {
@@ -171,6 +247,12 @@ FILESIZE_LIMIT_BYTES_NONSUBS = 32 * 2 ** 20
 # Unless they have one of those roles.
 ROLES_FOR_UNLIMITED_UPLOADS = {'subscriber', 'demo', 'admin'}
 
+# Resumable uploads send files in chunks of at least this many bytes; larger
+# chunks are used for very large files. See pillar.api.file_storage.resumable.
+RESUMABLE_UPLOAD_CHUNK_SIZE = 8 * 2 ** 20
+# Resumable uploads that don't receive any chunk in this time are removed.
+RESUMABLE_UPLOAD_EXPIRY = datetime.timedelta(days=1)
+
 ROLES_FOR_COMMENT_VOTING = {'subscriber', 'demo'}
 
 #############################################
@@ -204,7 +286,12 @@ CELERY_BEAT_SCHEDULE = {
     'regenerate-expired-links': {
         'task': 'pillar.celery.file_link_tasks.regenerate_all_expired_links',
         'schedule': 600,  # every N seconds
-        'args': ('gcs', 100)
+        # Links are refreshed in concurrent batches, see refresh_links_for_backend().
+        'args': ('gcs', 10000)
+    },
+    'remove-expired-upload-sessions': {
+        'task': 'pillar.celery.file_processing.remove_expired_upload_sessions',
+        'schedule': 3600,  # every N seconds
     },
     'refresh-blenderid-badges': {
         'task': 'pillar.celery.badges.sync_badges_for_users',
@@ -220,6 +307,22 @@ BLENDER_ID_BADGE_EXPIRY = datetime.timedelta(hours=4)
 # How many times the Celery task for downloading an avatar is retried.
 AVATAR_DOWNLOAD_CELERY_RETRY = 3
 
+# How many times the Celery task for processing an uploaded file is retried.
+FILE_PROCESSING_CELERY_RETRY = 3
+
+# Uploaded files are linked into STORAGE_DIR/processing, so that the processing
+# Celery task doesn't have to download them from storage. Disable this when the
+# Celery workers do not share STORAGE_DIR with the web servers.
+FILE_PROCESSING_SPOOL = True
+
+# Maximum number of thumbnail variations uploaded to the storage backend concurrently.
+VARIATION_UPLOAD_THREADS = 6
+
+# When True, uploads that are identical to an already processed file in the
+# same project refer to the existing blob and variations, instead of being
+# stored and processed again. See pillar.api.file_storage.dedup.
+DEDUPLICATE_UPLOADS = False
+
 # Mapping from user role to capabilities obtained by users with that role.
 USER_CAPABILITIES = defaultdict(**{
     'subscriber': {'subscriber', 'home-project'},
@@ -1,8 +1,11 @@
 """PillarSDK subclass for direct Flask-internal calls."""
 
 import logging
+import typing
 import urllib.parse
-from flask import current_app
+
+from flask import current_app, g
+from werkzeug import exceptions as wz_exceptions
 
 import pillarsdk
 from pillarsdk import exceptions
@@ -100,3 +103,133 @@ class FlaskInternalApi(pillarsdk.Api):
 
         raise exceptions.ConnectionError(response, text,
                                          "Unknown response code: %s" % response.status_code)
+
+
+class _DirectResponse:
+    """Minimal stand-in for a Requests response, for pillarsdk error handling."""
+
+    def __init__(self, status_code: int, text: str) -> None:
+        self.status_code = status_code
+        self.text = text
+        self.headers = {}
+
+
+class DirectInternalApi(FlaskInternalApi):
+    """SDK API subclass that dispatches straight into Eve.
+
+    Calls for Eve resources are handled by Eve's own GET/PATCH/POST methods
+    (including the pre-event and fetched hooks that implement permission
+    checks), but skip the WSGI stack, the before_request chain (token
+    validation), and the JSON serialisation & parsing of the response. The
+    request is performed as the already-authenticated g.current_user, so
+    this only works when that user belongs to the API token.
+
+    Anything else (non-Eve endpoints, file uploads, other HTTP methods, or
+    calls for another user) is passed on to FlaskInternalApi.
+    """
+
+    direct_methods = {
+        ('resource', 'GET'): 'get',
+        ('resource', 'POST'): 'post',
+        ('item_lookup', 'GET'): 'getitem',
+        ('item_lookup', 'PATCH'): 'patch',
+    }
+
+    def http_call(self, url, method, **kwargs):
+        if kwargs.get('files') or not self._can_dispatch_directly():
+            return super().http_call(url, method, **kwargs)
+
+        split_url = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(split_url[:-2] + (None, None))
+        headers = dict(kwargs.get('headers') or {})
+        headers.setdefault('Content-Type', 'application/json')
+
+        # Pushing a request context reuses the current application context, so
+        # g.current_user stays available to Eve and our hooks.
+        with current_app.test_request_context(path=path, method=method,
+                                              query_string=split_url.query,
+                                              headers=headers, data=kwargs.get('data')):
+            eve_method = self._eve_method_for_request(method)
+            if eve_method is not None:
+                try:
+                    status, content = self._dispatch(eve_method)
+                except Exception as ex:
+                    log.warning('Error performing direct %s request to %s: %s', method,
+                                url, str(ex))
+                    raise
+
+        if eve_method is None:
+            return super().http_call(url, method, **kwargs)
+
+        if 200 <= status <= 299:
+            return json_compatible(content)
+
+        # Errors are rare enough to just let pillarsdk handle them as usual.
+        if not isinstance(content, str):
+            from pillar.api.utils import dumps
+            content = dumps(content)
+        return self.handle_response(_DirectResponse(status, content), content)
+
+    def _can_dispatch_directly(self) -> bool:
+        """Only dispatch directly when g.current_user belongs to our token."""
+
+        current_user = g.get('current_user')
+        if current_user is None or current_user.is_anonymous:
+            return not self.token
+        return bool(self.token) and current_user.id == self.token
+
+    def _eve_method_for_request(self, method: str) -> typing.Optional[typing.Callable]:
+        """Returns the Eve method (like eve.methods.get) for the current request."""
+
+        from flask import request
+        import eve.methods
+
+        endpoint = request.endpoint or ''
+        if '|' not in endpoint:
+            return None
+
+        _, endpoint_type = endpoint.split('|', 1)
+        func_name = self.direct_methods.get((endpoint_type, method))
+        if func_name is None:
+            return None
+        return getattr(eve.methods, func_name)
+
+    def _dispatch(self, eve_method: typing.Callable) \
+            -> typing.Tuple[int, typing.Union[str, dict]]:
+        """Calls the Eve method, returning (status code, response content)."""
+
+        from flask import request
+
+        resource = request.endpoint.split('|', 1)[0]
+        try:
+            result = eve_method(resource, **request.view_args)
+        except wz_exceptions.HTTPException as ex:
+            if ex.response is not None:
+                return ex.response.status_code, ex.response.get_data(as_text=True)
+            return ex.code, {'_status': 'ERR',
+                             '_code': ex.code,
+                             '_message': ex.description}
+        return result[3], result[0]
+
+
+def json_compatible(value):
+    """Converts a MongoDB/Eve document into what json.loads(dumps(value)) returns.
+
+    This produces the same types as the JSON round-trip (ObjectIds and datetimes
+    become strings), without actually producing and parsing JSON.
+    """
+
+    from pillar.api.utils import PillarJSONEncoder
+
+    encode = PillarJSONEncoder().default
+
+    def convert(item):
+        if isinstance(item, dict):
+            return {str(key): convert(val) for key, val in item.items()}
+        if isinstance(item, (list, tuple)):
+            return [convert(val) for val in item]
+        if item is None or isinstance(item, (str, int, float, bool)):
+            return item
+        return convert(encode(item))
+
+    return convert(value)
@@ -22,6 +22,12 @@ EXTERNAL_SUBSCRIPTIONS_MANAGEMENT_SERVER = "http://store.localhost/api"
 
 SECRET_KEY = '12345'
 
+# Many tests modify users and projects directly in MongoDB.
+AUTH_TOKEN_CACHE_TIMEOUT = 0
+PROJECT_PERMISSIONS_CACHE_TIMEOUT = 0
+# Many tests validate the same token against a mocked Blender ID.
+BLENDER_ID_NEGATIVE_CACHE_TIMEOUT = 0
+
 OAUTH_CREDENTIALS = {
     'blender-id': {
         'id': 'blender-id-app-id',
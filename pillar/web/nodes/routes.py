@@ -28,7 +28,8 @@ from pillar.web.nodes.forms import get_node_form
 from pillar.web.nodes.forms import process_node_form
 from pillar.web.nodes.custom.storage import StorageNode
 from pillar.web.projects.routes import project_update_nodes_list
-from pillar.web.utils import get_file
+from pillar.web.utils import get_file, queue_files
+from pillar.web.utils import batching
 from pillar.web.utils import attach_project_pictures
 from pillar.web.utils.jstree import jstree_build_children, GROUP_NODES
 from pillar.web.utils.jstree import jstree_build_from_node
@@ -141,18 +142,6 @@ def view(node_id, extra_template_args: dict=None):
         'texture': _view_handler_texture,
         'hdri': _view_handler_hdri,
     }
-    if node_type_name in node_type_handlers:
-        handler = node_type_handlers[node_type_name]
-        template_path, template_action = handler(node, template_path, template_action, link_allowed)
-    # Fetch linked resources.
-    node.picture = get_file(node.picture, api=api)
-    node.user = node.user and pillarsdk.User.find(node.user, api=api)
-
-    try:
-        node.parent = node.parent and pillarsdk.Node.find(node.parent, api=api)
-    except ForbiddenAccess:
-        # This can happen when a node has world-GET, but the parent doesn't.
-        node.parent = None
 
     # Get children
     children_projection = {'project': 1, 'name': 1, 'picture': 1, 'parent': 1,
@@ -176,6 +165,27 @@ def view(node_id, extra_template_args: dict=None):
         return render_template('errors/403_embed.html')
     children = children._items
 
+    # Queue all files needed by this view, so that they are fetched in one go.
+    file_ids = [node.picture]
+    file_ids.extend(child.picture for child in children)
+    if node.properties:
+        file_ids.append(node.properties.file)
+        file_ids.extend(f.file for f in node.properties.files or ())
+    queue_files(file_ids, api=api)
+
+    if node_type_name in node_type_handlers:
+        handler = node_type_handlers[node_type_name]
+        template_path, template_action = handler(node, template_path, template_action, link_allowed)
+    # Fetch linked resources.
+    node.picture = get_file(node.picture, api=api)
+    node.user = node.user and batching.loader(pillarsdk.User, api=api).find(node.user)
+
+    try:
+        node.parent = node.parent and batching.loader(Node, api=api).find(node.parent)
+    except ForbiddenAccess:
+        # This can happen when a node has world-GET, but the parent doesn't.
+        node.parent = None
+
     for child in children:
         child.picture = get_file(child.picture, api=api)
 
@@ -676,6 +686,10 @@ def breadcrumbs(node_id: str):
         log.warning('breadcrumbs(node_id=%r): access denied to current user', node_id)
         raise wz_exceptions.Forbidden(f'No access to node {node_id}')
 
+    # Fetch all ancestors with one query, rather than one query per parent.
+    nodes = batching.loader(Node, api=api)
+    nodes.queue(node._ancestors or [])
+
     crumbs = []
     while True:
         crumbs.append(make_crumb(node))
@@ -688,7 +702,7 @@ def breadcrumbs(node_id: str):
         # If a subsequent node doesn't exist any more, include that in the breadcrumbs.
         # Forbidden nodes are handled as if they don't exist.
         try:
-            node = Node.find(node_id, api=api)
+            node = nodes.find(node_id)
         except (ResourceNotFound, ForbiddenAccess):
             log.warning('breadcrumbs: Unable to find node %r but it is marked as parent of %r',
                         node_id, child_id)
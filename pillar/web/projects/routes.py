@@ -25,8 +25,9 @@ from pillar.api.utils import utcnow
 import pillar.api.users.avatar
 from pillar.web import system_util
 from pillar.web import utils
+from pillar.web.utils import batching
 from pillar.web.nodes import finders
-from pillar.web.utils.jstree import jstree_get_children
+from pillar.web.utils.jstree import jstree_get_children, jstree_get_subtree
 import pillar.extension
 
 from .forms import ProjectForm
@@ -119,7 +120,11 @@ def index():
 
 @blueprint.route('/<project_url>/jstree')
 def jstree(project_url):
-    """Entry point to view a project as JSTree"""
+    """Entry point to view a project as JSTree
+
+    The optional 'depth' query parameter prefetches that many levels of
+    children, up to JSTREE_MAX_PREFETCH_DEPTH.
+    """
     api = system_util.pillar_api()
 
     try:
@@ -130,6 +135,11 @@ def jstree(project_url):
     except ResourceNotFound:
         raise wz_exceptions.NotFound('No such project')
 
+    depth = request.args.get('depth', 0, type=int)
+    depth = max(0, min(depth, current_app.config['JSTREE_MAX_PREFETCH_DEPTH']))
+    if depth:
+        return jsonify(items=jstree_get_subtree(project._id, depth))
+
     return jsonify(items=jstree_get_children(None, project._id))
 
 
@@ -271,6 +281,11 @@ def home_jstree():
     except ResourceNotFound:
         raise wz_exceptions.NotFound('No such project')
 
+    depth = request.args.get('depth', 0, type=int)
+    depth = max(0, min(depth, current_app.config['JSTREE_MAX_PREFETCH_DEPTH']))
+    if depth:
+        return jsonify(items=jstree_get_subtree(project._id, depth))
+
     return jsonify(items=jstree_get_children(None, project._id))
 
 
@@ -369,18 +384,26 @@ def render_project(project, api, extra_context=None, template_name=None):
         elif node_type == 'asset':
             projection['description'] = 1
 
+        node_ids = list(reversed(list_of_ids))
+        nodes = batching.loader(Node, api=api, params=params)
+        nodes.queue(node_ids)
+
         list_latest = []
-        for node_id in reversed(list_of_ids or ()):
+        for node_id in node_ids:
             try:
-                node_item = Node.find(node_id, params, api=api)
-
-                node_item.picture = utils.get_file(node_item.picture, api=api)
-                list_latest.append(node_item)
+                node_item = nodes.find(node_id)
             except ForbiddenAccess:
                 pass
             except ResourceNotFound:
                 log.warning('Project %s refers to removed node %s!',
                             project._id, node_id)
+            else:
+                list_latest.append(node_item)
+
+        # Fetch all pictures in one go.
+        utils.queue_files((node_item.picture for node_item in list_latest), api=api)
+        for node_item in list_latest:
+            node_item.picture = utils.get_file(node_item.picture, api=api)
 
         return list_latest
 
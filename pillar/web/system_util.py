@@ -7,10 +7,16 @@ import logging
 from flask import current_app, session, request
 from flask_login import current_user
 
-from pillar.sdk import FlaskInternalApi
+from pillar.sdk import FlaskInternalApi, DirectInternalApi
 
 log = logging.getLogger(__name__)
 
+# Mapping from SDK_INTERNAL_TRANSPORT config value to SDK API class.
+SDK_TRANSPORTS = {
+    'test-client': FlaskInternalApi,
+    'direct': DirectInternalApi,
+}
+
 
 def pillar_server_endpoint():
     """Gets the endpoint for the authentication API. If the env variable
@@ -38,7 +44,9 @@ def pillar_api(token=None):
     if token is None and current_user and current_user.is_authenticated:
         use_token = current_user.id
 
-    api = FlaskInternalApi(
+    transport = current_app.config.get('SDK_INTERNAL_TRANSPORT', 'test-client')
+    api_class = SDK_TRANSPORTS[transport]
+    api = api_class(
         endpoint=pillar_server_endpoint(),
         username=None,
         password=None,
@@ -13,13 +13,19 @@ from pillarsdk import Project
 from pillarsdk.exceptions import ResourceNotFound
 import pillarsdk.utils
 from pillar.web import system_util
+from pillar.web.utils import batching
 from pillar.web.utils.exceptions import ConfigError
 
 log = logging.getLogger(__name__)
 
 
 def get_file(file_id, api=None):
-    # TODO: remove this function and just use the Pillar SDK directly.
+    """Returns the file, or None if it doesn't exist.
+
+    Files are loaded through the request-scoped batch loader, so IDs queued
+    with queue_files() are fetched together, and each file is fetched only
+    once per request.
+    """
     if file_id is None:
         return None
 
@@ -27,7 +33,7 @@ def get_file(file_id, api=None):
         api = system_util.pillar_api()
 
     try:
-        return File.find(file_id, api=api)
+        return batching.loader(File, api=api).find(file_id)
     except ResourceNotFound:
         f = sys.exc_info()[2].tb_frame.f_back
         tb = traceback.format_stack(f=f, limit=2)
@@ -36,6 +42,15 @@ def get_file(file_id, api=None):
         return None
 
 
+def queue_files(file_ids: typing.Iterable[typing.Optional[str]], api=None):
+    """Queues file IDs, so that the next get_file() call fetches them all at once."""
+
+    if api is None:
+        api = system_util.pillar_api()
+
+    batching.loader(File, api=api).queue(file_ids)
+
+
 def attach_project_pictures(project, api):
     """Utility function that queries for file objects referenced in picture
     header and square. In eve we currently can't embed objects in nested
@@ -45,6 +60,7 @@ def attach_project_pictures(project, api):
 
     # When adding to the list of pictures dealt with here, make sure
     # you update unattach_project_pictures() too.
+    queue_files([project.picture_square, project.picture_header, project.picture_16_9], api=api)
     project.picture_square = get_file(project.picture_square, api=api)
     project.picture_header = get_file(project.picture_header, api=api)
     project.picture_16_9 = get_file(project.picture_16_9, api=api)
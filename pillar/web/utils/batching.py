@@ -0,0 +1,159 @@
+"""Request-scoped batching of PillarSDK lookups.
+
+Code that knows it will need a set of documents queues their IDs first, and
+the first lookup then fetches all queued IDs of that collection with a single
+`{'_id': {'$in': [...]}}` query. Results are kept for the rest of the request.
+
+    >>> files = loader(pillarsdk.File, api=api)
+    >>> files.queue(node.picture for node in nodes)
+    >>> for node in nodes:
+    ...     node.picture = files.find(node.picture)  # only the first call queries.
+
+This generalises what pillar.web.utils.mass_attach_project_pictures() does for
+project pictures.
+"""
+
+import collections
+import copy
+import json
+import logging
+import typing
+
+from flask import current_app, g
+import pillarsdk
+from pillarsdk.exceptions import ForbiddenAccess, ResourceNotFound
+
+log = logging.getLogger(__name__)
+
+
+class BatchLoader:
+    """Loads documents of one resource class, batching and memoising lookups.
+
+    The find() method behaves like resource_class.find(doc_id, params, api=api),
+    including the ResourceNotFound and ForbiddenAccess exceptions it raises.
+    Every call returns a new resource object, so callers can modify it without
+    affecting other users of the same document.
+    """
+
+    def __init__(self, resource_class: typing.Type[pillarsdk.Resource], api,
+                 params: typing.Optional[dict] = None) -> None:
+        self.resource_class = resource_class
+        self.api = api
+        self.params = params or {}
+
+        self._pending: typing.MutableMapping[str, None] = collections.OrderedDict()
+        # Mapping from document ID to either the document or the exception to raise.
+        self._loaded: typing.MutableMapping[str, typing.Union[dict, Exception]] = {}
+
+    def queue(self, doc_ids: typing.Iterable[typing.Optional[str]]) -> None:
+        """Queue document IDs to be fetched by the next lookup.
+
+        None and empty IDs are ignored, so it's fine to just pass optional
+        properties like node.picture.
+        """
+
+        for doc_id in doc_ids:
+            if not doc_id:
+                continue
+            doc_id = str(doc_id)
+            if doc_id not in self._loaded:
+                self._pending[doc_id] = None
+
+    def find(self, doc_id) -> pillarsdk.Resource:
+        """Returns the document, fetching all queued documents if necessary."""
+
+        doc_id = str(doc_id)
+        if doc_id not in self._loaded:
+            self._pending[doc_id] = None
+            self.flush()
+
+        result = self._loaded[doc_id]
+        if isinstance(result, Exception):
+            raise result
+        return self.resource_class(copy.deepcopy(result))
+
+    def find_many(self, doc_ids: typing.Iterable) -> typing.List[pillarsdk.Resource]:
+        """Returns the found documents in the given order, skipping inaccessible ones."""
+
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id]
+        self.queue(doc_ids)
+
+        found = []
+        for doc_id in doc_ids:
+            try:
+                found.append(self.find(doc_id))
+            except (ResourceNotFound, ForbiddenAccess):
+                pass
+        return found
+
+    def flush(self) -> None:
+        """Fetches all queued documents."""
+
+        pending = list(self._pending)
+        self._pending.clear()
+        if not pending:
+            return
+
+        if len(pending) == 1:
+            # A batch of one is just a regular lookup.
+            self._find_individually(pending)
+            return
+
+        batch_size = current_app.config.get('PAGINATION_LIMIT', 250)
+        for start in range(0, len(pending), batch_size):
+            self._find_batch(pending[start:start + batch_size])
+
+    def _find_batch(self, doc_ids: typing.List[str]):
+        params = copy.deepcopy(self.params)
+        params['where'] = {'_id': {'$in': doc_ids}}
+        params['max_results'] = len(doc_ids)
+
+        log.debug('batch-fetching %d %s documents', len(doc_ids), self.resource_class.__name__)
+        try:
+            resp = self.resource_class.all(params, api=self.api)
+        except ForbiddenAccess:
+            # Permissions are checked for the listing as a whole, so one
+            # inaccessible document makes the entire batch fail.
+            log.debug('batch-fetch of %s was forbidden, falling back to individual lookups',
+                      self.resource_class.__name__)
+            self._find_individually(doc_ids)
+            return
+
+        for item in resp['_items']:
+            self._loaded[str(item['_id'])] = item.to_dict()
+
+        # Not every document has to be returned by a listing (users can only
+        # list themselves, deleted documents are skipped), so look those up
+        # individually to get the same result as resource_class.find().
+        missing = [doc_id for doc_id in doc_ids if doc_id not in self._loaded]
+        self._find_individually(missing)
+
+    def _find_individually(self, doc_ids: typing.Iterable[str]):
+        for doc_id in doc_ids:
+            try:
+                found = self.resource_class.find(doc_id, self.params or None, api=self.api)
+            except (ResourceNotFound, ForbiddenAccess) as ex:
+                self._loaded[doc_id] = ex
+            else:
+                self._loaded[doc_id] = found.to_dict()
+
+
+def loader(resource_class: typing.Type[pillarsdk.Resource], *, api,
+           params: typing.Optional[dict] = None) -> BatchLoader:
+    """Returns the BatchLoader for this resource class and parameters for the current request.
+
+    Loaders are kept per API token, as that determines the user whose
+    permissions are checked.
+    """
+
+    if not hasattr(g, 'batch_loaders'):
+        g.batch_loaders = {}
+
+    params_key = json.dumps(params, sort_keys=True) if params else ''
+    key = (resource_class.__name__, params_key, api.token)
+    try:
+        return g.batch_loaders[key]
+    except KeyError:
+        batch_loader = BatchLoader(resource_class, api, params)
+        g.batch_loaders[key] = batch_loader
+        return batch_loader
@@ -1,6 +1,8 @@
+import collections
 import logging
+import typing
 
-from flask import Markup
+from flask import Markup, current_app
 
 from pillarsdk import Node
 from pillarsdk.exceptions import ForbiddenAccess
@@ -50,10 +52,9 @@ def jstree_parse_node(node, children=None):
     return parsed_node
 
 
-def jstree_get_children(node_id, project_id=None):
-    api = system_util.pillar_api()
-    children_list = []
-    lookup = {
+def _jstree_children_lookup() -> dict:
+    """Returns the query parameters for fetching children to show in the tree."""
+    return {
         'projection': {
             'name': 1, 'parent': 1, 'node_type': 1, 'properties.order': 1,
             'properties.status': 1, 'properties.content_type': 1, 'user': 1,
@@ -66,6 +67,19 @@ def jstree_get_children(node_id, project_id=None):
             ],
         }
     }
+
+
+def _jstree_is_visible(child) -> bool:
+    # TODO: allow nodes that don't have a status property to be visible
+    # in the node tree (for example blog)
+    is_pub = child.properties.status == 'published'
+    return is_pub or (current_user.is_authenticated and child.user == current_user.objectid)
+
+
+def jstree_get_children(node_id, project_id=None):
+    api = system_util.pillar_api()
+    children_list = []
+    lookup = _jstree_children_lookup()
     if node_id:
         if node_id.startswith('n_'):
             node_id = node_id.split('_')[1]
@@ -77,16 +91,76 @@ def jstree_get_children(node_id, project_id=None):
     try:
         children = Node.all(lookup, api=api)
         for child in children['_items']:
-            # TODO: allow nodes that don't have a status property to be visible
-            # in the node tree (for example blog)
-            is_pub = child.properties.status == 'published'
-            if is_pub or (current_user.is_authenticated and child.user == current_user.objectid):
+            if _jstree_is_visible(child):
                 children_list.append(jstree_parse_node(child))
     except ForbiddenAccess:
         pass
     return children_list
 
 
+def jstree_get_children_of(parent_ids: typing.List[str]) -> typing.Dict[str, list]:
+    """Returns the children of multiple parent nodes, fetched with a single query.
+
+    The query is paginated when there are more children than Eve returns in
+    one page.
+
+    :returns: mapping from parent node ID to its list of jstree children.
+    :raises ForbiddenAccess: when any of the children is not accessible.
+    """
+
+    api = system_util.pillar_api()
+    children_per_parent = collections.defaultdict(list)
+    if not parent_ids:
+        return children_per_parent
+
+    lookup = _jstree_children_lookup()
+    lookup['where']['parent'] = {'$in': list(parent_ids)}
+    lookup['max_results'] = current_app.config.get('PAGINATION_LIMIT', 250)
+
+    page = 1
+    while True:
+        lookup['page'] = page
+        children = Node.all(lookup, api=api)
+        for child in children['_items']:
+            if _jstree_is_visible(child):
+                children_per_parent[child.parent].append(jstree_parse_node(child))
+
+        if page * lookup['max_results'] >= children['_meta']['total']:
+            break
+        page += 1
+
+    return children_per_parent
+
+
+def jstree_get_subtree(project_id, depth: int) -> list:
+    """Returns the project's top-level nodes, with `depth` levels of children prefetched.
+
+    Every level costs one query, regardless of the number of nodes in it.
+    Group nodes below the prefetched depth are loaded by jstree when opened.
+    """
+
+    top_level = jstree_get_children(None, project_id)
+
+    level = top_level
+    for _ in range(depth):
+        groups = [item for item in level if item['children'] is True]
+        if not groups:
+            break
+
+        try:
+            children_per_parent = jstree_get_children_of([item['id'][2:] for item in groups])
+        except ForbiddenAccess:
+            # Leave this level to be loaded by jstree, per group node.
+            break
+
+        level = []
+        for item in groups:
+            item['children'] = children_per_parent.get(item['id'][2:], [])
+            level.extend(item['children'])
+
+    return top_level
+
+
 def jstree_build_children(node):
     return dict(
         id="n_{0}".format(node._id),
@@ -96,12 +170,104 @@ def jstree_build_children(node):
     )
 
 
+def _jstree_find_ancestors(node, projection: dict) -> list:
+    """Returns the node's ancestors, nearest first, using a fixed number of queries.
+
+    The chain stops at the first ancestor that cannot be found (for example
+    because it was deleted).
+
+    :raises ForbiddenAccess: when any of the ancestors is not accessible.
+    """
+    from pillar.api.nodes.hierarchy import find_ancestor_ids
+    from pillar.api.utils import str2id
+
+    if not node.parent:
+        return []
+
+    if node._ancestors:
+        ancestor_ids = list(reversed(node._ancestors))
+    else:
+        ancestor_ids = find_ancestor_ids(str2id(node._id))
+    if not ancestor_ids:
+        return []
+
+    api = system_util.pillar_api()
+    found = Node.all({
+        'where': {'_id': {'$in': [str(ancestor_id) for ancestor_id in ancestor_ids]}},
+        'max_results': len(ancestor_ids),
+        **projection,
+    }, api=api)
+    ancestors_by_id = {ancestor._id: ancestor for ancestor in found['_items']}
+
+    ancestors = []
+    parent_id = node.parent
+    while parent_id in ancestors_by_id:
+        ancestor = ancestors_by_id.pop(parent_id)  # pop() protects against cycles.
+        ancestors.append(ancestor)
+        parent_id = ancestor.parent
+    return ancestors
+
+
 def jstree_build_from_node(node):
     """Give a node, traverse the tree bottom to top and expand the relevant
     branches.
 
+    The ancestors and their children are fetched with a fixed number of
+    queries; when any of those is not accessible to the current user, this
+    falls back to fetching the tree one level at a time.
+
     :param node: the base node, where tree building starts
     """
+    parent_projection = {'projection': {
+        'name': 1,
+        'parent': 1,
+        'project': 1,
+        'node_type': 1,
+        'properties.content_type': 1,
+    }}
+
+    try:
+        ancestors = _jstree_find_ancestors(node, parent_projection)
+    except ForbiddenAccess:
+        return _jstree_build_from_node_per_level(node, parent_projection)
+
+    try:
+        children_per_parent = jstree_get_children_of([ancestor._id for ancestor in ancestors])
+    except ForbiddenAccess:
+        # Get the children per ancestor, so that only the inaccessible ones are skipped.
+        children_per_parent = {ancestor._id: jstree_get_children(ancestor._id)
+                               for ancestor in ancestors}
+
+    # Parse the node and mark it as selected
+    child_node = jstree_parse_node(node)
+    child_node['state'] = dict(selected=True, opened=True)
+
+    # Splice the specified child node between the other project children.
+    def select_node(x):
+        if x['id'] == child_node['id']:
+            return child_node
+        return x
+
+    for parent in ancestors:
+        parent_parent = jstree_parse_node(parent)
+        parent_children = [select_node(x) for x in children_per_parent.get(parent._id, [])]
+        parent_parent.pop('children', None)
+        # Overwrite children_node with the current parent
+        child_node = parent_parent
+        # Set the node to open so that jstree actually displays the nodes
+        child_node['state'] = dict(selected=True, opened=True)
+        # Push in the computed children into the parent
+        child_node['children'] = parent_children
+
+    # Get top level nodes for the project
+    project_children = jstree_get_children(None, node.project)
+
+    nodes_list = [select_node(x) for x in project_children]
+    return nodes_list
+
+
+def _jstree_build_from_node_per_level(node, parent_projection: dict):
+    """Builds the tree like jstree_build_from_node(), with queries per level."""
     api = system_util.pillar_api()
     # Parse the node and mark it as selected
     child_node = jstree_parse_node(node)
@@ -115,13 +281,6 @@ def jstree_build_from_node(node):
 
     # Get the parent node
     parent = None
-    parent_projection = {'projection': {
-        'name': 1,
-        'parent': 1,
-        'project': 1,
-        'node_type': 1,
-        'properties.content_type': 1,
-    }}
 
     if node.parent:
         try:
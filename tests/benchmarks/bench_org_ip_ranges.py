@@ -0,0 +1,82 @@
+"""Benchmark of looking up organization roles by IP address.
+
+Compares the in-memory IP range index with the MongoDB query it replaced,
+for 10k organization IP ranges. Not collected by the regular test run; run
+explicitly with:
+
+    python -m pytest -s tests/benchmarks/bench_org_ip_ranges.py
+"""
+
+import random
+import time
+
+from pillar.api.organizations import ip_ranges
+from pillar.tests import AbstractPillarTest
+
+RANGE_COUNT = 10000
+RANGES_PER_ORG = 10
+LOOKUPS = 1000
+
+
+class OrgIPRangesBenchmark(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        rng = random.Random(47)
+        org_docs = []
+        for org_idx in range(RANGE_COUNT // RANGES_PER_ORG):
+            iprs = []
+            for _ in range(RANGES_PER_ORG):
+                if rng.random() < 0.5:
+                    addr = '.'.join(str(rng.randrange(256)) for _ in range(4))
+                    iprs.append(ip_ranges.doc(f'{addr}/{rng.randrange(16, 33)}'))
+                else:
+                    addr = ':'.join(f'{rng.randrange(2 ** 16):x}' for _ in range(8))
+                    iprs.append(ip_ranges.doc(f'{addr}/{rng.randrange(48, 129)}'))
+            org_docs.append({
+                'name': f'Organization {org_idx}',
+                'org_roles': [f'org-role{org_idx % 50}'],
+                'ip_ranges': iprs,
+            })
+
+        with self.app.app_context():
+            self.app.db('organizations').insert_many(org_docs)
+
+        self.addresses = ['.'.join(str(rng.randrange(256)) for _ in range(4))
+                          for _ in range(LOOKUPS // 2)]
+        self.addresses.extend(':'.join(f'{rng.randrange(2 ** 16):x}' for _ in range(8))
+                              for _ in range(LOOKUPS // 2))
+
+    def _roles_via_query(self, remote_addr: str) -> set:
+        orgs = self.app.db('organizations').find(
+            {'ip_ranges': ip_ranges.query(remote_addr)},
+            projection={'org_roles': True},
+        )
+        return set(role for org in orgs for role in org.get('org_roles', []))
+
+    def test_benchmark(self):
+        om = self.app.org_manager
+
+        with self.app.app_context():
+            start = time.perf_counter()
+            index = om.rebuild_ip_index()
+            build_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for addr in self.addresses:
+                om.roles_for_ip_address(addr)
+            index_time = (time.perf_counter() - start) / len(self.addresses)
+
+            start = time.perf_counter()
+            for addr in self.addresses:
+                self._roles_via_query(addr)
+            query_time = (time.perf_counter() - start) / len(self.addresses)
+
+            for addr in self.addresses:
+                self.assertEqual(self._roles_via_query(addr), om.roles_for_ip_address(addr))
+
+        print()
+        print(f'{RANGE_COUNT} ranges, {len(index)} segments, built in {build_time * 1000:.1f}ms')
+        print(f'{"index":8} {index_time * 1e6:10.1f}µs per lookup')
+        print(f'{"query":8} {query_time * 1e6:10.1f}µs per lookup')
+        print(f'{"speedup":8} {query_time / index_time:10.1f}x')
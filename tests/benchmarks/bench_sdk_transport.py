@@ -0,0 +1,69 @@
+"""Benchmark of the PillarSDK transports used by the web layer.
+
+Not collected by the regular test run; run explicitly with:
+
+    python -m pytest -s tests/benchmarks/bench_sdk_transport.py
+"""
+
+import time
+
+from bson import ObjectId
+
+from pillar.tests import AbstractPillarTest
+
+ITERATIONS = 50
+
+
+class SDKTransportBenchmark(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        self.project_id, self.project = self.ensure_project_exists()
+        self.user_id = self.create_project_admin(self.project)
+        self.create_valid_auth_token(self.user_id, 'token')
+
+        self.group_id = self.create_node({
+            '_id': ObjectId(),
+            'description': '',
+            'project': self.project_id,
+            'node_type': 'group',
+            'user': self.user_id,
+            'properties': {'status': 'published'},
+            'name': 'Benchmark group',
+        })
+        for idx in range(20):
+            self.create_node({
+                '_id': ObjectId(),
+                'description': '',
+                'project': self.project_id,
+                'node_type': 'group',
+                'parent': self.group_id,
+                'user': self.user_id,
+                'properties': {'status': 'published'},
+                'name': f'Child {idx}',
+            })
+
+    def _time_url(self, transport: str, url: str) -> float:
+        self.app.config['SDK_INTERNAL_TRANSPORT'] = transport
+
+        # Warm up caches and imports.
+        self.get(url, auth_token='token')
+
+        start = time.perf_counter()
+        for _ in range(ITERATIONS):
+            self.get(url, auth_token='token')
+        return (time.perf_counter() - start) / ITERATIONS
+
+    def test_benchmark(self):
+        urls = {
+            'projects.view': self.url_for('projects.view', project_url=self.project['url']),
+            'nodes.view': self.url_for('nodes.view', node_id=str(self.group_id)),
+        }
+
+        print()
+        print(f'{"endpoint":16} {"test-client":>12} {"direct":>12} {"speedup":>8}')
+        for endpoint, url in urls.items():
+            via_client = self._time_url('test-client', url)
+            via_direct = self._time_url('direct', url)
+            print(f'{endpoint:16} {via_client * 1000:10.2f}ms {via_direct * 1000:10.2f}ms '
+                  f'{via_client / via_direct:7.2f}x')
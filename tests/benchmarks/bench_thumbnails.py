@@ -0,0 +1,101 @@
+"""Benchmark of thumbnail generation for large images.
+
+Compares generate_local_thumbnails() with decoding the image for every
+thumbnail size and resampling each from the original, as it was done before.
+Every run happens in a forked process to measure its peak memory usage.
+Not collected by the regular test run; run explicitly with:
+
+    python -m pytest -s tests/benchmarks/bench_thumbnails.py
+"""
+
+import multiprocessing
+import pathlib
+import resource
+import shutil
+import tempfile
+import time
+
+from pillar.tests import AbstractPillarTest
+
+# 8K UHD
+IMAGE_SIZE = (7680, 4320)
+
+
+def generate_per_size(fp_base: str, src: pathlib.Path):
+    """Thumbnail generation as it was done before, for comparison."""
+    from PIL import Image
+    from flask import current_app
+    from pillar.api.utils import imaging
+
+    for size, settings in current_app.config['UPLOADS_LOCAL_STORAGE_THUMBNAILS'].items():
+        im = Image.open(src)
+        if settings['crop']:
+            im = imaging.resize_and_crop(im, settings['size'])
+        else:
+            im.thumbnail(settings['size'], resample=Image.LANCZOS)
+        dst = src.with_name(f'{src.stem}-{size}.jpg')
+        im.convert('RGB').save(dst, format='JPEG', optimize=True, quality=95)
+
+
+class ThumbnailBenchmark(AbstractPillarTest):
+    @classmethod
+    def setUpClass(cls):
+        from PIL import Image
+
+        super().setUpClass()
+        cls._tmp = tempfile.TemporaryDirectory()
+        cls.sources = {}
+
+        image = Image.merge('RGB', [
+            Image.effect_noise(IMAGE_SIZE, 40),
+            Image.linear_gradient('L').resize(IMAGE_SIZE),
+            Image.effect_mandelbrot(IMAGE_SIZE, (-2, -1.5, 1, 1.5), 100),
+        ])
+        for imformat, suffix in (('PNG', '.png'), ('JPEG', '.jpg'), ('TIFF', '.tif')):
+            path = pathlib.Path(cls._tmp.name) / f'source{suffix}'
+            image.save(path, format=imformat)
+            cls.sources[imformat] = path
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmp.cleanup()
+        super().tearDownClass()
+
+    def _measure(self, generate, source: pathlib.Path) -> (float, float):
+        """Run generate() in a child process.
+
+        :returns: tuple (duration in seconds, peak RSS increase in MiB)
+        """
+
+        def run(conn):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                src = pathlib.Path(tmpdir) / source.name
+                shutil.copy(str(source), str(src))
+
+                with self.app.app_context():
+                    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                    start = time.perf_counter()
+                    generate('bench', src)
+                    duration = time.perf_counter() - start
+                    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            conn.send((duration, (rss_after - rss_before) / 1024))
+
+        ctx = multiprocessing.get_context('fork')
+        parent_conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(target=run, args=(child_conn,))
+        proc.start()
+        result = parent_conn.recv()
+        proc.join()
+        return result
+
+    def test_benchmark(self):
+        from pillar.api.utils import imaging
+
+        print()
+        print(f'{IMAGE_SIZE[0]}x{IMAGE_SIZE[1]} source images')
+        print(f'{"format":6} {"method":12} {"time":>8} {"peak RSS":>10}')
+        for imformat, source in self.sources.items():
+            for method, generate in (('per-size', generate_per_size),
+                                     ('single', imaging.generate_local_thumbnails)):
+                duration, rss_mib = self._measure(generate, source)
+                print(f'{imformat:6} {method:12} {duration:7.2f}s {rss_mib:7.0f} MiB')
@@ -3,6 +3,8 @@
 import copy
 import datetime
 import json
+import typing
+from unittest import mock
 from urllib.parse import urljoin
 
 import pillar.tests.common_test_data as ctd
@@ -265,6 +267,45 @@ class AuthenticationTests(AbstractPillarTest):
         self.assertIn('token_hashed', db_token)
 
 
+    def test_validate_token__keeps_expired_tokens(self):
+        """Token validation only reads; expired tokens are deleted by a TTL index."""
+
+        from pillar.api.utils import authentication as auth
+
+        user_id = self.create_user()
+        self.create_valid_auth_token(user_id, 'expired-long-ago', expire_in_days=-30)
+        self.create_valid_auth_token(user_id, 'valid', expire_in_days=1)
+
+        with self.app.test_request_context(headers={'Authorization': self.make_header('valid')}):
+            self.assertTrue(auth.validate_token())
+
+            tokens_coll = self.app.db('tokens')
+            self.assertIsNotNone(tokens_coll.find_one({'token': 'expired-long-ago'}))
+
+    def test_token_expiry_index(self):
+        import pymongo
+        from pillar.api.utils import authentication as auth
+
+        with self.app.app_context():
+            tokens_coll = self.app.db('tokens')
+            self.assertTrue(auth.create_token_expiry_index(tokens_coll))
+            expiry_indices = [index for index in tokens_coll.list_indexes()
+                              if dict(index['key']) == {'expire_time': 1}]
+            self.assertEqual(1, len(expiry_indices))
+            self.assertEqual(7 * 24 * 3600, expiry_indices[0]['expireAfterSeconds'])
+
+            # A non-TTL index is only replaced when explicitly requested.
+            tokens_coll.drop_index(expiry_indices[0]['name'])
+            tokens_coll.create_index([('expire_time', pymongo.ASCENDING)])
+            self.assertFalse(auth.create_token_expiry_index(tokens_coll))
+            self.assertTrue(auth.create_token_expiry_index(tokens_coll, replace_existing=True))
+
+            expiry_indices = [index for index in tokens_coll.list_indexes()
+                              if dict(index['key']) == {'expire_time': 1}]
+            self.assertEqual(1, len(expiry_indices))
+            self.assertEqual(7 * 24 * 3600, expiry_indices[0]['expireAfterSeconds'])
+
+
 class UserListTests(AbstractPillarTest):
     """Security-related tests."""
 
@@ -602,6 +643,73 @@ class PermissionComputationTest(AbstractPillarTest):
         self.assertFalse(found.get('_deleted', False))
 
 
+class ProjectPermissionCacheTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+        self.app.config['PROJECT_PERMISSIONS_CACHE_TIMEOUT'] = 60
+
+        self.proj_id, self.project = self.ensure_project_exists(project_overrides=EXAMPLE_PROJECT)
+        self.node = copy.deepcopy(EXAMPLE_NODE)
+
+    def allowed_methods(self, group_ids=(), roles=frozenset(), node=None) -> set:
+        from pillar.api.utils.authorization import compute_allowed_methods
+
+        with self.app.test_request_context():
+            self.login_api_as(ObjectId(24 * 'a'), roles=roles, group_ids=list(group_ids))
+            return compute_allowed_methods('nodes', node or self.node)
+
+    def test_same_as_merged_permissions(self):
+        node_with_perms = copy.deepcopy(self.node)
+        node_with_perms['permissions'] = {
+            'users': [{'user': ObjectId(24 * 'a'), 'methods': ['PUT']}],
+        }
+
+        cases = [
+            {},
+            {'group_ids': [ObjectId('5596e975ea893b269af85c0f')]},
+            {'group_ids': [ObjectId('5596e975ea893b269af85c0e')]},
+            {'roles': {'admin'}},
+            {'node': node_with_perms},
+        ]
+        for kwargs in cases:
+            node = kwargs.pop('node', self.node)
+
+            # With an embedded project, the permissions are merged as dicts.
+            embedded = copy.deepcopy(node)
+            embedded['project'] = EXAMPLE_PROJECT
+
+            self.assertEqual(self.allowed_methods(node=embedded, **kwargs),
+                             self.allowed_methods(node=node, **kwargs),
+                             kwargs)
+
+    def test_no_project_queries_when_warm(self):
+        from pillar.api.utils import authorization
+
+        with mock.patch.object(authorization, '_load_project_node_type_entry',
+                               wraps=authorization._load_project_node_type_entry) as mock_load:
+            for _ in range(3):
+                self.assertEqual({'GET'}, self.allowed_methods())
+            self.assertEqual(1, mock_load.call_count)
+
+    def test_invalidated_on_project_change(self):
+        from pillar.api.utils import remove_private_keys
+
+        group_id = ObjectId('5596e975ea893b269af85c0f')
+        self.assertEqual({'DELETE', 'GET'}, self.allowed_methods([group_id]))
+
+        # Remove the node type permissions through Eve.
+        self.create_user(24 * 'f', roles={'admin'}, token='admin-token')
+        with self.app.app_context():
+            db_proj = self.app.db('projects').find_one(self.proj_id)
+        put_proj = remove_private_keys(db_proj)
+        for node_type in put_proj['node_types']:
+            node_type['permissions'] = {}
+        self.put(f'/api/projects/{self.proj_id}', json=put_proj, etag=db_proj['_etag'],
+                 auth_token='admin-token')
+
+        self.assertEqual({'GET'}, self.allowed_methods([group_id]))
+
+
 class RequireRolesTest(AbstractPillarTest):
     def test_no_roles_required(self):
         from pillar.api.utils.authorization import require_login
@@ -887,3 +995,105 @@ class CurrentUserTest(AbstractPillarTest):
             self.assertIsNone(user.user_id)
             self.assertTrue(user.is_anonymous)
             self.assertFalse(user.is_authenticated)
+
+
+class TokenCacheTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        from pillar.api.utils import token_cache
+
+        super().setUp(**kwargs)
+        self.app.config['AUTH_TOKEN_CACHE_TIMEOUT'] = 60
+
+        # All tests use the same user and token, so don't let them see each other's entries.
+        token_cache.clear_local()
+        self.addCleanup(token_cache.clear_local)
+        self.user_id = self.create_user(24 * 'd', roles={'subscriber'}, token='user-token')
+
+    def validate(self, token='user-token') -> typing.Optional[dict]:
+        from pillar.api.utils import authentication as auth
+
+        with self.app.test_request_context(headers={'Authorization': self.make_header(token)}):
+            if not auth.validate_token():
+                return None
+            from flask import g
+            return {'roles': set(g.current_user.roles), 'full_name': g.current_user.full_name}
+
+    def set_full_name(self, full_name: str):
+        with self.app.app_context():
+            self.app.db('users').update_one({'_id': self.user_id},
+                                            {'$set': {'full_name': full_name}})
+
+    def test_cached(self):
+        self.set_full_name('Old Name')
+        self.assertEqual('Old Name', self.validate()['full_name'])
+
+        # Changing the database directly isn't seen until the cache entry expires.
+        self.set_full_name('New Name')
+        self.assertEqual('Old Name', self.validate()['full_name'])
+
+    def test_shared_cache(self):
+        from flask_caching import Cache
+        from pillar.api.utils import token_cache
+
+        self.app.cache = Cache(self.app, config={'CACHE_TYPE': 'simple'})
+
+        self.set_full_name('Old Name')
+        self.assertEqual('Old Name', self.validate()['full_name'])
+
+        # Another process would only see the shared cache.
+        token_cache.clear_local()
+        self.set_full_name('New Name')
+        self.assertEqual('Old Name', self.validate()['full_name'])
+
+        with self.app.app_context():
+            token_cache.invalidate_user(self.user_id)
+        self.assertEqual('New Name', self.validate()['full_name'])
+
+    def test_remove_token(self):
+        from pillar.api.utils import authentication as auth
+
+        self.assertIsNotNone(self.validate())
+        with self.app.app_context():
+            auth.remove_token('user-token')
+        self.assertIsNone(self.validate())
+
+    def test_user_put(self):
+        from pillar.api.utils import remove_private_keys
+
+        self.assertEqual('', self.validate()['full_name'])
+
+        with self.app.app_context():
+            db_user = self.app.db('users').find_one(self.user_id)
+        puttable = remove_private_keys(db_user)
+        puttable['full_name'] = 'Put Name'
+        self.put(f'/api/users/{self.user_id}', json=puttable, etag=db_user['_etag'],
+                 auth_token='user-token')
+
+        self.assertEqual('Put Name', self.validate()['full_name'])
+
+    def test_roles_changed(self):
+        from pillar.api.service import signal_user_changed_role
+
+        self.assertEqual({'subscriber'}, self.validate()['roles'])
+
+        with self.app.app_context():
+            users_coll = self.app.db('users')
+            users_coll.update_one({'_id': self.user_id}, {'$set': {'roles': ['demo']}})
+            signal_user_changed_role.send(self.app, user=users_coll.find_one(self.user_id))
+
+        self.assertEqual({'demo'}, self.validate()['roles'])
+
+    def test_never_past_token_expiry(self):
+        from pillar.api.utils import token_cache
+        from pillar.api.utils import utcnow
+
+        from pillar.api.utils.authentication import hash_auth_token
+
+        self.assertIsNotNone(self.validate())
+        with self.app.app_context():
+            token_hashed = hash_auth_token('user-token')
+            self.assertIsNotNone(token_cache.get(token_hashed, False))
+
+            after_expiry = utcnow() + datetime.timedelta(days=2)
+            with mock.patch('pillar.api.utils.token_cache.utcnow', return_value=after_expiry):
+                self.assertIsNone(token_cache.get(token_hashed, False))
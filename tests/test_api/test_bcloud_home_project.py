@@ -381,6 +381,32 @@ class HomeProjectUserChangedRoleTest(AbstractPillarTest):
         # The home project should NOT be writable, so we should NOT be able to create a node.
         self.create_test_node(home_proj['_id'], 403)
 
+    def test_revoking_subscriber_role_cached_permissions(self):
+        from pillar.api.blender_cloud import home_project
+        from pillar.api.utils.authentication import validate_token
+
+        self.app.config['PROJECT_PERMISSIONS_CACHE_TIMEOUT'] = 60
+        self.user_id = self.create_user(roles=set('subscriber'))
+        self.create_valid_auth_token(self.user_id, 'token')
+
+        with self.app.test_request_context(headers={'Authorization': self.make_header('token')}):
+            validate_token()
+            home_proj = home_project.create_home_project(self.user_id, write_access=True)
+
+        # This caches the project's permissions.
+        self.create_test_node(home_proj['_id'])
+
+        with self.app.test_request_context(headers={'Authorization': self.make_header('token')}):
+            validate_token()
+            changed = home_project.user_changed_role(None, {'_id': self.user_id,
+                                                            'roles': []})
+            self.assertTrue(changed)
+
+            db_proj = self.app.db('projects').find_one(home_proj['_id'])
+            self.assertNotEqual(home_proj['_etag'], db_proj['_etag'])
+
+        self.create_test_node(home_proj['_id'], 403)
+
     def create_test_node(self, project_id, status_code=201):
         from pillar.api.utils import dumps
 
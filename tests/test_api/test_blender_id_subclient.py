@@ -109,3 +109,88 @@ class BlenderIdSubclientTest(AbstractPillarTest):
             self.assertIsNotNone(db_token)
 
         return db_user
+
+
+class BlenderIdValidationCoalescingTest(AbstractPillarTest):
+    """Tests the negative cache and single-flight validation against a stub Blender ID."""
+
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+        from pillar.api import blender_id
+
+        self.validate_url = urljoin(self.app.config['BLENDER_ID_ENDPOINT'], 'u/validate_token')
+        self.app.config['BLENDER_ID_NEGATIVE_CACHE_TIMEOUT'] = 30
+        blender_id._reset_validation_state()
+
+    @responses.activate
+    def test_negative_cache(self):
+        from pillar.api import blender_id
+
+        self.mock_blenderid_validate_unhappy()
+
+        with self.app.test_request_context():
+            self.assertEqual((None, None), blender_id.validate_create_user('', 'revoked', ''))
+            self.assertEqual((None, None), blender_id.validate_create_user('', 'revoked', ''))
+
+        self.assertEqual(1, len(responses.calls))
+        stats = blender_id.validation_stats()
+        self.assertEqual(1, stats['upstream_calls'])
+        self.assertEqual(1, stats['rejected'])
+        self.assertEqual(1, stats['negative_cache_hits'])
+
+    @responses.activate
+    def test_negative_cache_skips_connection_errors(self):
+        from pillar.api import blender_id
+
+        # No mocked response, so Blender ID cannot be reached.
+        with self.app.test_request_context():
+            self.assertEqual((None, None), blender_id.validate_create_user('', 'some-token', ''))
+            self.assertEqual((None, None), blender_id.validate_create_user('', 'some-token', ''))
+
+        stats = blender_id.validation_stats()
+        self.assertEqual(2, stats['upstream_calls'])
+        self.assertNotIn('negative_cache_hits', stats)
+
+    @responses.activate
+    def test_single_flight(self):
+        import threading
+        import time
+        from pillar.api import blender_id
+        from pillar.tests import BLENDER_ID_USER_RESPONSE
+
+        thread_count = 5
+
+        def slow_blender_id(request):
+            # Give the other threads time to start validating the same token.
+            time.sleep(0.5)
+            return 200, {}, json.dumps(BLENDER_ID_USER_RESPONSE)
+
+        responses.add_callback(responses.POST, self.validate_url, callback=slow_blender_id,
+                               content_type='application/json')
+
+        barrier = threading.Barrier(thread_count)
+        results = []
+
+        def validate():
+            with self.app.test_request_context():
+                barrier.wait()
+                db_user, _ = blender_id.validate_create_user('', 'new-token', '')
+                results.append(db_user)
+
+        threads = [threading.Thread(target=validate) for _ in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(responses.calls))
+        self.assertEqual(thread_count, len(results))
+        self.assertEqual({TEST_EMAIL_ADDRESS}, {db_user['email'] for db_user in results})
+
+        stats = blender_id.validation_stats()
+        self.assertEqual(1, stats['upstream_calls'])
+        self.assertEqual(thread_count - 1, stats['single_flight_shared'])
+
+        with self.app.app_context():
+            tokens_coll = self.app.db('tokens')
+            self.assertEqual(1, tokens_coll.count_documents({'token': 'new-token'}))
@@ -0,0 +1,115 @@
+import io
+import os
+import time
+
+from pillar.tests import AbstractPillarTest
+
+
+class BlobCacheTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        from pillar.api.file_storage_backends.local import LocalBucket, LocalBlob
+
+        class CountingBlob(LocalBlob):
+            downloads = 0
+
+            def download_to_file(self, file_obj):
+                type(self).downloads += 1
+                super().download_to_file(file_obj)
+
+            def cache_validator(self):
+                try:
+                    stat = self.abspath().stat()
+                except FileNotFoundError:
+                    raise FileNotFoundError(f'{self} does not exist')
+                self._size_in_bytes = stat.st_size
+                return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+        class CachingBucket(LocalBucket):
+            backend_name = 'unittest-cached'
+            cache_downloads = True
+
+            def blob(self, blob_name: str) -> CountingBlob:
+                return CountingBlob(name=blob_name, bucket=self)
+
+        self.blob_class = CountingBlob
+        self.bucket_class = CachingBucket
+        self.app.config['BLOB_CACHE_MAX_BYTES'] = 3000
+
+        self.enter_app_context()
+        self.bucket = self.bucket_class(24 * 'a')
+
+    def tearDown(self):
+        from pillar.api.file_storage_backends import Bucket, blob_cache
+
+        blob_cache.clear()
+        del Bucket.backends['unittest-cached']
+        super().tearDown()
+
+    def create_blob(self, name: str, contents: bytes):
+        blob = self.bucket.blob(name)
+        blob.create_from_file(io.BytesIO(contents), content_type='application/octet-stream')
+        return blob
+
+    def test_hit_and_miss(self):
+        from pillar.api.file_storage_backends import blob_cache
+
+        contents = os.urandom(1000)
+        blob = self.create_blob('somefile.bin', contents)
+        hits, misses, _ = blob_cache.stats()
+
+        for _ in range(3):
+            with blob_cache.open_blob(self.bucket.blob('somefile.bin')) as local_file:
+                self.assertEqual(contents, local_file.read())
+
+        self.assertEqual(1, self.blob_class.downloads)
+        self.assertEqual((hits + 2, misses + 1), blob_cache.stats()[:2])
+        self.assertEqual((1, 1000), blob_cache.disk_usage())
+
+        # Changing the blob should invalidate the cached copy.
+        new_contents = os.urandom(1200)
+        self.create_blob('somefile.bin', new_contents)
+        outfile = io.BytesIO()
+        blob_cache.download_to_file(blob, outfile)
+        self.assertEqual(new_contents, outfile.getvalue())
+        self.assertEqual(2, self.blob_class.downloads)
+
+    def test_eviction(self):
+        from pillar.api.file_storage_backends import blob_cache
+
+        for idx in range(4):
+            blob = self.create_blob(f'file-{idx}.bin', os.urandom(1000))
+            blob_cache.open_blob(blob).close()
+            time.sleep(0.01)  # Eviction order is based on file modification times.
+
+            # Using the first file should keep it in the cache.
+            blob_cache.open_blob(self.bucket.blob('file-0.bin')).close()
+            time.sleep(0.01)
+
+        self.assertEqual((3, 3000), blob_cache.disk_usage())
+        self.assertEqual(4, self.blob_class.downloads)
+
+        blob_cache.open_blob(self.bucket.blob('file-0.bin')).close()
+        blob_cache.open_blob(self.bucket.blob('file-3.bin')).close()
+        self.assertEqual(4, self.blob_class.downloads)
+
+    def test_missing_blob(self):
+        from pillar.api.file_storage_backends import blob_cache
+
+        with self.assertRaises(FileNotFoundError):
+            blob_cache.open_blob(self.bucket.blob('nonexistent.bin'))
+
+    def test_disabled(self):
+        from pillar.api.file_storage_backends import blob_cache
+
+        self.app.config['BLOB_CACHE_MAX_BYTES'] = 0
+        contents = os.urandom(1000)
+        blob = self.create_blob('somefile.bin', contents)
+
+        for _ in range(2):
+            with blob_cache.open_blob(blob) as local_file:
+                self.assertEqual(contents, local_file.read())
+
+        self.assertEqual(2, self.blob_class.downloads)
+        self.assertFalse(blob_cache.is_cacheable('unittest-cached'))
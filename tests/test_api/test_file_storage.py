@@ -1,7 +1,13 @@
 import io
 import json
 import os
+import pathlib
 import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from bson import ObjectId
 
 import pillar.tests.common_test_data as ctd
 import rsa.randnum
@@ -51,6 +57,415 @@ class FileStorageTest(AbstractPillarTest):
         self.assertEqual('application/awesome-type', fake.mimetype)
 
 
+class VariationUploadTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.file_id = ObjectId(24 * 'f')
+
+        self.variations = []
+        for size in ('s', 'b', 't', 'm', 'l', 'h'):
+            local_path = pathlib.Path(self.tmpdir.name) / f'thumb-{size}.jpg'
+            local_path.write_bytes(b'JPEG')
+            self.variations.append({
+                'size': size,
+                'file_path': f'abc-{size}.jpg',
+                'local_path': str(local_path),
+                'content_type': 'image/jpeg',
+            })
+        self.local_paths = [pathlib.Path(var['local_path']) for var in self.variations]
+
+        blobs = self.blobs = {var['file_path']: mock.Mock() for var in self.variations}
+        buckets = self.buckets = []
+
+        class FakeBucket:
+            def __init__(self, name, subdir='_'):
+                self.name = name
+                self.subdir = subdir
+                buckets.append(self)
+
+            def clone(self):
+                return FakeBucket(self.name, self.subdir)
+
+            def blob(self, blob_name):
+                return blobs[blob_name]
+
+        self.bucket = FakeBucket('some-project', subdir='custom')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def _upload(self):
+        from pillar.api.file_storage import _upload_variations
+
+        with self.app.app_context(), mock.patch.dict(self.app.config, {'TESTING': False}):
+            _upload_variations(self.bucket, self.file_id, self.variations)
+
+    def test_concurrent_upload(self):
+        # Block all uploads until they are all running at the same time.
+        barrier = threading.Barrier(len(self.variations), timeout=5)
+        for blob in self.blobs.values():
+            blob.upload_from_path.side_effect = lambda *args, **kwargs: barrier.wait()
+
+        self._upload()
+
+        for var in self.variations:
+            self.assertNotIn('local_path', var)
+            blob = self.blobs[var['file_path']]
+            blob.upload_from_path.assert_called_once()
+            if var['size'] == 't':
+                blob.make_public.assert_called_once_with()
+            else:
+                blob.make_public.assert_not_called()
+        self.assertFalse(any(path.exists() for path in self.local_paths))
+
+        # Every upload should have used its own bucket.
+        self.assertEqual(len(self.variations) + 1, len(self.buckets))
+        self.assertTrue(all(bucket.name == 'some-project' for bucket in self.buckets))
+        self.assertTrue(all(bucket.subdir == 'custom' for bucket in self.buckets))
+
+    def test_failures_per_variation(self):
+        from pillar.api.file_storage import VariationUploadError
+
+        self.blobs['abc-b.jpg'].upload_from_path.side_effect = IOError('nope')
+        self.blobs['abc-t.jpg'].make_public.side_effect = IOError('also nope')
+
+        with self.assertRaises(VariationUploadError) as ctx:
+            self._upload()
+
+        self.assertEqual(['abc-b.jpg', 'abc-t.jpg'], ctx.exception.failed_paths)
+        self.assertEqual(self.file_id, ctx.exception.file_id)
+
+        # Other variations were still uploaded, and all local files are gone.
+        self.blobs['abc-h.jpg'].upload_from_path.assert_called_once()
+        self.assertFalse(any(path.exists() for path in self.local_paths))
+        for var in self.variations:
+            self.assertNotIn('local_path', var)
+
+
+class FileProcessingTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        self.project_id, _ = self.ensure_project_exists()
+        self.user_id = self.create_user(groups=[ctd.EXAMPLE_ADMIN_GROUP_ID], roles=set())
+        self.create_valid_auth_token(self.user_id, 'token')
+
+        self.image_path = pathlib.Path(__file__).with_name('images') / '512x512-8bit-rgb.jpg'
+
+    def _upload_queued(self) -> (ObjectId, tuple):
+        """Uploads the image without processing it.
+
+        :returns: the file ID and the arguments of the queued Celery task.
+        """
+        with self.app.app_context():
+            from pillar.celery import file_processing
+
+        with mock.patch.object(file_processing.process_uploaded_file, 'delay') as mock_delay:
+            with self.image_path.open('rb') as image_file:
+                resp = self.post(f'/api/storage/stream/{self.project_id}',
+                                 expected_status=201,
+                                 auth_token='token',
+                                 files={'file': (image_file, 'image.jpg', 'image/jpeg')})
+        file_id = resp.get_json()['file_id']
+        mock_delay.assert_called_once()
+        return ObjectId(file_id), mock_delay.call_args[0]
+
+    def _file_doc(self, file_id: ObjectId) -> dict:
+        with self.app.app_context():
+            return self.app.db('files').find_one(file_id)
+
+    def test_upload_queues_processing(self):
+        file_id, (task_file_id, spool_path, may_encode_video) = self._upload_queued()
+
+        self.assertEqual(str(file_id), task_file_id)
+        self.assertFalse(may_encode_video)
+        self.assertEqual(self.image_path.read_bytes(), pathlib.Path(spool_path).read_bytes())
+
+        file_doc = self._file_doc(file_id)
+        self.assertEqual('queued_for_processing', file_doc['status'])
+        self.assertNotIn('variations', file_doc)
+
+    def test_process_spooled(self):
+        from pillar.api import file_storage
+
+        file_id, (_, spool_path, _) = self._upload_queued()
+
+        with self.app.app_context(), \
+                mock.patch.object(file_storage.Bucket, 'for_backend') as mock_for_backend:
+            file_storage.process_stored_file(file_id, pathlib.Path(spool_path),
+                                             may_encode_video=False)
+
+        # The spooled file should have been used, instead of downloading from storage.
+        mock_blob = mock_for_backend.return_value.return_value.blob
+        mock_blob.return_value.download_to_file.assert_not_called()
+
+        file_doc = self._file_doc(file_id)
+        self.assertEqual('complete', file_doc['status'])
+        self.assertEqual({'s', 'b', 't', 'm', 'l', 'h'},
+                         {var['size'] for var in file_doc['variations']})
+
+    def test_process_downloaded_and_retry(self):
+        from pillar.api import file_storage
+
+        file_id, (_, spool_path, _) = self._upload_queued()
+        pathlib.Path(spool_path).unlink()
+
+        with self.app.app_context():
+            file_storage.process_stored_file(file_id, pathlib.Path(spool_path),
+                                             may_encode_video=False)
+        file_doc = self._file_doc(file_id)
+        self.assertEqual('complete', file_doc['status'])
+        self.assertEqual((512, 512), (file_doc['width'], file_doc['height']))
+
+        # Processing it again should be a no-op.
+        with self.app.app_context(), \
+                mock.patch.object(file_storage, 'process_file') as mock_process_file:
+            file_storage.process_stored_file(file_id, None, may_encode_video=False)
+        mock_process_file.assert_not_called()
+
+    def test_processing_error(self):
+        from pillar.api import file_storage
+
+        file_id, (_, spool_path, _) = self._upload_queued()
+
+        with self.app.app_context(), \
+                mock.patch.object(file_storage.imaging, 'generate_local_thumbnails',
+                                  side_effect=OSError('disk full')), \
+                self.assertRaises(OSError):
+            file_storage.process_stored_file(file_id, pathlib.Path(spool_path),
+                                             may_encode_video=False)
+
+        self.assertEqual('queued_for_processing', self._file_doc(file_id)['status'])
+
+
+class RawStreamUploadTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        self.project_id, _ = self.ensure_project_exists()
+        self.user_id = self.create_user(groups=[ctd.EXAMPLE_ADMIN_GROUP_ID],
+                                        roles={'subscriber'}, token='token')
+
+    def _put_raw(self, data: bytes, filename: str, content_type: str, expected_status=201):
+        return self.put(f'/api/storage/stream/{self.project_id}/raw',
+                        qs={'filename': filename},
+                        data=data,
+                        content_type=content_type,
+                        auth_token='token',
+                        expected_status=expected_status)
+
+    def _file_doc(self, file_id: str) -> dict:
+        with self.app.app_context():
+            return self.app.db('files').find_one(ObjectId(file_id))
+
+    def test_upload_binary(self):
+        import hashlib
+        from pillar.api.file_storage_backends.local import LocalBucket
+
+        contents = os.urandom(100 * 2 ** 10)
+        resp = self._put_raw(contents, 'data.bin', 'application/octet-stream')
+
+        file_doc = self._file_doc(resp.get_json()['file_id'])
+        self.assertEqual('complete', file_doc['status'])
+        self.assertEqual(len(contents), file_doc['length'])
+        self.assertEqual('data.bin', file_doc['filename'])
+        self.assertEqual(hashlib.md5(contents).hexdigest(), file_doc['md5'])
+        self.assertEqual(hashlib.sha256(contents).hexdigest(), file_doc['sha256'])
+
+        with self.app.app_context():
+            blob = LocalBucket(str(self.project_id)).blob(file_doc['file_path'])
+            self.assertEqual(contents, blob.abspath().read_bytes())
+
+    def test_upload_image_is_spooled(self):
+        with self.app.app_context():
+            from pillar.celery import file_processing
+
+        contents = (pathlib.Path(__file__).with_name('images') / '512x512-8bit-rgb.jpg') \
+            .read_bytes()
+        with mock.patch.object(file_processing.process_uploaded_file, 'delay') as mock_delay:
+            resp = self._put_raw(contents, 'image.jpg', 'image/jpeg')
+
+        file_id = resp.get_json()['file_id']
+        task_file_id, spool_path, _ = mock_delay.call_args[0]
+        self.assertEqual(file_id, task_file_id)
+        self.assertEqual(contents, pathlib.Path(spool_path).read_bytes())
+        self.assertEqual('queued_for_processing', self._file_doc(file_id)['status'])
+
+    def test_missing_filename(self):
+        self._put_raw(b'1234', '', 'application/octet-stream', expected_status=400)
+
+    def test_too_large_file(self):
+        self.create_user(24 * 'b', roles=set(), token='nonsub', email='nonsub@example.com')
+        self.put(f'/api/storage/stream/{self.project_id}/raw',
+                 qs={'filename': 'data.bin'},
+                 data=os.urandom(30 * 2 ** 10),
+                 content_type='application/octet-stream',
+                 auth_token='nonsub',
+                 expected_status=413)
+
+
+class DeduplicationTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+        self.app.config['DEDUPLICATE_UPLOADS'] = True
+
+        self.project_id, _ = self.ensure_project_exists()
+        self.user_id = self.create_user(groups=[ctd.EXAMPLE_ADMIN_GROUP_ID],
+                                        roles={'subscriber'}, token='token')
+        self.contents = (pathlib.Path(__file__).with_name('images') / '512x512-8bit-rgb.jpg') \
+            .read_bytes()
+
+    def _upload(self, project_id) -> dict:
+        resp = self.put(f'/api/storage/stream/{project_id}/raw',
+                        qs={'filename': 'image.jpg'},
+                        data=self.contents,
+                        content_type='image/jpeg',
+                        auth_token='token',
+                        expected_status=201)
+        with self.app.app_context():
+            return self.app.db('files').find_one(ObjectId(resp.get_json()['file_id']))
+
+    def _blob_path(self, file_doc: dict, file_path: str) -> pathlib.Path:
+        from pillar.api.file_storage_backends.local import LocalBucket
+
+        with self.app.app_context():
+            return LocalBucket(str(file_doc['project'])).blob(file_path).abspath()
+
+    def test_duplicate_upload(self):
+        with self.app.app_context():
+            from pillar.celery import file_processing
+
+        original = self._upload(self.project_id)
+        self.assertEqual('complete', original['status'])
+
+        with mock.patch.object(file_processing.process_uploaded_file, 'delay') as mock_delay:
+            duplicate = self._upload(self.project_id)
+        mock_delay.assert_not_called()
+
+        self.assertNotEqual(original['_id'], duplicate['_id'])
+        self.assertEqual('complete', duplicate['status'])
+        self.assertEqual(original['file_path'], duplicate['file_path'])
+        self.assertEqual(original['variations'], duplicate['variations'])
+        self.assertEqual(original['sha256'], duplicate['sha256'])
+
+        # Only the original blob should be stored; variations have a '-' in their name.
+        from pillar.api.file_storage_backends.local import LocalBucket
+
+        with self.app.app_context():
+            bucket_path = LocalBucket(str(self.project_id)).abspath
+        stored = [path for path in bucket_path.rglob('*.jpg') if '-' not in path.stem]
+        self.assertEqual([self._blob_path(original, original['file_path'])], stored)
+
+    def test_other_project_not_deduplicated(self):
+        other_project_id, _ = self.ensure_project_exists(project_overrides={
+            '_id': ObjectId(), 'url': 'other-project'})
+
+        original = self._upload(self.project_id)
+        other = self._upload(other_project_id)
+
+        self.assertNotEqual(original['file_path'], other['file_path'])
+        self.assertTrue(self._blob_path(other, other['file_path']).exists())
+
+    def test_disabled(self):
+        self.app.config['DEDUPLICATE_UPLOADS'] = False
+
+        original = self._upload(self.project_id)
+        other = self._upload(self.project_id)
+        self.assertNotEqual(original['file_path'], other['file_path'])
+
+    def test_shared_blobs_not_deleted(self):
+        from pillar.api.file_storage import dedup
+
+        original = self._upload(self.project_id)
+        duplicate = self._upload(self.project_id)
+        blob_path = self._blob_path(original, original['file_path'])
+        variation_path = self._blob_path(original, original['variations'][0]['file_path'])
+
+        with self.app.app_context():
+            files_coll = self.app.db('files')
+            self.assertEqual(2, dedup.blob_ref_count(original))
+            self.assertEqual(2, dedup.blob_ref_count(original,
+                                                     original['variations'][0]['file_path']))
+            self.assertTrue(dedup.is_blob_shared(original))
+
+            files_coll.update_one({'_id': original['_id']}, {'$set': {'_deleted': True}})
+            self.assertEqual(1, dedup.blob_ref_count(original))
+            self.assertFalse(dedup.is_blob_shared(duplicate))
+            self.assertFalse(dedup.delete_file_blobs(original))
+        self.assertTrue(blob_path.exists())
+
+        with self.app.app_context():
+            files_coll.update_one({'_id': duplicate['_id']}, {'$set': {'_deleted': True}})
+            self.assertTrue(dedup.delete_file_blobs(duplicate))
+        self.assertFalse(blob_path.exists())
+        self.assertFalse(variation_path.exists())
+
+    def test_shared_variation_not_renamed(self):
+        from pillar.api import encoding
+        from pillar.api.utils import remove_private_keys
+
+        original = self._upload(self.project_id)
+        self._upload(self.project_id)
+
+        variation = {**original['variations'][0], 'format': 'mp4'}
+        file_doc = remove_private_keys(original)
+        file_doc['variations'] = [variation]
+        output = {'format': 'mp4',
+                  'width': variation['width'],
+                  'height': variation['height'],
+                  'file_size_in_bytes': variation['length'],
+                  'md5_checksum': ''}
+
+        with self.app.app_context():
+            encoding.apply_encoded_outputs(original['_id'], file_doc, [output], duration_secs=1)
+
+        self.assertEqual(original['variations'][0]['file_path'], variation['file_path'])
+        self.assertTrue(self._blob_path(original, variation['file_path']).exists())
+
+
+class HashingReaderTest(unittest.TestCase):
+    def test_hash_and_tee(self):
+        import hashlib
+        from pillar.api.file_storage.hashing import HashingReader
+
+        contents = os.urandom(10000)
+        tee = io.BytesIO()
+        reader = HashingReader(io.BytesIO(contents), tee=tee)
+
+        chunks = [reader.read(4096) for _ in range(3)]
+        self.assertEqual(b'', reader.read(4096))
+
+        self.assertEqual(contents, b''.join(chunks))
+        self.assertEqual(contents, tee.getvalue())
+        self.assertEqual(len(contents), reader.bytes_read)
+        self.assertEqual(hashlib.md5(contents).hexdigest(), reader.md5)
+        self.assertEqual(hashlib.sha256(contents).hexdigest(), reader.sha256)
+
+    def test_seek_back(self):
+        import hashlib
+        from pillar.api.file_storage.hashing import HashingReader
+
+        contents = os.urandom(10000)
+        reader = HashingReader(io.BytesIO(contents), seek_window=1000)
+        self.assertFalse(reader.seekable())
+
+        # Seeking back within the window replays the data, without hashing it again.
+        first = reader.read(6000)
+        self.assertEqual(5500, reader.seek(5500))
+        self.assertEqual(contents[5500:6500], reader.read(1000))
+        self.assertEqual(6500, reader.tell())
+        self.assertEqual(contents[6500:], reader.read())
+        self.assertEqual(contents, first + contents[6000:])
+        self.assertEqual(hashlib.sha256(contents).hexdigest(), reader.sha256)
+
+        with self.assertRaises(io.UnsupportedOperation):
+            reader.seek(8999)
+        with self.assertRaises(io.UnsupportedOperation):
+            reader.seek(0, os.SEEK_END)
+
+
 class TempDirTest(AbstractPillarTest):
     def test_tempfiles_location(self):
         # After importing the application, tempfiles should be created in the STORAGE_DIR
@@ -237,26 +652,15 @@ class FileMaxSizeTest(AbstractPillarTest):
 
 class VideoSizeTest(AbstractPillarTest):
     def test_video_size(self):
-        from pillar.api import file_storage
+        from pillar.api.utils import imaging
         from pathlib import Path
 
         fname = Path(__file__).with_name('video-tiny.mkv')
 
         with self.app.test_request_context():
-            size = file_storage._video_size_pixels(fname)
-
-        self.assertEqual((960, 540), size)
-
-    def test_video_size_nonexistant(self):
-        from pillar.api import file_storage
-        from pathlib import Path
-
-        fname = Path(__file__).with_name('video-nonexistant.mkv')
-
-        with self.app.test_request_context():
-            size = file_storage._video_size_pixels(fname)
+            probe = imaging.probe_video(fname)
 
-        self.assertEqual((0, 0), size)
+        self.assertEqual((960, 540), (probe.width, probe.height))
 
     def test_video_cap_at_1080(self):
         from pillar.api import file_storage
@@ -282,19 +686,90 @@ class VideoSizeTest(AbstractPillarTest):
         self.assertIsInstance(size[1], int)
 
 
+class VideoProbeTest(AbstractPillarTest):
+    def test_probe_video(self):
+        from pathlib import Path
+        from pillar.api.utils import imaging
+
+        fname = Path(__file__).with_name('video-tiny.mkv')
+
+        with self.app.test_request_context():
+            probe = imaging.probe_video(fname)
+
+            # Probing the same file again should use the cached result.
+            with mock.patch('subprocess.run') as mock_run:
+                self.assertEqual(probe, imaging.probe_video(fname))
+            mock_run.assert_not_called()
+
+        self.assertEqual((960, 540), (probe.width, probe.height))
+        self.assertEqual(1, int(probe.duration))
+        self.assertEqual(0, probe.rotation)
+        self.assertTrue(probe.codec)
+
+    def test_probe_nonexistant(self):
+        from pathlib import Path
+        from pillar.api.utils import imaging
+
+        fname = Path(__file__).with_name('video-nonexistant.mkv')
+        with self.app.test_request_context():
+            self.assertIsNone(imaging.probe_video(fname))
+
+    def test_rotation(self):
+        from pillar.api.utils import imaging
+
+        self.assertEqual(0, imaging._probe_rotation({}))
+        self.assertEqual(90, imaging._probe_rotation({'tags': {'rotate': '90'}}))
+        self.assertEqual(270, imaging._probe_rotation(
+            {'side_data_list': [{'side_data_type': 'Display Matrix', 'rotation': 90}]}))
+
+        probe = imaging.VideoProbe(duration=None, width=1920, height=1080, codec='h264',
+                                   rotation=90)
+        self.assertEqual((1080, 1920), probe.display_size)
+        self.assertEqual(probe, imaging.VideoProbe.from_dict(probe.to_dict()))
+
+    def test_duration(self):
+        from pillar.api.utils import imaging
+
+        self.assertEqual(1.5, imaging._probe_duration({'duration': '1.5'}, {'duration': '2.0'}))
+        self.assertEqual(2.0, imaging._probe_duration({}, {'duration': '2.0'}))
+        self.assertEqual(61.25, imaging._probe_duration(
+            {'tags': {'DURATION': '00:01:01.250000000'}}, {}))
+        self.assertIsNone(imaging._probe_duration({'duration': '0'}, {}))
+
+    def test_process_video_stores_probe(self):
+        from pathlib import Path
+        from pillar.api import file_storage
+
+        fname = Path(__file__).with_name('video-tiny.mkv')
+        src_file = {}
+        with self.app.test_request_context():
+            file_storage._video_probe(fname, src_file)
+
+            self.assertEqual(960, src_file['video_probe']['width'])
+            self.assertEqual((960, 540), (src_file['width'], src_file['height']))
+            self.assertEqual(1, src_file['duration'])
+
+            # A stored result should be used instead of probing again.
+            src_file['video_probe']['width'] = 1280
+            with mock.patch('pillar.api.utils.imaging.probe_video') as mock_probe:
+                probe = file_storage._video_probe(fname, src_file)
+            mock_probe.assert_not_called()
+            self.assertEqual(1280, probe.width)
+
+
 class VideoDurationTest(AbstractPillarTest):
     def test_video_duration_from_container(self):
-        from pillar.api import file_storage
+        from pillar.api.utils import imaging
         from pathlib import Path
 
         with self.app.test_request_context():
             # This MKV file does not have container-level duration information.
             fname = Path(__file__).with_name('video-tiny.mkv')
 
-            self.assertEqual(1, file_storage._video_duration_seconds(fname))
+            self.assertEqual(1, int(imaging.probe_video(fname).duration))
 
     def test_video_duration_from_stream(self):
-        from pillar.api import file_storage
+        from pillar.api.utils import imaging
         from pathlib import Path
 
         with self.app.test_request_context():
@@ -302,4 +777,4 @@ class VideoDurationTest(AbstractPillarTest):
 
             # FFmpeg 3.x reports 2 seconds, FFmpeg 4.x reports 1.6 seconds which
             # is truncated to 1.
-            self.assertEqual(1, file_storage._video_duration_seconds(fname))
+            self.assertEqual(1, int(imaging.probe_video(fname).duration))
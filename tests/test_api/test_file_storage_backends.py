@@ -1,5 +1,8 @@
 import abc
+import os
+import threading
 import typing
+import unittest
 from unittest import mock
 
 from pillar.tests import AbstractPillarTest
@@ -141,6 +144,79 @@ class LocalStorageBackendTest(AbstractStorageBackendTest):
         self.assertEqual(old_blob.abspath().parent.parent,
                          new_blob.abspath().parent.parent)
 
+    def test_create_from_real_file(self):
+        import tempfile
+
+        self.enter_app_context()
+        file_contents = os.urandom(3000)
+
+        bucket = self.storage_backend()(24 * 'a')
+        blob = bucket.blob('somefile.bin')
+        with tempfile.TemporaryFile() as infile:
+            infile.write(file_contents)
+            infile.seek(1000)
+            blob.create_from_file(infile, content_type='application/octet-stream')
+
+            # The file should have been read from its current position until the end.
+            self.assertEqual(3000, infile.tell())
+
+        self.assertEqual(file_contents[1000:], blob.abspath().read_bytes())
+
+        with tempfile.TemporaryFile() as outfile:
+            outfile.write(b'header')
+            blob.download_to_file(outfile)
+            self.assertEqual(6 + 2000, outfile.tell())
+            outfile.seek(0)
+            self.assertEqual(b'header' + file_contents[1000:], outfile.read())
+
+    def test_create_from_file_is_atomic(self):
+        import io
+
+        self.enter_app_context()
+
+        class BrokenFile(io.BytesIO):
+            def read(self, size=-1):
+                if self.tell() > 0:
+                    raise IOError('connection lost')
+                return super().read(100)
+
+        bucket = self.storage_backend()(24 * 'a')
+        blob = bucket.blob('somefile.bin')
+        blob.create_from_file(io.BytesIO(b'old contents'), content_type='text/plain')
+
+        with self.assertRaises(IOError):
+            blob.create_from_file(BrokenFile(os.urandom(1000)), content_type='text/plain')
+
+        # The old file should still be there, and nothing else.
+        self.assertEqual(b'old contents', blob.abspath().read_bytes())
+        self.assertEqual([blob.abspath()], list(blob.abspath().parent.iterdir()))
+
+    def test_copy_blob_hardlink(self):
+        self.enter_app_context()
+        test_file, file_contents = self.create_test_file()
+
+        bucket_class = self.storage_backend()
+        src_blob = bucket_class(24 * 'a').blob('somefile.bin')
+        src_blob.create_from_file(test_file, content_type='application/octet-stream')
+
+        for allow_hardlink in (True, False):
+            self.app.config['LOCAL_STORAGE_HARDLINK_COPIES'] = allow_hardlink
+            dest_bucket = bucket_class(24 * ('d' if allow_hardlink else 'e'))
+            src_blob.bucket.copy_blob(src_blob, dest_bucket)
+
+            dest_blob = dest_bucket.blob('somefile.bin')
+            self.assertEqual(file_contents, dest_blob.abspath().read_bytes())
+            self.assertEqual(512, dest_blob.size)
+
+            # Replacing the copy should never change the original.
+            new_file, _ = self.create_test_file()
+            dest_blob.create_from_file(new_file, content_type='application/octet-stream')
+            self.assertEqual(file_contents, src_blob.abspath().read_bytes())
+
+        # Copying a file onto itself should be harmless.
+        src_blob.bucket.copy_blob(src_blob, src_blob.bucket)
+        self.assertEqual(file_contents, src_blob.abspath().read_bytes())
+
 
 class MockedGoogleCloudStorageTest(AbstractStorageBackendTest):
     def storage_backend(self):
@@ -189,6 +265,35 @@ class MockedGoogleCloudStorageTest(AbstractStorageBackendTest):
                                                       content_type='application/octet-stream')
         self.assertEqual(2, mock_blob.reload.call_count)
 
+    def test_bucket_cached(self):
+        import pillar.api.file_storage_backends.gcs as gcs
+
+        self.enter_app_context()
+        mock_bucket, _ = self.mock_gcs()
+
+        bucket_class = self.storage_backend()
+        bucket1 = bucket_class('buckettest')
+        bucket2 = bucket_class('buckettest')
+        self.assertIs(mock_bucket, bucket1._gcs_bucket)
+        self.assertIs(mock_bucket, bucket2._gcs_bucket)
+        gcs.gcs.get_bucket.assert_called_once_with('buckettest')
+
+        # Another client should not get the cached bucket.
+        self.mock_gcs()
+        bucket_class('buckettest')
+        gcs.gcs.get_bucket.assert_called_once_with('buckettest')
+
+    def test_clone(self):
+        self.enter_app_context()
+        mock_bucket, _ = self.mock_gcs()
+
+        bucket = self.storage_backend()('buckettest', subdir='shared')
+        clone = bucket.clone()
+        self.assertIsNot(bucket, clone)
+        self.assertEqual('buckettest', clone.name)
+        self.assertEqual('shared', clone.subdir)
+        self.assertIs(mock_bucket, clone._gcs_bucket)
+
     def test_rename(self):
         self.enter_app_context()
         mock_bucket, mock_blob = self.mock_gcs()
@@ -196,3 +301,103 @@ class MockedGoogleCloudStorageTest(AbstractStorageBackendTest):
 
         # The storage API should have added the _ path in front.
         mock_bucket.rename_blob.assert_called_with(mock_blob, '_/ænother-näme.bin')
+
+
+class GoogleCloudStorageClientTest(AbstractPillarTest):
+    def test_one_client_per_process(self):
+        import pillar.api.file_storage_backends.gcs as gcs
+
+        self.enter_app_context()
+        with mock.patch.object(gcs, '_client', None), \
+                mock.patch.object(gcs, '_create_client',
+                                  side_effect=lambda: mock.Mock()) as mock_create:
+            client = gcs.get_client()
+            clients = []
+            threads = [threading.Thread(target=lambda: clients.append(gcs.get_client()))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(4 * [client], clients)
+            mock_create.assert_called_once()
+
+            # After forking, a new client should be created.
+            with mock.patch('os.getpid', return_value=os.getpid() + 1):
+                forked_client = gcs.get_client()
+            self.assertIsNot(client, forked_client)
+            self.assertEqual(2, mock_create.call_count)
+
+    def test_http_pool(self):
+        from pillar.api.file_storage_backends.gcs import HttpPool
+
+        credentials = mock.Mock()
+        credentials.authorize.side_effect = lambda http: http
+        pool = HttpPool(credentials, max_size=1)
+
+        with mock.patch('httplib2.Http') as mock_http_class:
+            mock_http_class.side_effect = lambda: mock.Mock(connections={'https': mock.Mock()})
+
+            # Sequential requests reuse the same authorised Http object.
+            pool.request('https://example.com/1', 'GET')
+            pool.request('https://example.com/2', 'GET')
+            self.assertEqual(1, mock_http_class.call_count)
+            credentials.authorize.assert_called_once()
+
+            # Concurrent requests each get their own Http object.
+            http1 = pool._checkout()
+            http2 = pool._checkout()
+            self.assertIsNot(http1, http2)
+            pool._checkin(http1)
+            pool._checkin(http2)
+
+        # Only one idle Http object is kept; the connections of the other are closed.
+        http1.connections['https'].close.assert_not_called()
+        http2.connections['https'].close.assert_called_once_with()
+
+
+@unittest.skipUnless(os.environ.get('PILLAR_TEST_GCS_ENDPOINT'),
+                     'set PILLAR_TEST_GCS_ENDPOINT to the URL of a fake GCS server')
+class FakeGoogleCloudStorageServerTest(AbstractStorageBackendTest):
+    """Tests against a fake GCS server, like fsouza/fake-gcs-server."""
+
+    def setUp(self, **kwargs):
+        import pillar.api.file_storage_backends.gcs as gcs
+
+        super().setUp(**kwargs)
+        self.app.config['GCS_API_ENDPOINT'] = os.environ['PILLAR_TEST_GCS_ENDPOINT']
+
+        # Other tests may have replaced the client with a mock.
+        self._patches = [mock.patch.object(gcs, 'gcs', gcs.LocalProxy(gcs.get_client)),
+                         mock.patch.object(gcs, '_client', None)]
+        for patch in self._patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self._patches):
+            patch.stop()
+        super().tearDown()
+
+    def storage_backend(self):
+        from pillar.api.file_storage_backends import Bucket
+
+        return Bucket.for_backend('gcs')
+
+    def test_upload_and_download(self):
+        import io
+
+        self.enter_app_context()
+        test_file, file_contents = self.create_test_file()
+
+        bucket = self.storage_backend()('fake-gcs-test')
+        blob = bucket.blob('somefile.bin')
+        blob.create_from_file(test_file, file_size=len(file_contents),
+                              content_type='application/octet-stream')
+        self.assertEqual(len(file_contents), blob.size)
+
+        downloaded = io.BytesIO()
+        bucket.blob('somefile.bin').download_to_file(downloaded)
+        self.assertEqual(file_contents, downloaded.getvalue())
+
+        # The same bucket object is reused.
+        self.assertIs(bucket._gcs_bucket, self.storage_backend()('fake-gcs-test')._gcs_bucket)
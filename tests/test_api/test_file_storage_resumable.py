@@ -0,0 +1,187 @@
+import datetime
+import os
+
+from bson import ObjectId
+
+import pillar.tests.common_test_data as ctd
+from pillar.tests import AbstractPillarTest
+
+CHUNK_SIZE = 256 * 1024
+
+
+class AbstractResumableTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+        self.app.config['RESUMABLE_UPLOAD_CHUNK_SIZE'] = CHUNK_SIZE
+
+        self.project_id, _ = self.ensure_project_exists()
+        self.user_id = self.create_user(groups=[ctd.EXAMPLE_ADMIN_GROUP_ID],
+                                        roles={'subscriber'}, token='token')
+
+        # Two full chunks and a partial one.
+        self.contents = os.urandom(2 * CHUNK_SIZE + 1000)
+
+    def create_session(self, **payload) -> dict:
+        resp = self.post(f'/api/storage/resumable/{self.project_id}',
+                         json={'filename': 'huge.blend', 'size': len(self.contents),
+                               **payload},
+                         auth_token='token',
+                         expected_status=201)
+        return resp.get_json()
+
+    def put_chunk(self, upload_id: str, chunk_index: int, expected_status=200, data=None):
+        if data is None:
+            data = self.contents[chunk_index * CHUNK_SIZE:(chunk_index + 1) * CHUNK_SIZE]
+        return self.put(f'/api/storage/resumable/{upload_id}/{chunk_index}',
+                        data=data,
+                        content_type='application/octet-stream',
+                        auth_token='token',
+                        expected_status=expected_status)
+
+    def query_status(self, upload_id: str, expected_status: int):
+        return self.put(f'/api/storage/resumable/{upload_id}',
+                        headers={'Content-Range': f'bytes */{len(self.contents)}'},
+                        auth_token='token',
+                        expected_status=expected_status)
+
+    def chunk_paths(self, upload_id: str) -> list:
+        from pillar.api.file_storage.resumable import _chunk_blob_name
+        from pillar.api.file_storage_backends.local import LocalBucket
+
+        with self.app.app_context():
+            bucket = LocalBucket(str(self.project_id))
+            return [bucket.blob(_chunk_blob_name(ObjectId(upload_id), idx)).abspath()
+                    for idx in range(3)]
+
+
+class ResumableUploadTest(AbstractResumableTest):
+    def test_create_session(self):
+        session = self.create_session()
+
+        self.assertEqual(CHUNK_SIZE, session['chunk_size'])
+        self.assertEqual(3, session['chunk_count'])
+        self.assertEqual([0, 1, 2], session['missing_chunks'])
+        self.assertIsNone(session['file_id'])
+
+        with self.app.app_context():
+            db_session = self.app.db('upload_sessions').find_one(ObjectId(session['upload_id']))
+        self.assertEqual('application/x-blender', db_session['content_type'])
+        self.assertEqual(self.user_id, db_session['user'])
+
+    def test_chunk_size_for_huge_files(self):
+        from pillar.api.file_storage import resumable
+
+        with self.app.app_context():
+            self.assertEqual(CHUNK_SIZE, resumable._chunk_size_for(1))
+            chunk_size = resumable._chunk_size_for(20 * 2 ** 30)
+
+        self.assertEqual(0, chunk_size % resumable.CHUNK_SIZE_MULTIPLE)
+        self.assertLessEqual(20 * 2 ** 30 / chunk_size, resumable.MAX_CHUNK_COUNT)
+
+    def test_upload_out_of_order(self):
+        session = self.create_session()
+        upload_id = session['upload_id']
+
+        # No bytes received yet.
+        resp = self.query_status(upload_id, 308)
+        self.assertNotIn('Range', resp.headers)
+
+        self.put_chunk(upload_id, 2)
+        self.put_chunk(upload_id, 0)
+        resp = self.query_status(upload_id, 308)
+        self.assertEqual(f'bytes=0-{CHUNK_SIZE - 1}', resp.headers['Range'])
+        self.assertEqual([1], resp.get_json()['missing_chunks'])
+
+        # Finalising should fail while a chunk is missing.
+        resp = self.post(f'/api/storage/resumable/{upload_id}/finalise',
+                         auth_token='token', expected_status=409)
+        self.assertEqual([1], resp.get_json()['missing_chunks'])
+
+        # Re-sending a chunk is fine.
+        self.put_chunk(upload_id, 1)
+        self.put_chunk(upload_id, 0)
+        self.query_status(upload_id, 200)
+
+        resp = self.post(f'/api/storage/resumable/{upload_id}/finalise',
+                         auth_token='token', expected_status=201)
+        file_id = ObjectId(resp.get_json()['file_id'])
+
+        with self.app.app_context():
+            from pillar.api.file_storage_backends.local import LocalBucket
+
+            file_doc = self.app.db('files').find_one(file_id)
+            blob = LocalBucket(str(self.project_id)).blob(file_doc['file_path'])
+            self.assertEqual(self.contents, blob.abspath().read_bytes())
+
+        self.assertEqual('complete', file_doc['status'])
+        self.assertEqual(len(self.contents), file_doc['length'])
+        self.assertEqual('huge.blend', file_doc['filename'])
+        self.assertEqual('application/x-blender', file_doc['content_type'])
+
+        # The chunks should be gone.
+        self.assertFalse(any(path.exists() for path in self.chunk_paths(upload_id)))
+
+        # Finalising again should just return the same file.
+        resp = self.post(f'/api/storage/resumable/{upload_id}/finalise',
+                         auth_token='token', expected_status=200)
+        self.assertEqual(str(file_id), resp.get_json()['file_id'])
+
+    def test_wrong_chunk_size(self):
+        upload_id = self.create_session()['upload_id']
+
+        self.put_chunk(upload_id, 0, data=self.contents[:1000], expected_status=400)
+        self.put_chunk(upload_id, 2, data=self.contents[:CHUNK_SIZE], expected_status=400)
+        self.put_chunk(upload_id, 3, data=b'', expected_status=404)
+
+    def test_other_user(self):
+        upload_id = self.create_session()['upload_id']
+
+        other_id = self.create_user(24 * 'b', groups=[ctd.EXAMPLE_ADMIN_GROUP_ID],
+                                    token='other', email='other@example.com')
+        self.assertNotEqual(other_id, self.user_id)
+        self.get(f'/api/storage/resumable/{upload_id}', auth_token='other', expected_status=404)
+        self.put(f'/api/storage/resumable/{upload_id}/0', data=self.contents[:CHUNK_SIZE],
+                 auth_token='other', expected_status=404)
+
+    def test_too_large_for_non_subscriber(self):
+        self.create_user(24 * 'c', roles=set(), groups=[ctd.EXAMPLE_ADMIN_GROUP_ID],
+                         token='nonsub', email='nonsub@example.com')
+        self.post(f'/api/storage/resumable/{self.project_id}',
+                  json={'filename': 'huge.blend', 'size': len(self.contents)},
+                  auth_token='nonsub',
+                  expected_status=413)
+
+    def test_abort(self):
+        upload_id = self.create_session()['upload_id']
+        self.put_chunk(upload_id, 1)
+        self.assertTrue(self.chunk_paths(upload_id)[1].exists())
+
+        self.delete(f'/api/storage/resumable/{upload_id}', auth_token='token',
+                    expected_status=204)
+        self.assertFalse(self.chunk_paths(upload_id)[1].exists())
+        self.get(f'/api/storage/resumable/{upload_id}', auth_token='token', expected_status=404)
+
+
+class ExpiredUploadSessionTest(AbstractResumableTest):
+    def test_remove_expired(self):
+        from pillar.api.file_storage import resumable
+
+        expired_id = self.create_session()['upload_id']
+        active_id = self.create_session()['upload_id']
+        self.put_chunk(expired_id, 0)
+        self.put_chunk(active_id, 0)
+
+        with self.app.app_context():
+            sessions_coll = self.app.db('upload_sessions')
+            sessions_coll.update_one(
+                {'_id': ObjectId(expired_id)},
+                {'$set': {'expires': datetime.datetime.now(tz=datetime.timezone.utc)
+                                     - datetime.timedelta(minutes=1)}})
+
+            self.assertEqual(1, resumable.remove_expired_sessions())
+
+            self.assertIsNone(sessions_coll.find_one(ObjectId(expired_id)))
+            self.assertIsNotNone(sessions_coll.find_one(ObjectId(active_id)))
+
+        self.assertFalse(self.chunk_paths(expired_id)[0].exists())
+        self.assertTrue(self.chunk_paths(active_id)[0].exists())
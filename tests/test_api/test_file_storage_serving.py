@@ -0,0 +1,83 @@
+import os
+import pathlib
+
+from pillar.tests import AbstractPillarTest
+
+
+class LocalFileServingTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        self.contents = os.urandom(1000)
+        self.file_name = 'ab/abcdef.mp4'
+        path = pathlib.Path(self.app.config['STORAGE_DIR']) / self.file_name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(self.contents)
+
+        self.url = f'/api/storage/file/{self.file_name}'
+
+    def test_entire_file(self):
+        resp = self.get(self.url)
+        self.assertEqual(self.contents, resp.data)
+        self.assertEqual('video/mp4', resp.mimetype)
+        self.assertEqual('bytes', resp.headers['Accept-Ranges'])
+        self.assertEqual(str(len(self.contents)), resp.headers['Content-Length'])
+
+        # Conditional requests.
+        self.get(self.url, etag=resp.headers['ETag'], expected_status=304)
+        self.get(self.url, headers={'If-Modified-Since': resp.headers['Last-Modified']},
+                 expected_status=304)
+        self.get(self.url, etag='"other-etag"', expected_status=200)
+
+    def test_range(self):
+        resp = self.get(self.url, headers={'Range': 'bytes=10-19'}, expected_status=206)
+        self.assertEqual(self.contents[10:20], resp.data)
+        self.assertEqual('bytes 10-19/1000', resp.headers['Content-Range'])
+        self.assertEqual('10', resp.headers['Content-Length'])
+
+        # Open-ended range, as sent by browsers seeking in a video.
+        resp = self.get(self.url, headers={'Range': 'bytes=900-'}, expected_status=206)
+        self.assertEqual(self.contents[900:], resp.data)
+        self.assertEqual('bytes 900-999/1000', resp.headers['Content-Range'])
+
+        resp = self.get(self.url, headers={'Range': 'bytes=-100'}, expected_status=206)
+        self.assertEqual(self.contents[-100:], resp.data)
+
+        resp = self.get(self.url, headers={'Range': 'bytes=2000-'}, expected_status=416)
+        self.assertEqual('bytes */1000', resp.headers['Content-Range'])
+
+    def test_if_range(self):
+        etag = self.get(self.url).headers['ETag']
+
+        resp = self.get(self.url, headers={'Range': 'bytes=10-19', 'If-Range': etag},
+                        expected_status=206)
+        self.assertEqual(self.contents[10:20], resp.data)
+
+        # The file changed, so the entire file should be sent.
+        resp = self.get(self.url, headers={'Range': 'bytes=10-19', 'If-Range': '"old-etag"'},
+                        expected_status=200)
+        self.assertEqual(self.contents, resp.data)
+
+    def test_not_found(self):
+        self.get('/api/storage/file/ab/nonexistent.mp4', expected_status=404)
+        self.get('/api/storage/file/ab', expected_status=404)
+        self.get('/api/storage/file/../etc/passwd', expected_status=404)
+
+    def test_x_accel_redirect(self):
+        self.app.config['LOCAL_STORAGE_SERVE_MODE'] = 'x-accel-redirect'
+        self.app.config['LOCAL_STORAGE_ACCEL_PREFIX'] = '/protected/'
+
+        resp = self.get(self.url)
+        self.assertEqual(b'', resp.data)
+        self.assertEqual('/protected/ab/abcdef.mp4', resp.headers['X-Accel-Redirect'])
+        self.assertEqual('video/mp4', resp.mimetype)
+
+        self.get('/api/storage/file/ab/nonexistent.mp4', expected_status=404)
+
+    def test_x_sendfile(self):
+        self.app.config['LOCAL_STORAGE_SERVE_MODE'] = 'x-sendfile'
+
+        resp = self.get(self.url)
+        self.assertEqual(b'', resp.data)
+        expected = pathlib.Path(self.app.config['STORAGE_DIR']).absolute() / self.file_name
+        self.assertEqual(str(expected), resp.headers['X-Sendfile'])
@@ -1,9 +1,14 @@
 import pathlib
 import shutil
 import tempfile
+from unittest import mock
 
 from pillar.tests import AbstractPillarTest
 
+# Maximum mean absolute difference per channel (0-255) between cascaded
+# thumbnails and thumbnails resampled directly from the original.
+MAX_MEAN_ABS_DIFF = 2.5
+
 
 class ThumbnailTest(AbstractPillarTest):
     @classmethod
@@ -290,3 +295,44 @@ class ThumbnailTest(AbstractPillarTest):
                  'content_type': 'image/png'},
             ],
             thumbs)
+
+    def test_cascade_quality(self):
+        import io
+        from PIL import Image, ImageChops, ImageStat
+        from pillar.api.utils import imaging
+
+        # Noise is the worst case for resampling from an intermediate.
+        size = (3000, 2000)
+        source = self.tmp / 'noisy.jpg'
+        Image.merge('RGB', [
+            Image.effect_noise(size, 80),
+            Image.linear_gradient('L').resize(size),
+            Image.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 100),
+        ]).save(source, quality=95)
+
+        with self.app.app_context(), \
+                mock.patch.object(Image, 'open', wraps=Image.open) as mock_open:
+            thumbnail_settings = self.app.config['UPLOADS_LOCAL_STORAGE_THUMBNAILS']
+            thumbs = imaging.generate_local_thumbnails('noisy', source)
+        mock_open.assert_called_once_with(source)
+
+        for thumb in thumbs:
+            # Resample directly from the original, and save like the thumbnail.
+            settings = thumbnail_settings[thumb['size']]
+            expect = Image.open(source)
+            if settings['crop']:
+                resized, box = imaging.crop_sizes(expect.size, settings['size'])
+                expect = expect.resize(resized, Image.LANCZOS).crop(box)
+            else:
+                expect = expect.resize(imaging.thumbnail_size(expect.size, settings['size']),
+                                       Image.LANCZOS)
+            buf = io.BytesIO()
+            expect.save(buf, format='JPEG', quality=95, optimize=True)
+            expect = Image.open(buf)
+
+            actual = Image.open(thumb['local_path'])
+            self.assertEqual(expect.size, actual.size)
+
+            diff = ImageStat.Stat(ImageChops.difference(expect, actual))
+            for channel_diff in diff.mean:
+                self.assertLess(channel_diff, MAX_MEAN_ABS_DIFF, f'size {thumb["size"]}')
@@ -1,5 +1,6 @@
 """Tests chunked refreshing of links."""
 import json
+from unittest import mock
 
 from bson import ObjectId, tz_util
 from pillar.tests import AbstractPillarTest
@@ -116,3 +117,79 @@ class LinkRefreshTest(AbstractPillarTest):
         with self.app.test_request_context():
             self._reload_from_db()
             self.assertLess(refreshed_lower_limit, self.file[0]['link_expires'])
+
+    def test_bulk_refresh(self):
+        validity_seconds = self.app.config['FILE_LINK_VALIDITY']['unittest']
+        refreshed_lower_limit = self.now + timedelta(seconds=0.9 * validity_seconds)
+
+        with self.app.app_context():
+            from pillar.api import file_storage
+            from pillar.api.utils import utcnow
+
+            files_collection = self.app.data.driver.db['files']
+            files_collection.update_one({'_id': self.file_id[1]}, {'$set': {'variations': [
+                {'size': 't', 'file_path': 'variation-t.jpg', 'link': 'old-link'},
+            ]}})
+            file_docs = [files_collection.find_one(file_id) for file_id in self.file_id]
+
+            # Links of one file cannot be generated.
+            real_generate_link = file_storage.generate_link
+
+            def generate_link(backend, file_path, *args, **kwargs):
+                if file_path == self.file[2]['file_path']:
+                    raise ValueError('no access')
+                return real_generate_link(backend, file_path, *args, **kwargs)
+
+            with mock.patch.object(file_storage, 'generate_link', side_effect=generate_link):
+                stats = file_storage.refresh_links(file_docs, utcnow())
+
+        self.assertEqual(4, stats.refreshed)
+        self.assertEqual(1, stats.failed)
+
+        old_etags = [file_doc['_etag'] for file_doc in self.file]
+        with self.app.app_context():
+            self._reload_from_db()
+        for idx in (0, 1, 3, 4):
+            self.assertLess(refreshed_lower_limit, self.file[idx]['link_expires'])
+            self.assertNotEqual(old_etags[idx], self.file[idx]['_etag'])
+            # The in-memory documents should have been updated too.
+            self.assertEqual(file_docs[idx]['_etag'], self.file[idx]['_etag'])
+            self.assertEqual(file_docs[idx]['link'], self.file[idx]['link'])
+        self.assertEqual(self.expiry[2], self.file[2]['link_expires'])
+        self.assertEqual(old_etags[2], self.file[2]['_etag'])
+
+        variation = self.file[1]['variations'][0]
+        self.assertEqual('t', variation['size'])
+        self.assertNotEqual('old-link', variation['link'])
+        self.assertEqual(real_generate_link('unittest', 'variation-t.jpg'), variation['link'])
+
+    def test_links_on_read(self):
+        from pillar.api import file_storage
+        from pillar.api.file_storage import link_cache
+
+        self.app.config['FILE_LINKS_ON_READ'] = True
+        link_cache.clear()
+
+        validity_seconds = self.app.config['FILE_LINK_VALIDITY']['unittest']
+        refreshed_lower_limit = self.now + timedelta(seconds=0.9 * validity_seconds)
+        path_count = 1 + len(self.file[0].get('variations', []))
+        expected_link = file_storage.generate_link('unittest', self.file[0]['file_path'])
+
+        with mock.patch.object(file_storage, 'generate_link',
+                               wraps=file_storage.generate_link) as mock_generate_link:
+            for _ in range(2):
+                file_doc = self.get('/api/files/%s' % self.file_id[0]).get_json()
+
+                expires = datetime.strptime(file_doc['link_expires'],
+                                            self.app.config['RFC1123_DATE_FORMAT'])
+                self.assertLess(refreshed_lower_limit, expires.replace(tzinfo=tz_util.utc))
+                self.assertEqual(expected_link, file_doc['link'])
+
+        # The links should have been generated only once.
+        self.assertEqual(path_count, mock_generate_link.call_count)
+
+        # The database should not have been touched.
+        old_doc = self.file[0]
+        with self.app.app_context():
+            self._reload_from_db()
+        self.assertEqual(old_doc, self.file[0])
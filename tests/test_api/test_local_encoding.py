@@ -0,0 +1,122 @@
+"""Test cases for encoding videos with FFmpeg on our own workers."""
+import pathlib
+from unittest import mock
+
+from bson import ObjectId
+
+from pillar.tests import AbstractPillarTest
+
+TEST_VIDEO = pathlib.Path(__file__).with_name('video-tiny.mp4')
+
+
+class LocalEncodingTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+        self.enter_app_context()
+
+        from pillar.api.file_storage_backends.local import LocalBucket
+
+        self.project_id, _ = self.ensure_project_exists()
+        bucket = LocalBucket(str(self.project_id))
+        with TEST_VIDEO.open('rb') as infile:
+            bucket.blob('video-tiny.mp4').create_from_file(infile, content_type='video/mp4')
+
+        self.file_id, _ = self.ensure_file_exists(file_overrides={
+            '_id': ObjectId(),
+            'project': self.project_id,
+            'backend': 'local',
+            'file_path': 'video-tiny.mp4',
+            'filename': 'video-tiny.mp4',
+            'content_type': 'video/mp4',
+            'status': 'processing',
+            'variations': [{
+                'format': 'mp4',
+                'content_type': 'video/mp4',
+                'file_path': 'video-tiny-mp4.mp4',
+                'width': 480,
+                'height': 270,
+                'length': 0,
+                'md5': '',
+                'size': '',
+            }],
+            'processing': {'backend': 'local',
+                           'job_id': 'job-1',
+                           'status': 'pending'},
+        })
+
+    def test_encode_file(self):
+        from pillar.api import local_encoding
+        from pillar.api.file_storage_backends.local import LocalBucket
+
+        local_encoding.encode_file(self.file_id, 'job-1')
+
+        db_file = self.app.db('files').find_one(self.file_id)
+        self.assertEqual('complete', db_file['status'])
+        self.assertEqual('finished', db_file['processing']['status'])
+        self.assertEqual(100, db_file['processing']['progress'])
+
+        variation = db_file['variations'][0]
+        self.assertEqual('video-tiny-270p.mp4', variation['file_path'])
+        self.assertEqual('270p', variation['size'])
+        self.assertEqual((480, 270), (variation['width'], variation['height']))
+        self.assertGreater(variation['length'], 0)
+
+        blob = LocalBucket(str(self.project_id)).blob(variation['file_path'])
+        self.assertTrue(blob.exists())
+
+        self.assertEqual({'state': 'finished', 'progress': 100},
+                         local_encoding.job_progress('job-1'))
+
+    def test_job_not_ready(self):
+        from pillar.api import local_encoding
+
+        with self.assertRaises(local_encoding.JobNotReady):
+            local_encoding.encode_file(self.file_id, 'job-2')
+
+        # Once the file refers to another job, this one is superseded.
+        self.app.db('files').update_one({'_id': self.file_id},
+                                        {'$set': {'status': 'complete'}})
+        with mock.patch('pillar.api.local_encoding._run_ffmpeg') as mock_ffmpeg:
+            local_encoding.encode_file(self.file_id, 'job-2')
+        mock_ffmpeg.assert_not_called()
+
+    def test_ffmpeg_failure(self):
+        from pillar.api import local_encoding
+
+        with mock.patch('pillar.api.utils.imaging.ffmpeg_encode_args',
+                        return_value=['false']), \
+                self.assertRaises(local_encoding.EncodingError):
+            local_encoding.encode_file(self.file_id, 'job-1')
+
+        local_encoding.mark_failed(self.file_id, 'job-1')
+        db_file = self.app.db('files').find_one(self.file_id)
+        self.assertEqual('failed', db_file['status'])
+        self.assertEqual('failed', db_file['processing']['status'])
+
+    def test_job_create(self):
+        from pillar.api.utils.encoding import Encoder
+
+        self.app.config['ENCODING_BACKEND'] = 'local'
+        src_file = self.app.db('files').find_one(self.file_id)
+
+        with mock.patch('pillar.celery.video_encoding.encode_video.delay') as mock_delay:
+            job = Encoder.job_create(src_file, file_id=self.file_id)
+
+        self.assertEqual('local', job['backend'])
+        mock_delay.assert_called_once_with(str(self.file_id), job['process_id'])
+
+
+class FFmpegArgsTest(AbstractPillarTest):
+    def test_formats(self):
+        from pillar.api.utils import imaging
+
+        args = imaging.ffmpeg_encode_args('in.mov', 'out.mp4', 'mp4', 1280, 720, threads=2)
+        self.assertIn('libx264', args)
+        self.assertEqual(['-threads', '2'], args[args.index('-threads'):][:2])
+        self.assertEqual('out.mp4', args[-1])
+
+        args = imaging.ffmpeg_encode_args('in.mov', 'out.webm', 'webm', 1280, 720)
+        self.assertIn('libvpx', args)
+
+        with self.assertRaises(ValueError):
+            imaging.ffmpeg_encode_args('in.mov', 'out.avi', 'avi', 1280, 720)
@@ -726,3 +726,246 @@ class NodesReferencedByProjectTest(AbstractPillarTest):
 
 
 
+
+
+class NodeAncestorsTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        self.create_valid_auth_token(user_id=ctd.EXAMPLE_PROJECT_OWNER_ID, token='token')
+        self.project_id, _ = self.ensure_project_exists()
+
+    def post_group(self, name: str, parent: typing.Optional[str] = None) -> dict:
+        node = {
+            'project': self.project_id,
+            'node_type': 'group',
+            'name': name,
+            'properties': {'status': 'published'},
+            'user': ctd.EXAMPLE_PROJECT_OWNER_ID,
+        }
+        if parent:
+            node['parent'] = parent
+        resp = self.post('/api/nodes', json=node, expected_status=201, auth_token='token')
+        return resp.get_json()
+
+    def ancestors(self, node_id: str) -> typing.List[str]:
+        with self.app.app_context():
+            node = self.app.db('nodes').find_one({'_id': ObjectId(node_id)})
+        return [str(ancestor_id) for ancestor_id in node['_ancestors']]
+
+    def test_insert(self):
+        top = self.post_group('top')
+        middle = self.post_group('middle', top['_id'])
+        bottom = self.post_group('bottom', middle['_id'])
+
+        self.assertEqual([], self.ancestors(top['_id']))
+        self.assertEqual([top['_id']], self.ancestors(middle['_id']))
+        self.assertEqual([top['_id'], middle['_id']], self.ancestors(bottom['_id']))
+
+    def test_move_updates_descendants(self):
+        from pillar.api.utils import remove_private_keys
+
+        top1 = self.post_group('top 1')
+        top2 = self.post_group('top 2')
+        middle = self.post_group('middle', top1['_id'])
+        bottom = self.post_group('bottom', middle['_id'])
+
+        # Move the middle node to the other top-level node.
+        resp = self.get(f'/api/nodes/{middle["_id"]}', auth_token='token')
+        node = resp.get_json()
+        etag = node['_etag']
+        node = remove_private_keys(node)
+        node['parent'] = top2['_id']
+        self.put(f'/api/nodes/{middle["_id"]}', json=node, auth_token='token',
+                 headers={'If-Match': etag})
+
+        self.assertEqual([top2['_id']], self.ancestors(middle['_id']))
+        self.assertEqual([top2['_id'], middle['_id']], self.ancestors(bottom['_id']))
+
+    def test_patch_ignores_client_ancestors(self):
+        top = self.post_group('top')
+        middle = self.post_group('middle', top['_id'])
+        bottom = self.post_group('bottom', middle['_id'])
+
+        bogus_id = ObjectId()
+        with self.app.test_request_context():
+            r, _, _, status = self.app.patch_internal(
+                'nodes', {'_ancestors': [bogus_id], 'name': 'new name'},
+                _id=ObjectId(middle['_id']))
+        self.assertEqual(200, status, r)
+
+        self.assertEqual([top['_id']], self.ancestors(middle['_id']))
+        self.assertEqual([top['_id'], middle['_id']], self.ancestors(bottom['_id']))
+
+    def test_find_ancestor_ids(self):
+        from pillar.api.nodes.hierarchy import find_ancestor_ids
+
+        top = self.post_group('top')
+        middle = self.post_group('middle', top['_id'])
+        bottom = self.post_group('bottom', middle['_id'])
+
+        with self.app.app_context():
+            self.assertEqual([ObjectId(middle['_id']), ObjectId(top['_id'])],
+                             find_ancestor_ids(ObjectId(bottom['_id'])))
+
+    def test_move_project_without_stored_ancestors(self):
+        from pillar.api.nodes.moving import NodeMover
+
+        top = self.post_group('top')
+        middle = self.post_group('middle', top['_id'])
+
+        # Nodes that were created before ancestors were stored.
+        bottom_id = self.create_node({
+            'project': self.project_id,
+            'node_type': 'group',
+            'name': 'bottom',
+            'parent': ObjectId(middle['_id']),
+            'properties': {'status': 'published'},
+            'user': ctd.EXAMPLE_PROJECT_OWNER_ID,
+        })
+        leaf_id = self.create_node({
+            'project': self.project_id,
+            'node_type': 'group',
+            'name': 'leaf',
+            'parent': bottom_id,
+            'properties': {'status': 'published'},
+            'user': ctd.EXAMPLE_PROJECT_OWNER_ID,
+        })
+        dest_proj_id, dest_proj = self.ensure_project_exists(
+            project_overrides={'_id': ObjectId(), 'url': 'dest'})
+
+        with self.app.app_context():
+            nodes_coll = self.app.db('nodes')
+            node = nodes_coll.find_one({'_id': ObjectId(top['_id'])})
+            NodeMover(db=self.app.db(), skip_gcs=True).change_project(node, dest_proj)
+
+            moved_ids = {node_doc['_id'] for node_doc in nodes_coll.find({'project': dest_proj_id})}
+        self.assertEqual({ObjectId(top['_id']), ObjectId(middle['_id']), bottom_id, leaf_id},
+                         moved_ids)
+
+
+class NodeListingPermissionFilterTest(AbstractPillarTest):
+    """The permission filter on node listings should match has_permissions()."""
+
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        self.group1 = ObjectId(24 * '1')
+        self.group2 = ObjectId(24 * '2')
+        self.node_user = ObjectId(24 * '3')
+
+        # Public project.
+        self.public_pid, _ = self.ensure_project_exists()
+
+        # Private project, readable by group 1; its assets are readable by group 2.
+        self.private_pid, _ = self.ensure_project_exists(project_overrides={
+            '_id': ObjectId(24 * 'b'),
+            'url': 'private',
+            'is_private': True,
+            'permissions': {'groups': [{'group': self.group1, 'methods': ['GET', 'PUT']}],
+                            'users': [],
+                            'world': []},
+            'node_types': [
+                {'name': 'asset', 'permissions': {
+                    'groups': [{'group': self.group2, 'methods': ['GET']}]}},
+                {'name': 'group', 'permissions': {}},
+            ],
+        })
+
+        # Project that grants nothing; only node permissions give access.
+        self.closed_pid, _ = self.ensure_project_exists(project_overrides={
+            '_id': ObjectId(24 * 'c'),
+            'url': 'closed',
+            'is_private': True,
+            'permissions': {'groups': [{'group': self.group1, 'methods': ['PUT']}]},
+            'node_types': [{'name': 'asset', 'permissions': {}}],
+        })
+
+        self.node_ids = set()
+        for pid in (self.public_pid, self.private_pid, self.closed_pid):
+            for node_type in ('asset', 'group'):
+                self.node_ids.add(self.create_node({
+                    'name': f'{node_type} in {pid}', 'project': pid, 'node_type': node_type,
+                    'properties': {}, '_deleted': False}))
+        self.node_ids.add(self.create_node({
+            'name': 'shared with user', 'project': self.closed_pid, 'node_type': 'asset',
+            'properties': {}, '_deleted': False,
+            'permissions': {'users': [{'user': self.node_user, 'methods': ['GET']}]}}))
+        self.node_ids.add(self.create_node({
+            'name': 'shared with world', 'project': self.closed_pid, 'node_type': 'asset',
+            'properties': {}, '_deleted': False,
+            'permissions': {'world': ['GET']}}))
+
+        self.create_user(24 * 'a', groups=[self.group1], token='group1-token')
+        self.create_user(24 * 'd', groups=[self.group2], token='group2-token')
+        self.create_user(self.node_user, token='node-user-token')
+        self.create_user(24 * 'e', token='other-token')
+        self.create_user(24 * 'f', roles={'admin'}, token='admin-token')
+
+    def expected_node_ids(self, token: typing.Optional[str]) -> typing.Set[str]:
+        """Returns the IDs of the nodes that has_permissions() allows GET on."""
+        from pillar.api.utils.authentication import validate_token
+        from pillar.api.utils.authorization import has_permissions
+
+        headers = {'Authorization': self.make_header(token)} if token else {}
+        with self.app.test_request_context(headers=headers):
+            validate_token()
+            nodes = self.app.db('nodes').find({'_id': {'$in': list(self.node_ids)}})
+            return {str(node['_id']) for node in nodes
+                    if has_permissions('nodes', node, 'GET')}
+
+    def listed_node_ids(self, token: typing.Optional[str]) -> typing.Set[str]:
+        resp = self.get('/api/nodes?max_results=100', auth_token=token)
+        listing = resp.get_json()
+        self.assertEqual(len(listing['_items']), listing['_meta']['total'])
+        return {node['_id'] for node in listing['_items']}
+
+    def test_same_as_has_permissions(self):
+        for token in (None, 'group1-token', 'group2-token', 'node-user-token', 'other-token',
+                      'admin-token'):
+            expected = self.expected_node_ids(token)
+            self.assertEqual(expected, self.listed_node_ids(token), f'token={token}')
+
+    def test_pagination_counts_visible_nodes(self):
+        resp = self.get('/api/nodes?max_results=1', auth_token='group2-token')
+        listing = resp.get_json()
+
+        # Public nodes, private assets, node shared with the world.
+        self.assertEqual(4, listing['_meta']['total'])
+        self.assertEqual(1, len(listing['_items']))
+
+    def test_item_lookup_still_forbidden(self):
+        nodes_coll_filter = {'project': self.private_pid, 'node_type': 'group'}
+        with self.app.app_context():
+            node = self.app.db('nodes').find_one(nodes_coll_filter)
+        self.get(f'/api/nodes/{node["_id"]}', auth_token='other-token', expected_status=403)
+
+    def permission_filter(self, token: str) -> dict:
+        from pillar.api.utils.authentication import validate_token
+        from pillar.api.utils.authorization import node_permission_filter
+
+        with self.app.test_request_context(headers={'Authorization': self.make_header(token)}):
+            validate_token()
+            return node_permission_filter()
+
+    def test_deleted_projects_skipped(self):
+        visible_projects = self.permission_filter('group1-token')['$or'][0]['project']['$in']
+        self.assertIn(self.private_pid, visible_projects)
+
+        with self.app.app_context():
+            self.app.db('projects').update_one({'_id': self.private_pid},
+                                               {'$set': {'_deleted': True}})
+        permission_filter = self.permission_filter('group1-token')
+        self.assertNotIn(self.private_pid, permission_filter['$or'][0]['project']['$in'])
+        self.assertNotIn(self.private_pid,
+                         {cond.get('project') for cond in permission_filter['$or']})
+
+    def test_reuses_cached_permission_tables(self):
+        from pillar.api.utils.authorization import PermissionTable
+
+        self.app.config['PROJECT_PERMISSIONS_CACHE_TIMEOUT'] = 60
+        expected = self.permission_filter('group2-token')
+
+        with mock.patch.object(PermissionTable, 'compile') as mock_compile:
+            self.assertEqual(expected, self.permission_filter('group2-token'))
+        mock_compile.assert_not_called()
@@ -1,5 +1,8 @@
 import datetime
+import random
 import typing
+import unittest
+from unittest import mock
 from urllib.parse import urljoin
 
 import bson
@@ -978,6 +981,111 @@ class IPRangeQueryTest(AbstractOrgTest):
         self.assertEqual(set(), self.om.roles_for_ip_address('::1'))
 
 
+class IPRangeIndexTest(unittest.TestCase):
+    def test_against_linear_search(self):
+        from pillar.api.organizations.ip_ranges import IPRangeIndex
+
+        rng = random.Random(47)
+        ranges = []
+        for idx in range(200):
+            start = rng.randrange(2 ** 16)
+            end = start + rng.randrange(2 ** 12)
+            roles = {f'org-role{idx % 7}', f'org-role{idx % 11}'}
+            ranges.append((start.to_bytes(16, 'big'), end.to_bytes(16, 'big'), roles))
+        index = IPRangeIndex(ranges)
+
+        def linear_search(address: int) -> set:
+            return {role
+                    for start, end, roles in ranges
+                    if int.from_bytes(start, 'big') <= address <= int.from_bytes(end, 'big')
+                    for role in roles}
+
+        addresses = [rng.randrange(2 ** 16 + 2 ** 12) for _ in range(2000)]
+        for start, end, _ in ranges:
+            start_int = int.from_bytes(start, 'big')
+            end_int = int.from_bytes(end, 'big')
+            addresses.extend([start_int - 1, start_int, end_int, end_int + 1])
+
+        for address in addresses:
+            self.assertEqual(linear_search(address), index.roles_for_int(address),
+                             f'address {address}')
+
+    def test_ipv4_and_ipv6(self):
+        from pillar.api.organizations import ip_ranges
+
+        def as_range(iprange: str, roles: set) -> tuple:
+            doc = ip_ranges.doc(iprange)
+            return doc['start'], doc['end'], roles
+
+        index = ip_ranges.IPRangeIndex([
+            as_range('192.168.0.0/16', {'org-a'}),
+            as_range('192.168.9.0/24', {'org-b'}),
+            as_range('2a03:b0c0:beef::/48', {'org-c'}),
+        ])
+        self.assertEqual({'org-a'}, index.roles_for('192.168.3.255'))
+        self.assertEqual({'org-a', 'org-b'}, index.roles_for('192.168.9.16'))
+        self.assertEqual({'org-a'}, index.roles_for('192.168.10.0'))
+        self.assertEqual({'org-c'}, index.roles_for('2a03:b0c0:beef:d00d::8fe:6e47'))
+        self.assertEqual(set(), index.roles_for('::1'))
+        self.assertEqual(set(), index.roles_for('10.0.0.1'))
+        with self.assertRaises(ValueError):
+            index.roles_for('not-an-address')
+
+
+class IPRangeIndexInvalidationTest(AbstractIPRangeSingleOrgTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+        self._patch({'ip_ranges': ['192.168.0.0/16']})
+        self.enter_app_context()
+
+    def test_no_database_query_when_built(self):
+        self.assertEqual(self.org_roles, self.om.roles_for_ip_address('192.168.3.4'))
+
+        with mock.patch('pymongo.collection.Collection.find') as mock_find:
+            self.assertEqual(self.org_roles, self.om.roles_for_ip_address('192.168.3.4'))
+            self.assertEqual(set(), self.om.roles_for_ip_address('10.1.2.3'))
+        mock_find.assert_not_called()
+
+    def test_invalidated_by_edit(self):
+        self.assertEqual(self.org_roles, self.om.roles_for_ip_address('192.168.3.4'))
+        self._patch({'ip_ranges': ['10.1.0.0/16']})
+        self.assertEqual(set(), self.om.roles_for_ip_address('192.168.3.4'))
+        self.assertEqual(self.org_roles, self.om.roles_for_ip_address('10.1.2.3'))
+
+    def test_invalidated_by_other_process(self):
+        from flask_caching import Cache
+        from pillar.api.organizations import IP_INDEX_GENERATION_KEY
+
+        self.app.cache = Cache(self.app, config={'CACHE_TYPE': 'simple'})
+        self.app.config['ORG_IP_RANGES_CHECK_INTERVAL'] = 0
+        self.om.rebuild_ip_index()
+        self.assertEqual(self.org_roles, self.om.roles_for_ip_address('192.168.3.4'))
+
+        # Another process changes the organization and the generation.
+        org_coll = self.app.db('organizations')
+        org_coll.update_one({'_id': self.org_id}, {'$set': {'org_roles': ['org-other']}})
+        self.assertEqual(self.org_roles, self.om.roles_for_ip_address('192.168.3.4'))
+
+        self.app.cache.set(IP_INDEX_GENERATION_KEY, 'new-generation')
+        self.assertEqual({'org-other'}, self.om.roles_for_ip_address('192.168.3.4'))
+
+    def test_expires_without_shared_cache(self):
+        from flask_caching import Cache
+
+        self.app.cache = Cache(self.app, config={'CACHE_TYPE': 'null'})
+        self.app.config['ORG_IP_RANGES_CHECK_INTERVAL'] = 0
+        self.om.rebuild_ip_index()
+        self.assertEqual(self.org_roles, self.om.roles_for_ip_address('192.168.3.4'))
+
+        # Another process changes the organization, but cannot signal this.
+        org_coll = self.app.db('organizations')
+        org_coll.update_one({'_id': self.org_id}, {'$set': {'org_roles': ['org-other']}})
+        self.assertEqual(self.org_roles, self.om.roles_for_ip_address('192.168.3.4'))
+
+        self.app.config['ORG_IP_RANGES_CACHE_TIMEOUT'] = 0
+        self.assertEqual({'org-other'}, self.om.roles_for_ip_address('192.168.3.4'))
+
+
 class IPRangeLoginRolesTest(AbstractIPRangeSingleOrgTest):
     def setUp(self, **kwargs):
         super().setUp(**kwargs)
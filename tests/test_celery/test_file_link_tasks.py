@@ -100,3 +100,30 @@ class FileLinkCeleryTasksTest(AbstractPillarTest):
         for name, (fid, before) in expected_untouched.items():
             from_db = files_coll.find_one(fid)
             self.assertEqual(from_db['link_expires'], before['link_expires'], f'checking {name}')
+
+    def test_skip_files_of_deleted_projects(self):
+        self.enter_app_context()
+
+        now = datetime.datetime.now(tz=tz_util.utc)
+        deleted_proj_id, _ = self.ensure_project_exists(project_overrides={
+            '_id': ObjectId(), '_deleted': True, 'url': 'deleted-project'})
+
+        # Files of deleted projects should not take up the chunk.
+        fid1, file_1 = self.ensure_file_exists({
+            'backend': 'gcs', 'project': deleted_proj_id,
+            'link_expires': now - datetime.timedelta(hours=5)})
+        # Files of non-existing projects are skipped.
+        fid2, file_2 = self.ensure_file_exists({
+            'backend': 'gcs', 'link_expires': now - datetime.timedelta(hours=4)})
+        self.app.db('files').update_one({'_id': fid2}, {'$set': {'project': ObjectId()}})
+        fid3, _ = self.ensure_file_exists({
+            'backend': 'gcs', 'link_expires': now - datetime.timedelta(hours=3)})
+
+        from pillar.celery import file_link_tasks as flt
+
+        flt.regenerate_all_expired_links('gcs', 2)
+
+        files_coll = self.app.db('files')
+        self.assertEqual(file_1['link_expires'], files_coll.find_one(fid1)['link_expires'])
+        self.assertEqual(file_2['link_expires'], files_coll.find_one(fid2)['link_expires'])
+        self.assertGreater(files_coll.find_one(fid3)['link_expires'], now)
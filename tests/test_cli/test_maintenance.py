@@ -190,6 +190,20 @@ class ReconcileNodeDurationTest(AbstractPillarTest):
                 self.assertUpdated(self.node_id1, duration_seconds=3661)
                 self.assertUpdated(self.node_id2, duration_seconds=432)
 
+    def test_reconcile_from_probed_duration(self):
+        from pillar.cli.maintenance import reconcile_node_video_duration
+
+        # The encoder didn't report the duration, but probing the upload did.
+        node_id = self._create_video_node(probed_duration=47)
+        with self.app.app_context():
+            self.orig_nodes[node_id] = self.app.db('nodes').find_one({'_id': node_id})
+
+            with mock.patch('pillar.api.utils.utcnow') as mock_utcnow:
+                mock_utcnow.return_value = self.fake_now
+                reconcile_node_video_duration(nodes_to_update=[str(node_id)], go=True)
+
+            self.assertUpdated(node_id, duration_seconds=47)
+
     def assertUpdated(self, nid, duration_seconds):
         nodes_coll = self.app.db('nodes')
         new_node = nodes_coll.find_one({'_id': nid})
@@ -208,8 +222,9 @@ class ReconcileNodeDurationTest(AbstractPillarTest):
             orig_node = self.orig_nodes[nid]
             self.assertEqual(orig_node, new_node)
 
-    def _create_video_node(self, file_duration=None, node_duration=None, include_file=True):
-        file_id, _ = self.ensure_file_exists(file_overrides={
+    def _create_video_node(self, file_duration=None, node_duration=None, include_file=True,
+                           probed_duration=None):
+        file_overrides = {
             '_id': ObjectId(),
             'content_type': 'video/mp4',
             'variations': [
@@ -217,7 +232,10 @@ class ReconcileNodeDurationTest(AbstractPillarTest):
                  'duration': file_duration
                  },
             ],
-        })
+        }
+        if probed_duration is not None:
+            file_overrides['duration'] = probed_duration
+        file_id, _ = self.ensure_file_exists(file_overrides=file_overrides)
 
         node = {
             'name': 'Just a node name',
@@ -367,3 +385,26 @@ class FixMissingActivitiesSubscription(AbstractPillarTest):
             valid_subscription = subscriptions_collection.find_one({'_id': id_valid})
             self.assertFalse(valid_subscription['is_subscribed'])
             self.assertFalse(valid_subscription['notifications']['web'])
+
+
+class BackfillNodeAncestorsTest(AbstractPillarTest):
+    def test_backfill(self):
+        from pillar.cli.maintenance import backfill_node_ancestors
+
+        pid, _ = self.ensure_project_exists()
+        top_id = self.create_node({'name': 'top', 'project': pid, 'node_type': 'group'})
+        middle_id = self.create_node({'name': 'middle', 'project': pid, 'node_type': 'group',
+                                      'parent': top_id})
+        bottom_id = self.create_node({'name': 'bottom', 'project': pid, 'node_type': 'asset',
+                                      'parent': middle_id})
+
+        with self.app.app_context():
+            nodes_coll = self.app.db('nodes')
+
+            backfill_node_ancestors(go=False)
+            self.assertEqual(3, nodes_coll.count_documents({'_ancestors': {'$exists': False}}))
+
+            backfill_node_ancestors(go=True)
+            self.assertEqual([], nodes_coll.find_one(top_id)['_ancestors'])
+            self.assertEqual([top_id], nodes_coll.find_one(middle_id)['_ancestors'])
+            self.assertEqual([top_id, middle_id], nodes_coll.find_one(bottom_id)['_ancestors'])
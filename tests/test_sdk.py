@@ -105,3 +105,81 @@ class FlaskInternalApiTest(AbstractPillarTest):
             resp = self.get(url_for('nodes|item_lookup', _id=node_id), auth_token='token')
             node_doc = resp.get_json()
             self.assertEqual('BlenderDesktopLogo.png', node_doc['name'])
+
+
+class DirectInternalApiTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        self.project_id, self.user_id = self.create_project_with_admin()
+        self.create_valid_auth_token(self.user_id, 'token')
+
+        self.node_id = self.create_node({
+            'description': '',
+            'project': self.project_id,
+            'node_type': 'group',
+            'user': self.user_id,
+            'properties': {'status': 'published'},
+            'name': 'Test group',
+        })
+
+    def _apis(self):
+        from pillar.sdk import DirectInternalApi
+
+        kwargs = dict(endpoint='/api/', username=None, password=None, token='token')
+        return FlaskInternalApi(**kwargs), DirectInternalApi(**kwargs)
+
+    def _login(self):
+        from pillar.api.utils.authentication import validate_this_token
+        validate_this_token('token')
+
+    def test_find_same_as_test_client(self):
+        flask_api, direct_api = self._apis()
+
+        with self.app.test_request_context():
+            self._login()
+            via_flask = pillarsdk.Node.find(str(self.node_id), api=flask_api)
+            via_direct = pillarsdk.Node.find(str(self.node_id), api=direct_api)
+
+        self.assertEqual(via_flask.to_dict(), via_direct.to_dict())
+        self.assertIsInstance(via_direct._id, str)
+        self.assertIsInstance(via_direct.project, str)
+
+    def test_all_same_as_test_client(self):
+        flask_api, direct_api = self._apis()
+        params = {'where': {'project': str(self.project_id)}}
+
+        with self.app.test_request_context():
+            self._login()
+            via_flask = pillarsdk.Node.all(params, api=flask_api)
+            via_direct = pillarsdk.Node.all(params, api=direct_api)
+
+        self.assertEqual(via_flask.to_dict(), via_direct.to_dict())
+        self.assertEqual(1, len(via_direct['_items']))
+
+    def test_custom_endpoint_falls_back(self):
+        _, direct_api = self._apis()
+
+        # PATCH on nodes is handled by a Flask view, not by Eve.
+        with self.app.test_request_context(f'/api/nodes/{self.node_id}', method='PATCH'):
+            self.assertIsNone(direct_api._eve_method_for_request('PATCH'))
+        with self.app.test_request_context(f'/api/nodes/{self.node_id}', method='GET'):
+            self.assertIsNotNone(direct_api._eve_method_for_request('GET'))
+
+    def test_not_found(self):
+        from pillarsdk import ResourceNotFound
+
+        _, direct_api = self._apis()
+        with self.app.test_request_context():
+            self._login()
+            with self.assertRaises(ResourceNotFound):
+                pillarsdk.Node.find(24 * 'f', api=direct_api)
+
+    def test_other_user_falls_back(self):
+        from pillar.sdk import DirectInternalApi
+
+        other_api = DirectInternalApi(endpoint='/api/', username=None, password=None,
+                                      token='other-token')
+        with self.app.test_request_context():
+            self._login()
+            self.assertFalse(other_api._can_dispatch_directly())
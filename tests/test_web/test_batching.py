@@ -0,0 +1,75 @@
+from unittest import mock
+
+from bson import ObjectId
+import pillarsdk
+from pillarsdk.exceptions import ResourceNotFound
+
+from pillar.tests import AbstractPillarTest
+
+
+class BatchLoaderTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        self.file_ids = [self.ensure_file_exists({'_id': ObjectId()})[0] for _ in range(3)]
+        self.user_id = self.create_user(token='token')
+
+    def _api(self):
+        from pillar.sdk import FlaskInternalApi
+        return FlaskInternalApi(endpoint='/api/', username=None, password=None, token='token')
+
+    def test_single_query_for_queued_ids(self):
+        from pillar.web.utils import batching
+
+        with self.app.test_request_context():
+            files = batching.loader(pillarsdk.File, api=self._api())
+            files.queue(self.file_ids + [None])
+
+            with mock.patch.object(pillarsdk.File, 'all', wraps=pillarsdk.File.all) as mock_all, \
+                    mock.patch.object(pillarsdk.File, 'find', wraps=pillarsdk.File.find) as mock_find:
+                found = [files.find(file_id) for file_id in self.file_ids]
+                # Finding again should not perform any query.
+                files.find(self.file_ids[0])
+
+            mock_all.assert_called_once()
+            mock_find.assert_not_called()
+
+        self.assertEqual([str(file_id) for file_id in self.file_ids],
+                         [file_doc._id for file_doc in found])
+
+    def test_same_loader_within_request(self):
+        from pillar.web.utils import batching
+
+        api = self._api()
+        with self.app.test_request_context():
+            loader = batching.loader(pillarsdk.File, api=api)
+            self.assertIs(loader, batching.loader(pillarsdk.File, api=api))
+            self.assertIsNot(loader, batching.loader(pillarsdk.Node, api=api))
+            self.assertIsNot(loader, batching.loader(pillarsdk.File, api=api,
+                                                     params={'projection': {'name': 1}}))
+
+    def test_missing_document(self):
+        from pillar.web.utils import batching
+
+        missing_id = ObjectId()
+        with self.app.test_request_context():
+            files = batching.loader(pillarsdk.File, api=self._api())
+            files.queue([self.file_ids[0], missing_id])
+
+            with self.assertRaises(ResourceNotFound):
+                files.find(missing_id)
+            self.assertEqual(str(self.file_ids[0]), files.find(self.file_ids[0])._id)
+
+            found = files.find_many([missing_id, self.file_ids[1]])
+            self.assertEqual([str(self.file_ids[1])], [file_doc._id for file_doc in found])
+
+    def test_returns_independent_objects(self):
+        from pillar.web.utils import batching
+
+        with self.app.test_request_context():
+            files = batching.loader(pillarsdk.File, api=self._api())
+            first = files.find(self.file_ids[0])
+            first.link = None
+            second = files.find(self.file_ids[0])
+
+        self.assertIsNotNone(second.link)
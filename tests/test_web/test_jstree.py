@@ -1,9 +1,12 @@
+from unittest import mock
+
 from bson import ObjectId
 from dateutil.parser import parse
 from flask import Markup
 
 from pillarsdk import Node
 from pillar.tests import AbstractPillarTest
+from pillar.tests import common_test_data as ctd
 
 
 class JSTreeTest(AbstractPillarTest):
@@ -138,3 +141,109 @@ class JSTreeTest(AbstractPillarTest):
 
         resp = self.get(f'/p/{self.project["url"]}/jstree')
         self.assertEqual(200, resp.status_code)
+
+
+class JSTreeBuildTest(AbstractPillarTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+        self.project_id, self.project = self.ensure_project_exists()
+        self.user_id = self.create_user(groups=[ctd.EXAMPLE_ADMIN_GROUP_ID], token='token')
+
+        self.top = self._create_group('top', None)
+        self.middle = self._create_group('middle', self.top)
+        self._create_group('middle sibling', self.top)
+        self.bottom = self._create_group('bottom', self.middle)
+        self.leaf = self.create_node({
+            'project': self.project_id,
+            'node_type': 'asset',
+            'parent': self.bottom,
+            'user': self.user_id,
+            'properties': {'status': 'published', 'content_type': 'image'},
+            'name': 'leaf',
+        })
+
+    def _create_group(self, name, parent_id):
+        node = {
+            'project': self.project_id,
+            'node_type': 'group',
+            'user': self.user_id,
+            'properties': {'status': 'published'},
+            'name': name,
+        }
+        if parent_id:
+            node['parent'] = parent_id
+        return self.create_node(node)
+
+    def _find_node(self, node_id):
+        from pillar.web import system_util
+
+        return Node.find(str(node_id), {'projection': {
+            'name': 1, 'node_type': 1, 'parent': 1, 'project': 1,
+            'properties.content_type': 1,
+        }}, api=system_util.pillar_api())
+
+    def test_build_from_node_same_as_per_level(self):
+        from pillar.web.utils import jstree
+
+        with self.app.test_request_context():
+            self.login_api_as(self.user_id, group_ids=[ctd.EXAMPLE_ADMIN_GROUP_ID])
+            node = self._find_node(self.leaf)
+            expect = jstree._jstree_build_from_node_per_level(node, {'projection': {
+                'name': 1, 'parent': 1, 'project': 1, 'node_type': 1,
+                'properties.content_type': 1,
+            }})
+            actual = jstree.jstree_build_from_node(node)
+
+        self.assertEqual(expect, actual)
+        self.assertEqual(f'n_{self.top}', actual[0]['id'])
+        self.assertEqual(['middle', 'middle sibling'],
+                         [child['text'] for child in actual[0]['children']])
+
+    def test_stored_ancestors(self):
+        from pillar.api.nodes import hierarchy
+        from pillar.web import system_util
+        from pillar.web.utils import jstree
+
+        with self.app.test_request_context():
+            hierarchy.backfill(go=True)
+
+            self.login_api_as(self.user_id, group_ids=[ctd.EXAMPLE_ADMIN_GROUP_ID])
+            node = Node.find(str(self.leaf), {'projection': {
+                'name': 1, 'node_type': 1, 'parent': 1, 'project': 1, '_ancestors': 1,
+            }}, api=system_util.pillar_api())
+            self.assertEqual([str(self.top), str(self.middle), str(self.bottom)],
+                             [str(ancestor_id) for ancestor_id in node._ancestors])
+
+            with mock.patch('pillar.api.nodes.hierarchy.find_ancestor_ids') as mock_find:
+                ancestors = jstree._jstree_find_ancestors(node, {'projection': {
+                    'name': 1, 'parent': 1,
+                }})
+            mock_find.assert_not_called()
+
+        self.assertEqual(['bottom', 'middle', 'top'], [ancestor.name for ancestor in ancestors])
+
+    def test_ancestor_ids(self):
+        from pillar.api.nodes.hierarchy import find_ancestor_ids
+
+        with self.app.app_context():
+            self.assertEqual([self.bottom, self.middle, self.top], find_ancestor_ids(self.leaf))
+            self.assertEqual([], find_ancestor_ids(self.top))
+
+    def test_subtree_prefetch(self):
+        resp = self.get(f'/p/{self.project["url"]}/jstree', qs={'depth': 2},
+                        auth_token='token')
+        items = resp.get_json()['items']
+
+        self.assertEqual(1, len(items))
+        top = items[0]
+        self.assertEqual(['middle', 'middle sibling'],
+                         [child['text'] for child in top['children']])
+        # Two levels prefetched, so the third level should be left to jstree.
+        self.assertEqual([{'id': f'n_{self.bottom}'}],
+                         [{'id': child['id']} for child in top['children'][0]['children']])
+        self.assertIs(True, top['children'][0]['children'][0]['children'])
+
+    def test_subtree_no_depth(self):
+        resp = self.get(f'/p/{self.project["url"]}/jstree', auth_token='token')
+        items = resp.get_json()['items']
+        self.assertIs(True, items[0]['children'])
@@ -71,6 +71,25 @@ class BreadcrumbsTest(AbstractPillarTest):
 
         return node_id
 
+    def test_happy_stored_ancestors(self):
+        from pillar.api.nodes import hierarchy
+
+        create_node = self.create_node
+
+        def create_node_with_ancestors(node_doc: dict) -> ObjectId:
+            node_id = create_node(node_doc)
+            with self.app.app_context():
+                hierarchy.backfill(go=True)
+            return node_id
+
+        # The breadcrumbs should use the stored ancestors of the SDK Node.
+        self.create_node = create_node_with_ancestors
+        node_id = self.test_happy()
+
+        with self.app.app_context():
+            node = self.app.db('nodes').find_one(node_id)
+        self.assertEqual(2, len(node['_ancestors']))
+
     def test_missing_parent(self):
         # Note that this group node doesn't exist in the database:
         group_node_id = ObjectId(3 * 'deadbeef')